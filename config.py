@@ -9,8 +9,60 @@ MAX_LEVEL = 50
 
 # Настройки базы данных
 DB_PATH = "data/fnf_mmo.db"
+DB_STORAGE = os.getenv("FNF_DB_STORAGE", "file")  # "file" (WAL на диске), "memory" (SQLite в памяти) или "python" (без SQLite)
+DB_CACHE_SIZE_KB = 16384  # кэш страниц SQLite на соединение
+DB_MMAP_SIZE = 256 * 1024 * 1024  # байт под memory-mapped I/O
+DB_CHECKPOINT_SECONDS = 60  # интервал фоновых PASSIVE чекпоинтов WAL
+DB_READERS = 4  # соединений-читателей в пуле асинхронного DAO
+DB_GROUP_COMMIT_MS = 0  # окно группового коммита записей DAO, 0 - коммит на каждую операцию
+DB_SHARDS = int(os.getenv("FNF_DB_SHARDS", "1"))  # >1 - игроки разложены по файлам по хэшу telegram_id
+DB_SHARD_PATH = "data/fnf_mmo.shard{}.db"  # путь шарда по номеру
+
+# Снимки базы в режиме "memory" (восстанавливаются при старте)
+DB_SNAPSHOT_DIR = "data/snapshots"
+DB_SNAPSHOT_KEEP = 3  # сколько последних снимков хранить
+DB_SNAPSHOT_INTERVAL_SECONDS = 300
+DB_SNAPSHOT_STEP_PAGES = 256  # страниц за один шаг backup, на это время писатель ждет
+DB_SNAPSHOT_STEP_PAUSE_MS = 5  # пауза между шагами, чтобы писатель успевал работать
+DB_SNAPSHOT_MAX_RESTARTS = 3  # перезапусков из-за записей до копии через промежуточную базу
+
+# Хранение истории битв
+HISTORY_RETENTION_DAYS = 30  # сырые записи старше удаляются, итоги остаются в song_stats, повторы - в battle_replays
+HISTORY_COMPACT_BATCH = 500  # строк за одну транзакцию
+HISTORY_COMPACT_INTERVAL_HOURS = 6
+
+# Прогресс квестов и достижений копится в памяти и пишется пачкой,
+# при падении теряется не больше этого интервала (завершения пишутся сразу)
+PROGRESS_FLUSH_SECONDS = 10
+
+# Ежедневная ротация квестов
+DAILY_ROLLOVER_HOUR = 0  # время запуска по UTC, как и даты квестов
+DAILY_ROLLOVER_MINUTE = 5
+DAILY_ACTIVE_DAYS = 3  # задания заранее получают игроки, активные за это число дней
+DAILY_ROLLOVER_BATCH = 500  # строк (или игроков) за одну транзакцию
 
 # Настройки боя
 MAX_COMBO = 1000
 
 PERFECT_TIMING_WINDOW = 0.1  # секунды
+GOOD_TIMING_WINDOW = 0.3  # секунды, дальше - bad
+BATTLE_CHART_VARIANTS = 8  # вариантов нотной карты на песню (seed битвы от 0 до N-1)
+BATTLE_CHART_CACHE_SIZE = 64  # карт в LRU-кэше, хватает на все песни и варианты
+BATTLE_IDLE_TTL_SECONDS = 15 * 60  # битва без ввода дольше этого срока считается брошенной
+BATTLE_PERSIST_SECONDS = 5  # интервал сохранения незавершенных битв и вытеснения брошенных
+BATTLE_PHRASE_NOTES = 8  # нот в подсказке для ввода фразой (текстом одним сообщением)
+
+# Правки сообщений битвы (склеиваются, если игрок жмет быстрее лимитов Telegram)
+# Правок одного чата не чаще. Не больше шага нот (NOTE_INTERVAL_MS в game/charts.py),
+# иначе склеенное сообщение показывает ноту позже, чем открывается ее окно
+EDIT_MIN_INTERVAL_SECONDS = 0.8
+# Общий лимит считает только правки битв. Ответы на callback (query.answer) и
+# сообщения команд (reply_text, send_message) идут мимо него - по одному на
+# действие игрока, поэтому правкам оставлен запас до лимита Telegram
+EDIT_GLOBAL_RATE = 25  # правок в секунду на весь бот (лимит Telegram около 30 сообщений в секунду)
+EDIT_GLOBAL_BURST = 30  # запас токенов для всплесков
+
+# Оценка задержки Telegram (сглаженное опоздание нажатия относительно карты)
+LATENCY_EWMA_ALPHA = 0.2  # вес нового замера
+LATENCY_INITIAL_SECONDS = 0.5  # оценка для игрока без замеров
+LATENCY_MAX_SECONDS = 3.0  # замеры больше считаются паузой игрока и в оценку не идут
\ No newline at end of file
@@ -1,3 +1,19 @@
+# Реестр сюжета: позиция в списке - номер бита в story_progress.chapter_bits
+# и story_progress.flag_bits. Списки только дополняются в конец: удаление или
+# перестановка поменяет смысл уже сохраненных битов.
+CHAPTERS = [
+    "chapter1",
+    "chapter2",
+    "chapter3",
+    "chapter4",
+]
+
+STORY_FLAGS = [
+    "ask_pico_past",
+    "help_pico",
+    "challenge_battle",
+]
+
 def get_story_scene(chapter, scene):
     return None
 
@@ -1,9 +1,22 @@
+import asyncio
+import datetime
+import functools
 import logging
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from core.database import database
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
+from core.counters import progress
+from core.dao import dao
+from core.edits import EditCoalescer
+from core.database import snapshots
+from core.identity_map import per_update
 from game.engine import game_engine
 from game.battle import battle_system
+from game.charts import parse_phrase, phrase_text
+from game.battle_sessions import battle_sessions
+from game.timing import timing_judge
+from game.achievements import ACHIEVEMENT_NAMES
+from game.leaderboard import leaderboards
 from content.story import get_story_scene, get_available_chapters
 import config
 
@@ -12,32 +25,157 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+logger = logging.getLogger(__name__)
+
 class FNFMMOBot:
     def __init__(self):
         self.application = Application.builder().token(config.BOT_TOKEN).build()
+        # Правки экрана битвы идут через очередь с лимитами, а не напрямую
+        self.edits = EditCoalescer(self.application.bot)
         self.setup_handlers()
-        self.user_battles = {}  # {user_id: battle_data}
+        self.setup_jobs()
+        # Битвы, прерванные перезапуском, продолжаются с той же ноты
+        battle_sessions.restore()
         
     def setup_handlers(self):
-        self.application.add_handler(CommandHandler("start", self.start))
-        self.application.add_handler(CommandHandler("play", self.play))
-        self.application.add_handler(CommandHandler("profile", self.profile))
-        self.application.add_handler(CommandHandler("inventory", self.inventory))
-        self.application.add_handler(CommandHandler("achievements", self.achievements))
-        self.application.add_handler(CommandHandler("quests", self.quests))
-        self.application.add_handler(CommandHandler("battle", self.battle))
-        self.application.add_handler(CommandHandler("story", self.story))
-        self.application.add_handler(CommandHandler("daily", self.daily))
-        
-        self.application.add_handler(CallbackQueryHandler(self.button_handler))
+        self.application.add_handler(CommandHandler("start", per_update(self.start)))
+        self.application.add_handler(CommandHandler("play", per_update(self.play)))
+        self.application.add_handler(CommandHandler("profile", per_update(self.profile)))
+        self.application.add_handler(CommandHandler("inventory", per_update(self.inventory)))
+        self.application.add_handler(CommandHandler("achievements", per_update(self.achievements)))
+        self.application.add_handler(CommandHandler("quests", per_update(self.quests)))
+        self.application.add_handler(CommandHandler("battle", per_update(self.battle)))
+        self.application.add_handler(CommandHandler("story", per_update(self.story)))
+        self.application.add_handler(CommandHandler("daily", per_update(self.daily)))
+        self.application.add_handler(CommandHandler("top", per_update(self.top)))
+        
+        self.application.add_handler(CallbackQueryHandler(per_update(self.button_handler)))
+        # Текст во время битвы - ввод фразой из нескольких нот
+        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_update(self.battle_phrase)))
+        
+    def setup_jobs(self):
+        job_queue = self.application.job_queue
+        if job_queue is None:
+            logger.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]), фоновые задачи отключены")
+            return
+        
+        job_queue.run_repeating(
+            self.compact_history_job,
+            interval=config.HISTORY_COMPACT_INTERVAL_HOURS * 3600,
+            first=60,
+            name="compact_battle_history"
+        )
+        job_queue.run_repeating(
+            self.progress_flush_job,
+            interval=config.PROGRESS_FLUSH_SECONDS,
+            name="progress_flush"
+        )
+        job_queue.run_repeating(
+            self.battle_sessions_job,
+            interval=config.BATTLE_PERSIST_SECONDS,
+            name="battle_sessions"
+        )
+        job_queue.run_daily(
+            self.daily_rollover_job,
+            time=datetime.time(
+                hour=config.DAILY_ROLLOVER_HOUR, minute=config.DAILY_ROLLOVER_MINUTE, tzinfo=datetime.timezone.utc
+            ),
+            name="daily_quest_rollover"
+        )
+        if config.DB_STORAGE == "memory":
+            job_queue.run_repeating(
+                self.snapshot_job,
+                interval=config.DB_SNAPSHOT_INTERVAL_SECONDS,
+                first=config.DB_SNAPSHOT_INTERVAL_SECONDS,
+                name="database_snapshot"
+            )
+    
+    async def compact_history_job(self, context: ContextTypes.DEFAULT_TYPE):
+        # Каждая порция - отдельная операция писателя, между ними проходят запросы игроков
+        total = 0
+        while True:
+            deleted = await dao.compact_battle_history(
+                config.HISTORY_RETENTION_DAYS, config.HISTORY_COMPACT_BATCH
+            )
+            total += deleted
+            if deleted < config.HISTORY_COMPACT_BATCH:
+                break
         
+        if total:
+            logger.info(f"Удалено старых записей истории битв: {total}")
+    
+    async def progress_flush_job(self, context: ContextTypes.DEFAULT_TYPE):
+        await dao.run(progress.periodic_flush)
+    
+    async def battle_sessions_job(self, context: ContextTypes.DEFAULT_TYPE):
+        # Вытеснение смотрит только на истекшие записи кучи, сохранение - одна пачка
+        evicted = battle_sessions.evict_expired()
+        await dao.run(battle_sessions.flush)
+        
+        if evicted:
+            stats = battle_sessions.stats()
+            logger.info(
+                f"Вытеснено брошенных битв: {evicted}; активных {stats['active']}, "
+                f"~{stats['memory_bytes'] // 1024} КБ, всего начато {stats['started']}, "
+                f"завершено {stats['completed']}, сбежали {stats['fled']}, вытеснено {stats['evicted']}"
+            )
+            edits = self.edits.stats()
+            logger.info(
+                f"Правки битв: запрошено {edits['requested']}, отправлено {edits['sent']}, "
+                f"склеено {edits['merged']}, без изменений {edits['dropped']}, "
+                f"RetryAfter {edits['retry_after']}, ошибок {edits['failed']}"
+            )
+    
+    async def snapshot_job(self, context: ContextTypes.DEFAULT_TYPE):
+        # Снимок копируется в отдельном потоке порциями, писатель ждет только один шаг
+        await dao.run(progress.flush)
+        try:
+            stats = await asyncio.to_thread(snapshots.snapshot)
+        except Exception as e:
+            logger.error(f"Ошибка снимка базы: {e}")
+            return
+        
+        logger.info(
+            f"Снимок базы {stats['path']}: {stats['pages']} страниц за {stats['duration_ms']} мс, "
+            f"писатель ждал {stats['blocked_ms']} мс (макс. шаг {stats['max_blocked_ms']} мс)"
+        )
+    
+    async def daily_rollover_job(self, context: ContextTypes.DEFAULT_TYPE):
+        # Удаляем вчерашние квесты и заранее выдаем сегодняшние активным игрокам
+        started = time.perf_counter()
+        batch = config.DAILY_ROLLOVER_BATCH
+        # Сроки квестов, played_at и last_activity - все в UTC
+        now = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        
+        # Прогресс из памяти относится к старым квестам - записываем до удаления
+        await dao.run(progress.forget_quests)
+        
+        expired = 0
+        while True:
+            deleted = await dao.expire_quests(now, batch)
+            expired += deleted
+            if deleted < batch:
+                break
+        
+        player_ids = await dao.get_recently_active_player_ids(config.DAILY_ACTIVE_DAYS)
+        created = 0
+        for i in range(0, len(player_ids), batch):
+            created += await dao.run(game_engine.generate_daily_quests_for, player_ids[i:i + batch])
+        
+        elapsed = time.perf_counter() - started
+        rows = expired + created
+        logger.info(
+            f"Ротация квестов: удалено {expired}, создано {created} для {len(player_ids)} игроков "
+            f"за {elapsed:.2f} с ({rows / elapsed if elapsed else 0:.0f} строк/с)"
+        )
+    
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        player = database.get_player(user.id)
+        player = await dao.get_player(user.id)
         
         if not player:
             # Создаем нового игрока
-            player = database.create_player(user.id, user.username, user.first_name)
+            player = await dao.create_player(user.id, user.username, user.first_name)
             await update.message.reply_text(
                 f"🎮 *Добро пожаловать в Friday Night Funkin MMO!*\n\n"
                 f"Привет, {user.first_name}! Я твой проводник в мире ритм-баттлов и драматических историй.\n\n"
@@ -50,7 +188,8 @@ class FNFMMOBot:
                 f"/quests - Задания\n"
                 f"/achievements - Достижения\n"
                 f"/inventory - Инвентарь\n"
-                f"/daily - Ежедневные задания",
+                f"/daily - Ежедневные задания\n"
+                f"/top - Рейтинги",
                 parse_mode='Markdown'
             )
         else:
@@ -64,7 +203,7 @@ class FNFMMOBot:
     
     async def play(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        player = database.get_player(user.id)
+        player = await dao.get_player(user.id)
         
         if not player:
             await update.message.reply_text("Сначала зарегистрируйся с помощью /start")
@@ -77,15 +216,25 @@ class FNFMMOBot:
             parse_mode='Markdown'
         )
     
+    async def load_progress(self, telegram_id):
+        """Сводка прогресса через пул читателей, писатель нужен только для незаписанных приростов"""
+        player = await dao.get_player(telegram_id)
+        if not player:
+            return None
+        if progress.has_pending(player['id']):
+            await dao.run_for(player['id'], progress.flush_player, player['id'])
+        dashboard = await dao.get_player_dashboard(player['id'])
+        return game_engine.summarize_progress(player, dashboard)
+    
     async def profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        progress = game_engine.get_player_progress(user.id)
+        # Профилю счетчики прогресса не нужны - хватает записи игрока
+        player = await dao.get_player(user.id)
         
-        if not progress:
+        if not player:
             await update.message.reply_text("Игрок не найден! Используй /start")
             return
             
-        player = progress['player']
         stats = player['stats'] or {}
         
         text = (
@@ -105,14 +254,14 @@ class FNFMMOBot:
             f"⭐ Идеально: {stats.get('perfect_scores', 0)}\n"
             f"🔥 Макс комбо: {stats.get('max_combo', 0)}\n"
             f"📜 Квестов: {stats.get('quests_completed', 0)}\n\n"
-            f"🎮 Игровое время: {progress['play_time']['total']} минут"
+            f"🎮 Игровое время: {game_engine.play_time(player)['total']} минут"
         )
         
         await update.message.reply_text(text, parse_mode='Markdown')
     
     async def story(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        player = database.get_player(user.id)
+        player = await dao.get_player(user.id)
         
         if not player:
             await update.message.reply_text("Сначала зарегистрируйся с помощью /start")
@@ -141,7 +290,7 @@ class FNFMMOBot:
     
     async def battle(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        player = database.get_player(user.id)
+        player = await dao.get_player(user.id)
         
         if not player:
             await update.message.reply_text("Сначала зарегистрируйся с помощью /start")
@@ -173,36 +322,39 @@ class FNFMMOBot:
     
     async def achievements(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        progress = game_engine.get_player_progress(user.id)
+        progress = await self.load_progress(user.id)
         
         if not progress:
             await update.message.reply_text("Игрок не найден!")
             return
             
         achievements = progress['achievements']
+        shown = await dao.get_player_achievements(progress['player']['id'], 10)  # Показываем первые 10
         
         text = f"🏆 *Достижения* - {progress['player']['character_name']}\n\n"
         text += f"Завершено: {achievements['completed']}/{achievements['total']} ({achievements['completion_percentage']}%)\n\n"
         
-        for achievement in achievements['list'][:10]:  # Показываем первые 10
+        for achievement in shown:
             status = "✅" if achievement['completed'] else "🔄"
             text += f"{status} *{achievement['achievement_name']}*\n"
             text += f"   {achievement['progress']}/{achievement['target']} - {achievement['achievement_id']}\n\n"
             
-        if len(achievements['list']) > 10:
-            text += f"... и ещё {len(achievements['list']) - 10} достижений!"
+        if achievements['total'] > len(shown):
+            text += f"... и ещё {achievements['total'] - len(shown)} достижений!"
         
         await update.message.reply_text(text, parse_mode='Markdown')
     
     async def quests(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        player = database.get_player(user.id)
+        player = await dao.get_player(user.id)
         
         if not player:
             await update.message.reply_text("Игрок не найден!")
             return
             
-        active_quests = database.get_active_quests(player['id'])
+        if progress.has_pending(player['id']):
+            await dao.run_for(player['id'], progress.flush_player, player['id'])
+        active_quests = await dao.get_active_quests(player['id'])
         
         if not active_quests:
             text = "📜 *Активные задания*\n\nНет активных заданий.\nИспользуй /daily для получения ежедневных заданий!"
@@ -216,13 +368,13 @@ class FNFMMOBot:
     
     async def daily(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        player = database.get_player(user.id)
+        player = await dao.get_player(user.id)
         
         if not player:
             await update.message.reply_text("Игрок не найден!")
             return
             
-        generated = game_engine.generate_daily_quests(player['id'])
+        generated = await dao.run_for(player['id'], game_engine.generate_daily_quests, player['id'])
         
         await update.message.reply_text(
             f"📅 *Ежедневные задания обновлены!*\n\n"
@@ -231,21 +383,62 @@ class FNFMMOBot:
             parse_mode='Markdown'
         )
     
+    async def top(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        player = await dao.get_player(user.id)
+        
+        if not player:
+            await update.message.reply_text("Сначала зарегистрируйся с помощью /start")
+            return
+        
+        song_id = context.args[0] if context.args else None
+        board = leaderboards.board(song_id)
+        
+        if board is None:
+            songs = "\n".join(f"/top {song_id} - {song['name']}" for song_id, song in battle_system.songs.items())
+            await update.message.reply_text(f"Песня не найдена! Доступные рейтинги:\n\n/top - Общий\n{songs}")
+            return
+        
+        # Топ берется из памяти, база нужна только для имен и места вне топа
+        entries = board.top(10)
+        names = await dao.get_player_names([player_id for player_id, _ in entries])
+        
+        title = battle_system.songs[song_id]['name'] if song_id else "Общий рейтинг"
+        text = f"🏆 *{title}*\n\n"
+        
+        if not entries:
+            text += "Пока никто не играл!\n"
+        for place, (player_id, score) in enumerate(entries, 1):
+            text += f"{place}. {names.get(player_id, '???')} - {score}\n"
+        
+        own = board.rank(player['id'])
+        if own is None:
+            own_rank = await dao.get_leaderboard_rank(player['id'], song_id)
+            own = (own_rank['rank'], own_rank['score']) if own_rank else None
+        
+        if own:
+            text += f"\n📍 Твое место: {own[0]} ({own[1]})"
+        else:
+            text += "\n📍 Сыграй битву, чтобы попасть в рейтинг!"
+        
+        await update.message.reply_text(text, parse_mode='Markdown')
+    
     async def inventory(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        progress = game_engine.get_player_progress(user.id)
+        player = await dao.get_player(user.id)
         
-        if not progress:
+        if not player:
             await update.message.reply_text("Игрок не найден!")
             return
             
-        inventory = progress['inventory']
+        # Итог считается по уже загруженному списку, без отдельного запроса счетчиков
+        items = await dao.get_inventory(player['id'])
         
-        text = f"🎒 *Инвентарь* - {progress['player']['character_name']}\n\n"
-        text += f"Всего предметов: {inventory['total_items']}\n\n"
+        text = f"🎒 *Инвентарь* - {player['character_name']}\n\n"
+        text += f"Всего предметов: {sum(item['quantity'] for item in items)}\n\n"
         
-        if inventory['items']:
-            for item in inventory['items']:
+        if items:
+            for item in items:
                 text += f"📦 {item['item_name']} x{item['quantity']}\n"
         else:
             text += "Инвентарь пуст!\n"
@@ -253,6 +446,8 @@ class FNFMMOBot:
         await update.message.reply_text(text, parse_mode='Markdown')
     
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Время нажатия фиксируем до любых await, включая answerCallbackQuery
+        stamp = timing_judge.stamp()
         query = update.callback_query
         await query.answer()
         
@@ -264,7 +459,7 @@ class FNFMMOBot:
         elif data.startswith("battle_"):
             await self.handle_battle(user_id, data, query)
         elif data.startswith("arrow_"):
-            await self.handle_battle_input(user_id, data, query)
+            await self.handle_battle_input(user_id, data, query, stamp)
             
     async def handle_story_choice(self, user_id, data, query):
         parts = data.split("_")
@@ -277,20 +472,17 @@ class FNFMMOBot:
             return
             
         # Проверяем энергию
-        player = database.get_player(user_id)
+        player = await dao.get_player(user_id)
         energy_cost = story_scene.get('energy_cost', 0)
         
-        if player['energy'] < energy_cost:
+        # Списываем энергию одним условным UPDATE
+        if not await dao.spend_energy(player['id'], energy_cost):
             await query.edit_message_text(
                 f"Недостаточно энергии! Нужно: {energy_cost}, есть: {player['energy']}\n"
                 f"Энергия восстанавливается со временем."
             )
             return
             
-        # Используем энергию
-        if energy_cost > 0:
-            database.update_energy(player['id'], player['energy'] - energy_cost)
-            
         # Показываем сцену
         text = story_scene['text']
         
@@ -316,11 +508,13 @@ class FNFMMOBot:
         
         # Обрабатываем награды за выбор
         if len(parts) > 3 and parts[3] != "intro":
-            rewards = game_engine.process_story_choice(player['id'], parts[3], story_scene)
+            rewards = await dao.run_for(player['id'], game_engine.process_story_choice, player['id'], parts[3], story_scene)
             if rewards['exp'] > 0 or rewards['money'] > 0:
                 reward_text = f"\n\n🎁 Награды: +{rewards['exp']} опыта"
                 if rewards['money'] > 0:
                     reward_text += f", +{rewards['money']} денег"
+                for achievement_id in rewards['achievements']:
+                    reward_text += f"\n🏆 Достижение: {ACHIEVEMENT_NAMES.get(achievement_id, achievement_id)}"
                 await context.bot.send_message(
                     chat_id=user_id,
                     text=reward_text
@@ -330,89 +524,103 @@ class FNFMMOBot:
         parts = data.split("_")
         action = parts[1]
         song_id = parts[2] if len(parts) > 2 else None
+        edit = self.battle_editor(query)
         
         if action == "start":
-            player = database.get_player(user_id)
+            player = await dao.get_player(user_id)
             song = battle_system.songs.get(song_id)
             
             if not song:
-                await query.edit_message_text("Песня не найдена!")
+                await edit("Песня не найдена!")
                 return
                 
-            # Проверяем энергию
-            if player['energy'] < song['energy_cost']:
-                await query.edit_message_text(
+            # Списываем энергию одним условным UPDATE
+            if not await dao.spend_energy(player['id'], song['energy_cost']):
+                await edit(
                     f"Недостаточно энергии! Нужно: {song['energy_cost']}, есть: {player['energy']}"
                 )
                 return
                 
-            # Начинаем битву
-            battle_data = battle_system.start_battle(player['id'], song_id)
-            self.user_battles[user_id] = battle_data
-            
-            # Используем энергию
-            database.update_energy(player['id'], player['energy'] - song['energy_cost'])
+            # Начинаем битву и сразу сохраняем: энергия уже списана
+            battle_sessions.start(user_id, battle_system.start_battle(player['id'], song_id))
+            await dao.run(battle_sessions.flush)
             
             # Показываем интерфейс битвы
-            await query.edit_message_text(
+            await edit(
                 f"🎸 *БИТВА НАЧАЛАСЬ!*\n\n"
                 f"Песня: {song['name']}\n"
                 f"Нот: {song['notes']}\n"
                 f"Сложность: {'⭐' * song['difficulty']}\n\n"
+                f"Жми стрелки кнопками или отправляй фразу из нескольких нот текстом: ← →↑ ↓\n\n"
                 f"*Готовься к первой ноте!*",
                 parse_mode='Markdown',
                 reply_markup=self.get_battle_keyboard()
             )
-            
-    async def handle_battle_input(self, user_id, data, query):
-        if user_id not in self.user_battles:
-            await query.answer("Битва не начата!")
+
+        elif action == "flee":
+            # Энергия не возвращается, результат не записывается
+            battle = battle_sessions.finish(user_id, "fled")
+            if battle is None:
+                # На callback уже ответил button_handler, повторный answer не пройдет
+                await edit("Битва не начата!", reply_markup=self.get_main_menu_keyboard())
+                return
+
+            await edit(
+                f"🏃 Ты сбежал с битвы {battle.song_name}.\n"
+                f"Сыграно нот: {battle.current_note}/{battle.total_notes}",
+                reply_markup=self.get_main_menu_keyboard()
+            )
+
+    async def handle_battle_input(self, user_id, data, query, stamp):
+        battle = battle_sessions.get(user_id)
+        if battle is None:
+            # На callback уже ответил button_handler, поэтому сообщаем правкой
+            await self.battle_editor(query)("Битва не начата!", reply_markup=self.get_main_menu_keyboard())
             return
-            
-        battle_data = self.user_battles[user_id]
         
-        if battle_data['completed']:
-            await query.answer("Битва уже завершена!")
+        if battle.completed:
+            # Итоги уже отправлены (или в очереди правок), не перетираем их
             return
             
         # Обрабатываем ввод
         arrow = data.split("_")[1]
-        timing_accuracy = "good"  # В реальной игре тут расчет тайминга
+        timing_accuracy = timing_judge.judge(battle, stamp)
         
-        battle_data = battle_system.process_note_input(
-            battle_data, [arrow], timing_accuracy
-        )
+        battle_system.process_note_input(battle, [arrow], timing_accuracy)
+        await self.show_battle_progress(user_id, battle, self.battle_editor(query))
+    
+    async def battle_phrase(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Фраза из нескольких нот одним сообщением: один апдейт и один ответ вместо
+        # answer + edit_message_text на каждую ноту
+        stamp = timing_judge.stamp()
+        user_id = update.effective_user.id
+        battle = battle_sessions.get(user_id)
+        if battle is None or battle.completed:
+            return
         
-        self.user_battles[user_id] = battle_data
+        masks = parse_phrase(update.message.text)
+        if masks is None:
+            await update.message.reply_text(
+                "Не понял фразу. Ноты через пробел, аккорд слитно: ← →↑ ↓ (или l ru d)"
+            )
+            return
         
-        # Обновляем интерфейс
-        current_note = battle_data['current_note']
-        total_notes = battle_data['total_notes']
+        timing_accuracy = timing_judge.judge(battle, stamp, len(masks))
+        battle_system.process_phrase(battle, masks, timing_accuracy)
+        await self.show_battle_progress(user_id, battle, update.message.reply_text, phrase=True)
+    
+    async def show_battle_progress(self, user_id, battle, send, phrase=False):
+        """Показать следующую ноту (или фразу) либо завершить битву; send - edit_message_text или reply_text"""
+        current_note = battle.current_note
+        total_notes = battle.total_notes
         
-        if battle_data['completed']:
+        if battle.completed:
             # Завершаем битву
-            summary = battle_system.get_battle_summary(battle_data)
-            
-            # Записываем в БД
-            database.record_battle(
-                user_id,
-                battle_data['song_id'],
-                battle_data['score'],
-                battle_data['max_combo'],
-                battle_data['perfect_hits'],
-                battle_data['good_hits'],
-                battle_data['bad_hits'],
-                battle_data['missed'],
-                battle_data['battle_duration']
-            )
+            summary = battle_system.get_battle_summary(battle)
+            player = await dao.get_player(user_id)
             
-            # Награды
-            rewards = game_engine.calculate_battle_rewards(
-                user_id,
-                battle_data['score'],
-                battle_data['max_combo'], 
-                battle_data['perfect_hits']
-            )
+            # Записываем битву и выдаем награды одной транзакцией
+            rewards = await dao.run_for(player['id'], game_engine.settle_battle, player['id'], battle)
             
             text = (
                 f"🎉 *БИТВА ЗАВЕРШЕНА!*\n\n"
@@ -429,30 +637,50 @@ class FNFMMOBot:
             
             if rewards.get('level_up'):
                 text += f"🎯 ПОВЫШЕНИЕ УРОВНЯ! Новый уровень: {rewards['level_up']}\n"
+            for achievement_id in rewards['achievements']:
+                text += f"🏆 Достижение: {ACHIEVEMENT_NAMES.get(achievement_id, achievement_id)}\n"
                 
-            await query.edit_message_text(
+            await send(
                 text,
                 parse_mode='Markdown',
                 reply_markup=self.get_main_menu_keyboard()
             )
             
-            del self.user_battles[user_id]
+            battle_sessions.finish(user_id, "completed")
+            
+        elif phrase:
+            # Показываем следующую фразу
+            end = min(current_note + config.BATTLE_PHRASE_NOTES, total_notes)
+            note_text = phrase_text(battle.chart.masks[current_note:end])
+            
+            await send(
+                f"🎸 *БИТВА* - {battle.song_name}\n\n"
+                f"Счет: {battle.score}\n"
+                f"Комбо: {battle.combo}\n"
+                f"Прогресс: {current_note}/{total_notes}\n\n"
+                f"*Следующая фраза:* {note_text}",
+                parse_mode='Markdown',
+                reply_markup=self.get_battle_keyboard()
+            )
             
         else:
             # Показываем следующую ноту
-            next_note = battle_data['patterns'][current_note]
-            note_text = " ".join(next_note['arrows'])
+            note_text = " ".join(battle.chart.arrows(current_note))
             
-            await query.edit_message_text(
-                f"🎸 *БИТВА* - {battle_data['song_name']}\n\n"
-                f"Счет: {battle_data['score']}\n"
-                f"Комбо: {battle_data['combo']}\n"
+            await send(
+                f"🎸 *БИТВА* - {battle.song_name}\n\n"
+                f"Счет: {battle.score}\n"
+                f"Комбо: {battle.combo}\n"
                 f"Прогресс: {current_note}/{total_notes}\n\n"
                 f"*Следующая нота:* {note_text}",
                 parse_mode='Markdown',
                 reply_markup=self.get_battle_keyboard()
             )
     
+    def battle_editor(self, query):
+        """Правка сообщения с кнопкой через EditCoalescer, с той же сигнатурой, что у edit_message_text"""
+        return functools.partial(self.edits.edit_message_text, query.message.chat_id, query.message.message_id)
+    
     def get_main_menu_keyboard(self):
         keyboard = [
             [InlineKeyboardButton("📖 Сюжет", callback_data="menu_story"),
@@ -0,0 +1,142 @@
+import logging
+import threading
+from core.database import database
+
+logger = logging.getLogger(__name__)
+
+class ProgressCounters:
+    """Write-back счетчики прогресса квестов и достижений
+
+    Приросты копятся в памяти по (player_id, id) и пишутся в базу пачкой:
+    по таймеру (config.PROGRESS_FLUSH_SECONDS), при остановке бота и сразу,
+    как только прирост завершает квест или достижение. Поэтому завершения
+    никогда не теряются, а при падении процесса теряется не больше
+    PROGRESS_FLUSH_SECONDS незавершающего прогресса.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.RLock()
+        self.pending_achievements = {}  # {(player_id, achievement_id): прирост}
+        self.pending_quests = {}  # {(player_id, quest_type): прирост}
+        self.achievement_state = {}  # {(player_id, achievement_id): [прогресс, завершено]}
+        self.quest_state = {}  # {(player_id, quest_type): [[прогресс, цель], ...]}
+        self.pending_players = set()  # игроки с незаписанными приростами
+        self.targets = None
+        self.flushes = 0
+
+    def add_achievement(self, player_id, achievement_id, amount=1):
+        """Добавить прогресс достижения, True если оно завершено"""
+        with self.lock:
+            if not amount:
+                return self._achievement(player_id, achievement_id)[1]
+            if self.targets is None:
+                self.targets = self.db.get_achievement_targets()
+            target = self.targets.get(achievement_id)
+            if target is None:
+                return False
+
+            state = self._achievement(player_id, achievement_id)
+            if state[1]:
+                return True
+
+            key = (player_id, achievement_id)
+            self.pending_achievements[key] = self.pending_achievements.get(key, 0) + amount
+            self.pending_players.add(player_id)
+            state[0] += amount
+
+            if state[0] >= target:
+                state[1] = True
+                self.flush()
+            return state[1]
+
+    def add_quest(self, player_id, quest_type, amount=1):
+        """Добавить прогресс квестам типа, возвращает число только что завершенных"""
+        if not amount:
+            return 0
+
+        with self.lock:
+            key = (player_id, quest_type)
+            quests = self.quest_state.get(key)
+            if quests is None:
+                quests = [list(quest) for quest in self.db.get_open_quests(player_id, quest_type)]
+                self.quest_state[key] = quests
+            if not quests:
+                return 0
+
+            self.pending_quests[key] = self.pending_quests.get(key, 0) + amount
+            self.pending_players.add(player_id)
+            completed = 0
+            for quest in quests:
+                quest[0] += amount
+                if quest[0] >= quest[1]:
+                    completed += 1
+
+            if completed:
+                self.flush()
+                # Завершенные квесты больше не растут
+                self.quest_state[key] = [quest for quest in quests if quest[0] < quest[1]]
+            return completed
+
+    def _achievement(self, player_id, achievement_id):
+        key = (player_id, achievement_id)
+        state = self.achievement_state.get(key)
+        if state is None:
+            state = list(self.db.get_achievement_state(player_id, achievement_id))
+            self.achievement_state[key] = state
+        return state
+
+    def flush(self):
+        """Записать все накопленные приросты одной транзакцией"""
+        with self.lock:
+            if not self.pending_achievements and not self.pending_quests:
+                return 0
+
+            achievements, self.pending_achievements = self.pending_achievements, {}
+            quests, self.pending_quests = self.pending_quests, {}
+            players, self.pending_players = self.pending_players, set()
+            try:
+                self.db.apply_progress(achievements, quests)
+            except Exception:
+                # Вернем приросты, чтобы не потерять их до следующей попытки
+                for key, amount in achievements.items():
+                    self.pending_achievements[key] = self.pending_achievements.get(key, 0) + amount
+                for key, amount in quests.items():
+                    self.pending_quests[key] = self.pending_quests.get(key, 0) + amount
+                self.pending_players |= players
+                raise
+
+            self.flushes += 1
+            return len(achievements) + len(quests)
+
+    def has_pending(self, player_id):
+        """Есть ли у игрока незаписанные приросты (без замка - можно звать из event loop)"""
+        return player_id in self.pending_players
+
+    def flush_player(self, player_id):
+        """Записать приросты перед чтением прогресса игрока из базы"""
+        with self.lock:
+            if self.has_pending(player_id):
+                self.flush()
+
+    def forget_quests(self, player_id=None):
+        """Сбросить кэш квестов (после выдачи или удаления квестов)"""
+        with self.lock:
+            self.flush()
+            if player_id is None:
+                self.quest_state.clear()
+            else:
+                for key in [key for key in self.quest_state if key[0] == player_id]:
+                    del self.quest_state[key]
+
+    def periodic_flush(self):
+        """Плановый сброс: пишет приросты и очищает кэш состояний"""
+        with self.lock:
+            written = self.flush()
+            self.achievement_state.clear()
+            self.quest_state.clear()
+            self.targets = None
+            return written
+
+# Глобальные счетчики прогресса
+progress = ProgressCounters(database)
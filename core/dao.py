@@ -0,0 +1,224 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from core.database import database
+import config
+
+logger = logging.getLogger(__name__)
+
+# Запросы только на чтение, которые можно отдать пулу читателей
+READ_METHODS = frozenset({
+    "get_player",
+    "get_player_achievements",
+    "get_active_quests",
+    "get_completed_quests",
+    "get_inventory",
+    "get_player_dashboard",
+    "get_song_stats",
+    "get_leaderboard_top",
+    "get_leaderboard_rank",
+    "get_player_names",
+})
+
+class WriterThread(threading.Thread):
+    """Единственный поток-писатель с опциональным групповым коммитом
+
+    При group_commit_ms > 0 операции, пришедшие в течение окна, выполняются
+    в одной транзакции (каждая в своем SAVEPOINT) и фиксируются одним коммитом.
+    Future операции завершается только после коммита, так что вызывающий
+    код никогда не видит незафиксированный результат.
+    """
+
+    def __init__(self, db, group_commit_ms=0, lock=None, name="db-writer"):
+        super().__init__(name=name, daemon=True)
+        self.db = db
+        # Держим на время операции (снимки и общие операции шардов ждут между ними)
+        self.lock = lock if lock is not None else db.write_lock
+        self.window = group_commit_ms / 1000
+        self.queue = queue.Queue()
+        self.commits = 0
+        self.operations = 0
+
+    def submit(self, fn, *args):
+        # Операция выполняется в контексте вызывающего (карта игроков апдейта и т.п.)
+        future = Future()
+        self.queue.put((future, contextvars.copy_context().run, (fn, *args)))
+        return future
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            with self.lock:
+                if self.window:
+                    stop = self._run_group(item)
+                else:
+                    self._run_one(item)
+                    stop = False
+            if stop:
+                break
+
+    def _run_one(self, item):
+        future, fn, args = item
+        if not future.set_running_or_notify_cancel():
+            return
+        self.operations += 1
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _run_group(self, first):
+        # Возвращает True, если во время сбора группы пришла команда остановки
+        done = []
+        stop = False
+        deadline = time.monotonic() + self.window
+        item = first
+
+        try:
+            with self.db.transaction():
+                while True:
+                    future, fn, args = item
+                    if future.set_running_or_notify_cancel():
+                        self.operations += 1
+                        try:
+                            with self.db.transaction():
+                                done.append((future, True, fn(*args)))
+                        except Exception as e:
+                            done.append((future, False, e))
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+        except Exception as e:
+            logger.error(f"Ошибка группового коммита: {e}")
+            for future, _, _ in done:
+                future.set_exception(e)
+            return stop
+
+        self.commits += 1
+        for future, ok, value in done:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        return stop
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+class AsyncGameDAO:
+    """Асинхронный доступ к GameDatabase, не блокирующий event loop
+
+    Все записи идут через один поток-писатель (SQLite допускает одного писателя),
+    чтения из READ_METHODS - через пул отдельных соединений только на чтение.
+    У шардированной базы писатель свой у каждого шарда: методы базы по игроку
+    идут в писателя его шарда, операции движка (run_for) - в отдельного писателя
+    по игроку, который берет замок шарда только на время каждого вызова.
+    """
+
+    def __init__(self, db, readers=None):
+        self.db = db
+        self.readers = queue.Queue()
+
+        # Базу в памяти нельзя открыть вторым соединением - тогда читаем через писателя
+        reader_count = 0 if db.in_memory else (readers or config.DB_READERS)
+        for _ in range(reader_count):
+            self.readers.put(db.open_reader())
+
+        shards = getattr(db, "shards", None)
+        if shards:
+            self._shard_writers = [
+                WriterThread(shard, config.DB_GROUP_COMMIT_MS, name=f"db-writer-{index}")
+                for index, shard in enumerate(shards)
+            ]
+            # Операция движка может затронуть несколько шардов (прогресс, рейтинги),
+            # поэтому целиком замок шарда не держит - только на время каждого вызова базы
+            self._engine_writers = [
+                WriterThread(db, lock=contextlib.nullcontext(), name=f"engine-writer-{index}")
+                for index in range(len(shards))
+            ]
+        else:
+            self._shard_writers = []
+            self._engine_writers = [WriterThread(db, config.DB_GROUP_COMMIT_MS)]
+        self._writer = self._engine_writers[0]
+        for writer in self._shard_writers + self._engine_writers:
+            writer.start()
+        self._reader_pool = (
+            ThreadPoolExecutor(max_workers=reader_count, thread_name_prefix="db-reader")
+            if reader_count else None
+        )
+
+    async def run(self, fn, *args):
+        """Выполнить функцию в потоке-писателе (для операций GameEngine)"""
+        return await asyncio.wrap_future(self._writer.submit(fn, *args))
+
+    async def run_for(self, player_id, fn, *args):
+        """Выполнить операцию движка по игроку (в шардированной базе - параллельно с другими шардами)"""
+        if not self._shard_writers:
+            return await self.run(fn, *args)
+        writer = self._engine_writers[self.db.shard_of_player(player_id)]
+        return await asyncio.wrap_future(writer.submit(fn, *args))
+
+    async def write(self, method, *args):
+        """Вызвать метод GameDatabase в потоке-писателе"""
+        if self._shard_writers:
+            index = self.db.shard_index(method, args)
+            if index is not None:
+                shard_method = getattr(self.db.shards[index], method)
+                return await asyncio.wrap_future(self._shard_writers[index].submit(shard_method, *args))
+        return await self.run(getattr(self.db, method), *args)
+
+    async def read(self, method, *args):
+        """Вызвать метод чтения на свободном соединении из пула"""
+        if self._reader_pool is None:
+            return await self.write(method, *args)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._reader_pool,
+            functools.partial(contextvars.copy_context().run, self._read_with_pooled_reader, method, *args)
+        )
+
+    def _read_with_pooled_reader(self, method, *args):
+        reader = self.readers.get()
+        try:
+            return getattr(reader, method)(*args)
+        finally:
+            self.readers.put(reader)
+
+    def __getattr__(self, name):
+        # dao.get_player(...) и т.п. - те же имена, что у GameDatabase, но awaitable
+        if name.startswith("_") or not callable(getattr(self.db, name, None)):
+            raise AttributeError(name)
+        if name in READ_METHODS:
+            return functools.partial(self.read, name)
+        return functools.partial(self.write, name)
+
+    def close(self):
+        """Дождаться выполнения операций и закрыть соединения читателей"""
+        for writer in self._shard_writers + self._engine_writers:
+            writer.stop()
+        if self._reader_pool:
+            self._reader_pool.shutdown(wait=True)
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+
+# Глобальный экземпляр DAO
+dao = AsyncGameDAO(database)
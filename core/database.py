@@ -1,235 +1,214 @@
 import sqlite3
 import json
+import os
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import logging
+import config
+from core.identity_map import current_identity_map
+from core.memory_storage import InMemoryGameStorage
+from core.migrations import apply_migrations, get_schema_version
+from core.queries import (
+    ACHIEVEMENT_COMPLETE_SQL, ACHIEVEMENT_PROGRESS_SQL, ACTIVE_QUESTS_SQL, BATTLE_REPLAYS_SQL,
+    BETTER_SCORES_GLOBAL_SQL, BETTER_SCORES_SONG_SQL, COMPACT_HISTORY_SQL, COMPLETED_QUESTS_SQL,
+    EXPIRE_QUESTS_SQL, INVENTORY_SQL, LEADERBOARD_RANK_GLOBAL_SQL, LEADERBOARD_RANK_SONG_SQL,
+    LEADERBOARD_TOP_GLOBAL_SQL, LEADERBOARD_TOP_SONG_SQL, PLAYER_ACHIEVEMENTS_SQL, PLAYER_BY_TELEGRAM_ID_SQL,
+    PLAYER_DASHBOARD_SQL, QUEST_EXISTS_SQL, QUEST_PROGRESS_SQL, RECENTLY_ACTIVE_SQL, SONG_STATS_SQL,
+    SPEND_ENERGY_SQL, STATS_BY_PLAYER_SQL, STORY_BY_PLAYER_SQL
+)
+from core.snapshots import SnapshotManager
+from core.storage import GameStorage, STARTER_ITEMS, level_after_exp
+from core.story_state import chapter_mask, flag_mask, story_state
 
 logger = logging.getLogger(__name__)
 
-class GameDatabase:
-    def __init__(self):
-        # ИСПОЛЬЗУЕМ ПАМЯТЬ вместо файла для хостинга
-        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+MEMORY_PATH = ':memory:'
+
+class GameDatabase(GameStorage):
+    def __init__(self, db_path=MEMORY_PATH, read_only=False, shard=None):
+        # ':memory:' остается для тестов, на хостинге используем файл в режиме WAL
+        self.db_path = db_path
+        self.in_memory = db_path == MEMORY_PATH
+        self.read_only = read_only
+        # (номер, число шардов): id игроков этого файла дают номер по модулю числа шардов
+        self.shard = shard
+        self._tx_depth = 0
+        # Держится на время каждой операции писателя, снимки делают шаги между ними
+        self.write_lock = threading.RLock()
+        
+        self._checkpoint_stop = threading.Event()
+        self._checkpoint_thread = None
+        
+        if read_only:
+            # Соединение-читатель для пула: схему не трогаем, чекпоинты не запускаем
+            self.conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.configure_connection(self.conn)
+            return
+        
+        if not self.in_memory:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
-        self.create_tables()
-        self.create_default_achievements()
-       
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        # Игроки
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS players (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE NOT NULL,
-                username TEXT,
-                character_name TEXT NOT NULL,
-                level INTEGER DEFAULT 1,
-                exp INTEGER DEFAULT 0,
-                health INTEGER DEFAULT 100,
-                max_health INTEGER DEFAULT 100,
-                rhythm INTEGER DEFAULT 50,
-                charisma INTEGER DEFAULT 30,
-                strength INTEGER DEFAULT 40,
-                money INTEGER DEFAULT 100,
-                energy INTEGER DEFAULT 100,
-                max_energy INTEGER DEFAULT 100,
-                last_energy_update DATETIME DEFAULT CURRENT_TIMESTAMP,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_active DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Инвентарь
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS inventory (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                player_id INTEGER NOT NULL,
-                item_id TEXT NOT NULL,
-                item_name TEXT NOT NULL,
-                quantity INTEGER DEFAULT 1,
-                FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Прогресс сюжета
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS story_progress (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                player_id INTEGER UNIQUE NOT NULL,
-                chapter INTEGER DEFAULT 1,
-                completed_chapters TEXT DEFAULT '[]',
-                current_quest TEXT,
-                story_flags TEXT DEFAULT '{}',
-                pico_relationship INTEGER DEFAULT 0,
-                boyfriend_relationship INTEGER DEFAULT 0,
-                FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-            )
-        ''')
+        self.configure_connection(self.conn)
         
-        # Активные квесты
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS active_quests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                player_id INTEGER NOT NULL,
-                quest_id TEXT NOT NULL,
-                quest_type TEXT NOT NULL,
-                progress INTEGER DEFAULT 0,
-                target INTEGER NOT NULL,
-                started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                expires_at DATETIME,
-                FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Завершенные квесты
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS completed_quests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                player_id INTEGER NOT NULL,
-                quest_id TEXT NOT NULL,
-                completed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                reward_claimed BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Достижения
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS achievements (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                player_id INTEGER NOT NULL,
-                achievement_id TEXT NOT NULL,
-                achievement_name TEXT NOT NULL,
-                progress INTEGER DEFAULT 0,
-                target INTEGER NOT NULL,
-                completed BOOLEAN DEFAULT FALSE,
-                completed_at DATETIME,
-                reward_claimed BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Ежедневные задания
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS daily_quests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                player_id INTEGER NOT NULL,
-                quest_type TEXT NOT NULL,
-                progress INTEGER DEFAULT 0,
-                target INTEGER NOT NULL,
-                completed BOOLEAN DEFAULT FALSE,
-                date DATE NOT NULL,
-                reward_claimed BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Статистика
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS player_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                player_id INTEGER UNIQUE NOT NULL,
-                total_battles INTEGER DEFAULT 0,
-                battles_won INTEGER DEFAULT 0,
-                perfect_scores INTEGER DEFAULT 0,
-                max_combo INTEGER DEFAULT 0,
-                quests_completed INTEGER DEFAULT 0,
-                daily_quests_completed INTEGER DEFAULT 0,
-                achievements_completed INTEGER DEFAULT 0,
-                total_play_time INTEGER DEFAULT 0,
-                money_earned INTEGER DEFAULT 0,
-                money_spent INTEGER DEFAULT 0,
-                last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Баттлы
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS battle_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                player_id INTEGER NOT NULL,
-                song_id TEXT NOT NULL,
-                score INTEGER NOT NULL,
-                max_combo INTEGER DEFAULT 0,
-                perfect_hits INTEGER DEFAULT 0,
-                good_hits INTEGER DEFAULT 0,
-                bad_hits INTEGER DEFAULT 0,
-                missed INTEGER DEFAULT 0,
-                completed BOOLEAN DEFAULT FALSE,
-                battle_duration INTEGER DEFAULT 0,
-                played_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        self.conn.commit()
-        logger.info("Все таблицы созданы успешно!")
-    
-    def create_default_achievements(self):
-        """Создать достижения по умолчанию для всех игроков"""
-        default_achievements = [
-            # Story achievements
-            {"id": "first_blood", "name": "Первая кровь", "target": 1},
-            {"id": "pico_friend", "name": "Друг Пико", "target": 50},
-            {"id": "story_master", "name": "Мастер истории", "target": 4},
-            
-            # Battle achievements  
-            {"id": "perfectionist", "name": "Перфекционист", "target": 50},
-            {"id": "combo_master", "name": "Мастер комбо", "target": 100},
-            {"id": "boss_slayer", "name": "Убийца боссов", "target": 5},
-            
-            # Collection achievements
-            {"id": "note_collector", "name": "Коллекционер нот", "target": 1000},
-            {"id": "rich_player", "name": "Богатый игрок", "target": 10000},
-            
-            # Social achievements
-            {"id": "popular", "name": "Популярный", "target": 20},
-            {"id": "legendary", "name": "Легендарный", "target": 50}
-        ]
-        
-        cursor = self.conn.cursor()
-        
-        # Получаем всех игроков
-        cursor.execute("SELECT id FROM players")
-        players = cursor.fetchall()
+        if self.has_schema():
+            logger.info(f"Открыта существующая база {db_path}")
+        self.create_tables()
         
-        for player in players:
-            player_id = player[0]
-            for achievement in default_achievements:
-                # Проверяем, есть ли уже это достижение
-                cursor.execute(
-                    "SELECT id FROM achievements WHERE player_id = ? AND achievement_id = ?",
-                    (player_id, achievement["id"])
-                )
-                if not cursor.fetchone():
-                    cursor.execute(
-                        "INSERT INTO achievements (player_id, achievement_id, achievement_name, target) VALUES (?, ?, ?, ?)",
-                        (player_id, achievement["id"], achievement["name"], achievement["target"])
-                    )
+        if not self.in_memory:
+            self.start_checkpointer()
+    
+    def configure_connection(self, conn):
+        """Настроить PRAGMA соединения под режим хранения"""
+        conn.execute(f"PRAGMA cache_size = -{config.DB_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        
+        if self.read_only:
+            conn.execute(f"PRAGMA mmap_size = {config.DB_MMAP_SIZE}")
+            conn.execute("PRAGMA busy_timeout = 5000")
+        elif not self.in_memory:
+            conn.execute("PRAGMA journal_mode = WAL")
+            # В WAL режиме NORMAL не теряет целостность, только последние коммиты при сбое ОС
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(f"PRAGMA mmap_size = {config.DB_MMAP_SIZE}")
+            conn.execute("PRAGMA busy_timeout = 5000")
+    
+    def has_schema(self):
+        """Проверить, что таблицы уже созданы (база открыта повторно)"""
+        cursor = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'players'"
+        )
+        return cursor.fetchone() is not None
+    
+    def start_checkpointer(self, interval=None):
+        """Запустить фоновые PASSIVE чекпоинты WAL"""
+        interval = interval or config.DB_CHECKPOINT_SECONDS
+        self._checkpoint_thread = threading.Thread(
+            target=self._checkpoint_loop, args=(interval,), name="wal-checkpoint", daemon=True
+        )
+        self._checkpoint_thread.start()
+    
+    def _checkpoint_loop(self, interval):
+        # Отдельное соединение, чтобы не делить основное между потоками
+        conn = sqlite3.connect(self.db_path)
+        try:
+            while not self._checkpoint_stop.wait(interval):
+                busy, log_pages, checkpointed = conn.execute(
+                    "PRAGMA wal_checkpoint(PASSIVE)"
+                ).fetchone()
+                logger.debug(f"WAL чекпоинт: busy={busy}, log={log_pages}, checkpointed={checkpointed}")
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка фонового чекпоинта: {e}")
+        finally:
+            conn.close()
+    
+    def checkpoint(self, mode="PASSIVE"):
+        """Выполнить чекпоинт WAL (PASSIVE, FULL, RESTART или TRUNCATE)"""
+        if self.in_memory or self.read_only:
+            return None
+        if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+            raise ValueError(f"Неизвестный режим чекпоинта: {mode}")
+        return tuple(self.conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+    
+    def open_reader(self):
+        """Отдельное соединение только на чтение к той же базе (для пула читателей)"""
+        return GameDatabase(self.db_path, read_only=True, shard=self.shard)
+    
+    @contextmanager
+    def transaction(self, player_id=None):
+        """Единица работы: все записи внутри блока фиксируются одним коммитом
+
+        Вложенные блоки становятся SAVEPOINT и откатываются независимо от внешнего.
+        player_id нужен только шардированному хранилищу, чтобы выбрать файл.
+        """
+        depth = self._tx_depth
+        if depth == 0:
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+        else:
+            self.conn.execute(f"SAVEPOINT tx_{depth}")
+        
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth -= 1
+            if depth == 0:
+                self.conn.rollback()
+            else:
+                self.conn.execute(f"ROLLBACK TO tx_{depth}")
+                self.conn.execute(f"RELEASE tx_{depth}")
+            raise
+        
+        self._tx_depth -= 1
+        if depth == 0:
+            self.conn.commit()
+        else:
+            self.conn.execute(f"RELEASE tx_{depth}")
+    
+    def _commit(self):
+        # Внутри transaction() коммит откладывается до конца единицы работы
+        if self._tx_depth == 0:
+            self.conn.commit()
+    
+    def restore(self, path):
+        """Заменить содержимое базы копией из файла (снимка) и догнать схему"""
+        source = sqlite3.connect(path)
+        try:
+            source.backup(self.conn)
+        finally:
+            source.close()
+        self.create_tables()
+    
+    def close(self):
+        """Остановить чекпоинты и закрыть соединение"""
+        if self._checkpoint_thread:
+            self._checkpoint_stop.set()
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+        self.checkpoint("TRUNCATE")
+        self.conn.close()
         
-        self.conn.commit()
+    def create_tables(self):
+        """Создать или обновить схему через версионированные миграции"""
+        applied = apply_migrations(self.conn)
+        if applied:
+            logger.info(f"Применено миграций: {applied}, версия схемы {get_schema_version(self.conn)}")
     
     def get_player(self, telegram_id):
         """Получить игрока по telegram_id"""
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            cached = identity_map.get(telegram_id)
+            if cached is not None:
+                return cached
+        
         cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM players WHERE telegram_id = ?", (telegram_id,))
+        cursor.execute(PLAYER_BY_TELEGRAM_ID_SQL, (telegram_id,))
         player = cursor.fetchone()
         
         if player:
             # Получаем прогресс сюжета
-            cursor.execute("SELECT * FROM story_progress WHERE player_id = ?", (player["id"],))
+            cursor.execute(STORY_BY_PLAYER_SQL, (player["id"],))
             story = cursor.fetchone()
             
             # Получаем статистику
-            cursor.execute("SELECT * FROM player_stats WHERE player_id = ?", (player["id"],))
+            cursor.execute(STATS_BY_PLAYER_SQL, (player["id"],))
             stats = cursor.fetchone()
             
-            return {
+            player = {
                 **dict(player),
                 "story": dict(story) if story else None,
+                "story_state": story_state(story),
                 "stats": dict(stats) if stats else None
             }
+            player["energy"] = player.pop("current_energy")
+            if identity_map is not None:
+                identity_map.put(player)
+            return player
         return None
     
     def create_player(self, telegram_id, username, character_name):
@@ -237,46 +216,47 @@ class GameDatabase:
         cursor = self.conn.cursor()
         
         try:
-            # Создаем игрока
-            cursor.execute('''
-                INSERT INTO players (telegram_id, username, character_name) 
-                VALUES (?, ?, ?)
-            ''', (telegram_id, username, character_name))
-            
-            player_id = cursor.lastrowid
-            
-            # Создаем прогресс сюжета
-            cursor.execute('''
-                INSERT INTO story_progress (player_id) VALUES (?)
-            ''', (player_id,))
-            
-            # Создаем статистику
-            cursor.execute('''
-                INSERT INTO player_stats (player_id) VALUES (?)
-            ''', (player_id,))
-            
-            # Создаем достижения
-            self.create_default_achievements()
-            
-            # Даем стартовые предметы
-            starter_items = [
-                ("health_potion", "Зелье здоровья", 3),
-                ("energy_drink", "Энергетик", 2),
-                ("guitar_pick", "Медиатор", 1)
-            ]
-            
-            for item_id, item_name, quantity in starter_items:
+            with self.transaction():
+                # Создаем игрока
+                if self.shard is None:
+                    cursor.execute('''
+                        INSERT INTO players (telegram_id, username, character_name) 
+                        VALUES (?, ?, ?)
+                    ''', (telegram_id, username, character_name))
+                else:
+                    # id с шагом в число шардов, чтобы по id сразу находить файл игрока
+                    index, count = self.shard
+                    cursor.execute('''
+                        INSERT INTO players (id, telegram_id, username, character_name) 
+                        VALUES ((SELECT IFNULL(MAX(id), ?) + ? FROM players), ?, ?, ?)
+                    ''', (index, count, telegram_id, username, character_name))
+                
+                player_id = cursor.lastrowid
+                
+                # Создаем прогресс сюжета
                 cursor.execute('''
-                    INSERT INTO inventory (player_id, item_id, item_name, quantity)
-                    VALUES (?, ?, ?, ?)
-                ''', (player_id, item_id, item_name, quantity))
-            
-            self.conn.commit()
-            return self.get_player(telegram_id)
+                    INSERT INTO story_progress (player_id) VALUES (?)
+                ''', (player_id,))
+                
+                # Создаем статистику
+                cursor.execute('''
+                    INSERT INTO player_stats (player_id) VALUES (?)
+                ''', (player_id,))
+                
+                # Достижения создаются лениво при первом прогрессе (см. update_achievement_progress)
+                
+                # Даем стартовые предметы
+                for item_id, item_name, quantity in STARTER_ITEMS:
+                    cursor.execute('''
+                        INSERT INTO inventory (player_id, item_id, item_name, quantity)
+                        VALUES (?, ?, ?, ?)
+                    ''', (player_id, item_id, item_name, quantity))
             
         except sqlite3.IntegrityError:
             logger.warning(f"Игрок с telegram_id {telegram_id} уже существует")
             return None
+        
+        return self.get_player(telegram_id)
     
     def update_energy(self, player_id, new_energy):
         """Обновить энергию игрока"""
@@ -285,7 +265,20 @@ class GameDatabase:
             "UPDATE players SET energy = ?, last_energy_update = CURRENT_TIMESTAMP WHERE id = ?",
             (new_energy, player_id)
         )
-        self.conn.commit()
+        self._invalidate(player_id)
+        self._commit()
+    
+    def spend_energy(self, player_id, amount):
+        """Списать энергию, только если ее хватает с учетом восстановления"""
+        if amount <= 0:
+            return True
+        
+        cursor = self.conn.cursor()
+        cursor.execute(SPEND_ENERGY_SQL, {"amount": amount, "player_id": player_id})
+        
+        self._invalidate(player_id)
+        self._commit()
+        return cursor.rowcount == 1
     
     def add_experience(self, player_id, exp_amount):
         """Добавить опыт игроку"""
@@ -294,7 +287,8 @@ class GameDatabase:
             "UPDATE players SET exp = exp + ? WHERE id = ?",
             (exp_amount, player_id)
         )
-        self.conn.commit()
+        self._invalidate(player_id)
+        self._commit()
         
         # Проверяем повышение уровня
         self.check_level_up(player_id)
@@ -307,18 +301,16 @@ class GameDatabase:
         
         if player:
             current_level = player["level"]
-            current_exp = player["exp"]
-            
-            # Формула для следующего уровня: level^2 * 100
-            exp_needed = (current_level ** 2) * 100
+            new_level = level_after_exp(current_level, player["exp"])
             
-            if current_exp >= exp_needed:
-                new_level = current_level + 1
+            if new_level > current_level:
+                levels = new_level - current_level
                 cursor.execute(
-                    "UPDATE players SET level = ?, max_health = max_health + 10, max_energy = max_energy + 5 WHERE id = ?",
-                    (new_level, player_id)
+                    "UPDATE players SET level = ?, max_health = max_health + ?, max_energy = max_energy + ? WHERE id = ?",
+                    (new_level, 10 * levels, 5 * levels, player_id)
                 )
-                self.conn.commit()
+                self._invalidate(player_id)
+                self._commit()
                 return new_level
         
         return None
@@ -338,7 +330,8 @@ class GameDatabase:
                 (amount, player_id)
             )
         
-        self.conn.commit()
+        self._invalidate(player_id)
+        self._commit()
     
     def update_relationship(self, player_id, character, amount):
         """Обновить отношения с персонажем"""
@@ -355,17 +348,46 @@ class GameDatabase:
                 (amount, player_id)
             )
         
-        self.conn.commit()
+        self._invalidate(player_id)
+        self._commit()
+    
+    def touch_activity(self, player_id):
+        """Отметить игрока активным сейчас"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE player_stats SET last_activity = CURRENT_TIMESTAMP WHERE player_id = ?",
+            (player_id,)
+        )
+        self._commit()
+    
+    def set_story_flag(self, player_id, flag):
+        """Поставить флаг сюжета, True если его еще не было"""
+        return self._set_story_bit(player_id, "flag_bits", flag_mask(flag))
+    
+    def complete_chapter(self, player_id, chapter):
+        """Отметить главу пройденной, True если она пройдена впервые"""
+        return self._set_story_bit(player_id, "chapter_bits", chapter_mask(chapter))
+    
+    def _set_story_bit(self, player_id, column, mask):
+        # Одна битовая операция в UPDATE, условие отсекает уже поставленный бит
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f"UPDATE story_progress SET {column} = {column} | ? WHERE player_id = ? AND {column} & ? = 0",
+            (mask, player_id, mask)
+        )
+        changed = cursor.rowcount > 0
+        
+        if changed:
+            self._invalidate(player_id)
+        self._commit()
+        return changed
     
     def add_quest(self, player_id, quest_id, quest_type, target):
         """Добавить квест игроку"""
         cursor = self.conn.cursor()
         
         # Проверяем, нет ли уже такого квеста
-        cursor.execute(
-            "SELECT id FROM active_quests WHERE player_id = ? AND quest_id = ?",
-            (player_id, quest_id)
-        )
+        cursor.execute(QUEST_EXISTS_SQL, (player_id, quest_id))
         
         if not cursor.fetchone():
             cursor.execute('''
@@ -373,18 +395,40 @@ class GameDatabase:
                 VALUES (?, ?, ?, ?)
             ''', (player_id, quest_id, quest_type, target))
             
-            self.conn.commit()
+            self._commit()
             return True
         return False
     
+    def add_quests_bulk(self, rows):
+        """Добавить квесты пачкой [(player_id, quest_id, quest_type, target, expires_at)]
+
+        Уже выданные квесты пропускаются по уникальному индексу, возвращает число новых.
+        """
+        cursor = self.conn.cursor()
+        cursor.executemany('''
+            INSERT OR IGNORE INTO active_quests (player_id, quest_id, quest_type, target, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+        self._commit()
+        return cursor.rowcount
+    
+    def expire_quests(self, now, batch_size):
+        """Удалить порцию квестов с истекшим expires_at, возвращает число удаленных"""
+        cursor = self.conn.cursor()
+        cursor.execute(EXPIRE_QUESTS_SQL, (now, batch_size))
+        self._commit()
+        return cursor.rowcount
+    
+    def get_recently_active_player_ids(self, days):
+        """id игроков, активных за последние days дней"""
+        cursor = self.conn.cursor()
+        cursor.execute(RECENTLY_ACTIVE_SQL, (f"-{days} days",))
+        return [row[0] for row in cursor.fetchall()]
+    
     def update_quest_progress(self, player_id, quest_type, amount=1):
         """Обновить прогресс квеста"""
         cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE active_quests 
-            SET progress = progress + ? 
-            WHERE player_id = ? AND quest_type = ? AND completed = FALSE
-        ''', (amount, player_id, quest_type))
+        cursor.execute(QUEST_PROGRESS_SQL, (amount, player_id, quest_type))
         
         # Проверяем завершение квеста
         cursor.execute('''
@@ -393,7 +437,7 @@ class GameDatabase:
             WHERE player_id = ? AND quest_type = ? AND progress >= target AND completed = FALSE
         ''', (player_id, quest_type))
         
-        self.conn.commit()
+        self._commit()
         
         # Возвращаем количество завершенных квестов
         cursor.execute('''
@@ -406,20 +450,14 @@ class GameDatabase:
     def update_achievement_progress(self, player_id, achievement_id, amount=1):
         """Обновить прогресс достижения"""
         cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE achievements 
-            SET progress = progress + ? 
-            WHERE player_id = ? AND achievement_id = ? AND completed = FALSE
-        ''', (amount, player_id, achievement_id))
-        
-        # Проверяем завершение достижения
-        cursor.execute('''
-            UPDATE achievements 
-            SET completed = TRUE, completed_at = CURRENT_TIMESTAMP 
-            WHERE player_id = ? AND achievement_id = ? AND progress >= target AND completed = FALSE
-        ''', (player_id, achievement_id))
         
-        self.conn.commit()
+        if amount:
+            cursor.execute(ACHIEVEMENT_PROGRESS_SQL, (player_id, amount, achievement_id))
+            
+            # Проверяем завершение достижения
+            cursor.execute(ACHIEVEMENT_COMPLETE_SQL, (player_id, achievement_id))
+            
+            self._commit()
         
         cursor.execute('''
             SELECT completed FROM achievements 
@@ -454,40 +492,333 @@ class GameDatabase:
                 UPDATE player_stats SET perfect_scores = perfect_scores + 1 WHERE player_id = ?
             ''', (player_id,))
         
-        self.conn.commit()
-        return cursor.lastrowid
+        battle_id = cursor.lastrowid
+        self._update_song_stats(cursor, player_id, song_id, score, max_combo, perfect_hits + good_hits + bad_hits)
+        
+        self._invalidate(player_id)
+        self._commit()
+        return battle_id
 
-    def get_player_achievements(self, player_id):
-        """Получить достижения игрока"""
+    def grant_rewards(self, player_id, exp, money):
+        """Начислить опыт и деньги с повышением уровня (сразу на несколько) одним UPDATE"""
         cursor = self.conn.cursor()
+        
+        with self.transaction():
+            cursor.execute("SELECT level, exp FROM players WHERE id = ?", (player_id,))
+            player = cursor.fetchone()
+            new_level = level_after_exp(player["level"], player["exp"] + exp)
+            levels = new_level - player["level"]
+            cursor.execute('''
+                UPDATE players 
+                SET exp = exp + ?, money = money + ?, level = ?,
+                    max_health = max_health + ?, max_energy = max_energy + ?
+                WHERE id = ?
+            ''', (exp, money, new_level, 10 * levels, 5 * levels, player_id))
+            
+            if money > 0:
+                cursor.execute(
+                    "UPDATE player_stats SET money_earned = money_earned + ? WHERE player_id = ?",
+                    (money, player_id)
+                )
+            self._invalidate(player_id)
+        
+        return {
+            "level_up": new_level if levels else None,
+            "levels_gained": levels
+        }
+    
+    def settle_battle(self, player_id, battle, exp, money):
+        """Рассчитать итог битвы одной транзакцией
+
+        battle - поля для battle_history, exp/money - готовые награды. Возвращает
+        результат grant_rewards и лучшие результаты игрока для обновления рейтингов.
+        """
+        cursor = self.conn.cursor()
+        
+        with self.transaction():
+            cursor.execute('''
+                INSERT INTO battle_history 
+                (player_id, song_id, score, max_combo, perfect_hits, good_hits, bad_hits, missed, battle_duration, completed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, TRUE)
+            ''', (
+                player_id, battle['song_id'], battle['score'], battle['max_combo'], battle['perfect_hits'],
+                battle['good_hits'], battle['bad_hits'], battle['missed'], battle['battle_duration']
+            ))
+            if battle.get('replay') is not None:
+                cursor.execute('''
+                    INSERT INTO battle_replays (player_id, song_id, score, max_combo, replay)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (player_id, battle['song_id'], battle['score'], battle['max_combo'], battle['replay']))
+            
+            cursor.execute('''
+                UPDATE player_stats 
+                SET total_battles = total_battles + 1,
+                    battles_won = battles_won + 1,
+                    perfect_scores = perfect_scores + ?,
+                    max_combo = MAX(max_combo, ?),
+                    last_activity = CURRENT_TIMESTAMP
+                WHERE player_id = ?
+            ''', (1 if battle['perfect_hits'] >= 10 else 0, battle['max_combo'], player_id))
+            
+            granted = self.grant_rewards(player_id, exp, money)
+            
+            best_score, best_score_total = self._update_song_stats(
+                cursor, player_id, battle['song_id'], battle['score'], battle['max_combo'],
+                battle['perfect_hits'] + battle['good_hits'] + battle['bad_hits']
+            )
+            self._invalidate(player_id)
+        
+        return {
+            **granted,
+            "best_score": best_score,
+            "best_score_total": best_score_total
+        }
+    
+    def _update_song_stats(self, cursor, player_id, song_id, score, max_combo, hits):
+        # Агрегаты ведутся инкрементально, сырые записи истории можно удалять
+        cursor.execute('''
+            INSERT INTO song_stats (player_id, song_id, best_score, best_combo, play_count, total_hits)
+            VALUES (?, ?, ?, ?, 1, ?)
+            ON CONFLICT(player_id, song_id) DO UPDATE
+            SET best_score = MAX(best_score, excluded.best_score),
+                best_combo = MAX(best_combo, excluded.best_combo),
+                play_count = play_count + 1,
+                total_hits = total_hits + excluded.total_hits
+            RETURNING best_score
+        ''', (player_id, song_id, score, max_combo, hits))
+        best_score = cursor.fetchone()[0]
+        
+        # Сумма лучших результатов - ключ глобального рейтинга (не больше строки на песню)
         cursor.execute('''
-            SELECT * FROM achievements WHERE player_id = ? ORDER BY completed DESC, progress DESC
-        ''', (player_id,))
+            UPDATE player_stats 
+            SET best_score_total = (SELECT SUM(best_score) FROM song_stats WHERE player_id = ?)
+            WHERE player_id = ?
+            RETURNING best_score_total
+        ''', (player_id, player_id))
+        row = cursor.fetchone()
+        return best_score, row[0] if row else 0
+    
+    def get_song_stats(self, player_id):
+        """Лучшие результаты игрока по песням"""
+        cursor = self.conn.cursor()
+        cursor.execute(SONG_STATS_SQL, (player_id,))
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def get_leaderboard_top(self, song_id, limit):
+        """Лучшие результаты по песне (song_id=None - глобальный рейтинг)"""
+        cursor = self.conn.cursor()
+        if song_id is None:
+            cursor.execute(LEADERBOARD_TOP_GLOBAL_SQL, (limit,))
+        else:
+            cursor.execute(LEADERBOARD_TOP_SONG_SQL, (song_id, limit))
+        return [(row["player_id"], row["score"]) for row in cursor.fetchall()]
+    
+    def get_leaderboard_rank(self, player_id, song_id=None):
+        """Результат и место игрока по индексированному подсчету, None если не играл"""
+        cursor = self.conn.cursor()
+        if song_id is None:
+            cursor.execute(LEADERBOARD_RANK_GLOBAL_SQL, (player_id,))
+        else:
+            cursor.execute(LEADERBOARD_RANK_SONG_SQL, (player_id, song_id))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    def count_better_scores(self, score, song_id=None):
+        """Сколько игроков имеют результат выше score (для места в рейтинге)"""
+        cursor = self.conn.cursor()
+        if song_id is None:
+            cursor.execute(BETTER_SCORES_GLOBAL_SQL, (score,))
+        else:
+            cursor.execute(BETTER_SCORES_SONG_SQL, (song_id, score))
+        return cursor.fetchone()[0]
+    
+    def get_player_names(self, player_ids):
+        """Имена персонажей по id игроков"""
+        if not player_ids:
+            return {}
+        cursor = self.conn.cursor()
+        placeholders = ", ".join("?" * len(player_ids))
+        cursor.execute(
+            f"SELECT id, character_name FROM players WHERE id IN ({placeholders})",
+            list(player_ids)
+        )
+        return {row["id"]: row["character_name"] for row in cursor.fetchall()}
+    
+    def compact_battle_history(self, older_than_days, batch_size):
+        """Удалить одну порцию записей истории старше срока хранения
+
+        Итоги этих битв уже учтены в song_stats, поэтому удаление ничего не теряет.
+        Возвращает число удаленных строк; вызывать, пока не вернет меньше batch_size.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(COMPACT_HISTORY_SQL, (f"-{older_than_days} days", batch_size))
+        self._commit()
+        return cursor.rowcount
+    
+    def get_battle_replays(self, after, limit):
+        """[(курсор, song_id, replay, score, max_combo)] повторов по порядку id, курсор - id повтора"""
+        cursor = self.conn.cursor()
+        cursor.execute(BATTLE_REPLAYS_SQL, (after or 0, limit))
+        return [tuple(row) for row in cursor.fetchall()]
+    
+    def save_battles(self, rows):
+        """Сохранить незавершенные битвы [(player_id, telegram_id, song_id, seed, state)]"""
+        cursor = self.conn.cursor()
+        cursor.executemany('''
+            INSERT INTO active_battles (player_id, telegram_id, song_id, seed, state)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(player_id) DO UPDATE SET
+                telegram_id = excluded.telegram_id, song_id = excluded.song_id,
+                seed = excluded.seed, state = excluded.state, updated_at = CURRENT_TIMESTAMP
+        ''', rows)
+        self._commit()
+        return len(rows)
+    
+    def delete_battles(self, player_ids):
+        """Удалить сохраненные битвы игроков (завершены, брошены или истекли)"""
+        cursor = self.conn.cursor()
+        cursor.executemany("DELETE FROM active_battles WHERE player_id = ?", [(player_id,) for player_id in player_ids])
+        self._commit()
+        return cursor.rowcount
+    
+    def load_battles(self):
+        """[(player_id, telegram_id, song_id, seed, state)] всех сохраненных битв"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT player_id, telegram_id, song_id, seed, state FROM active_battles")
+        return [tuple(row) for row in cursor.fetchall()]
+    
+    def apply_progress(self, achievements, quests):
+        """Применить накопленный прогресс {(player_id, id): прирост} одной транзакцией"""
+        cursor = self.conn.cursor()
+        with self.transaction():
+            self._apply_achievement_deltas(cursor, achievements)
+            self._apply_quest_deltas(cursor, quests)
+    
+    def _apply_achievement_deltas(self, cursor, deltas):
+        # Прирост сразу по нескольким достижениям, завершение проверяется одним UPDATE на игрока
+        rows = [
+            (player_id, amount, achievement_id)
+            for (player_id, achievement_id), amount in deltas.items() if amount
+        ]
+        if not rows:
+            return
+        cursor.executemany('''
+            INSERT INTO achievements (player_id, achievement_id, achievement_name, target, progress)
+            SELECT ?, achievement_id, achievement_name, target, ?
+            FROM achievement_definitions WHERE achievement_id = ?
+            ON CONFLICT(player_id, achievement_id) DO UPDATE
+            SET progress = progress + excluded.progress
+            WHERE completed = FALSE
+        ''', rows)
+        cursor.executemany('''
+            UPDATE achievements 
+            SET completed = TRUE, completed_at = CURRENT_TIMESTAMP 
+            WHERE player_id = ? AND completed = FALSE AND progress >= target
+        ''', [(player_id,) for player_id in {row[0] for row in rows}])
+    
+    def _apply_quest_deltas(self, cursor, deltas):
+        rows = [
+            (amount, player_id, quest_type)
+            for (player_id, quest_type), amount in deltas.items() if amount
+        ]
+        if not rows:
+            return
+        cursor.executemany('''
+            UPDATE active_quests 
+            SET progress = progress + ? 
+            WHERE player_id = ? AND quest_type = ? AND completed = FALSE
+        ''', rows)
+        cursor.executemany('''
+            UPDATE active_quests 
+            SET completed = TRUE 
+            WHERE player_id = ? AND completed = FALSE AND progress >= target
+        ''', [(player_id,) for player_id in {row[1] for row in rows}])
+    
+    def get_achievement_targets(self):
+        """Цели достижений из каталога {achievement_id: target}"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT achievement_id, target FROM achievement_definitions")
+        return {row["achievement_id"]: row["target"] for row in cursor.fetchall()}
+    
+    def get_achievement_state(self, player_id, achievement_id):
+        """(прогресс, завершено) достижения игрока, (0, False) если не начато"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT progress, completed FROM achievements WHERE player_id = ? AND achievement_id = ?
+        ''', (player_id, achievement_id))
+        row = cursor.fetchone()
+        return (row["progress"], bool(row["completed"])) if row else (0, False)
+    
+    def get_open_quests(self, player_id, quest_type):
+        """[(прогресс, цель)] незавершенных квестов игрока данного типа"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT progress, target FROM active_quests 
+            WHERE player_id = ? AND quest_type = ? AND completed = FALSE
+        ''', (player_id, quest_type))
+        return [(row["progress"], row["target"]) for row in cursor.fetchall()]
+    
+    def get_player_dashboard(self, player_id):
+        """Счетчики профиля игрока одним запросом"""
+        cursor = self.conn.cursor()
+        cursor.execute(PLAYER_DASHBOARD_SQL, {"player_id": player_id})
+        dashboard = dict(cursor.fetchone())
+        total = dashboard["achievements_total"]
+        dashboard["achievements_percentage"] = (
+            round(100.0 * dashboard["achievements_completed"] / total, 1) if total > 0 else 0
+        )
+        return dashboard
+    
+    def get_player_achievements(self, player_id, limit=None):
+        """Получить достижения игрока"""
+        cursor = self.conn.cursor()
+        cursor.execute(PLAYER_ACHIEVEMENTS_SQL, (player_id, -1 if limit is None else limit))
         return [dict(row) for row in cursor.fetchall()]
     
     def get_active_quests(self, player_id):
         """Получить активные квесты игрока"""
         cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT * FROM active_quests WHERE player_id = ? AND completed = FALSE
-        ''', (player_id,))
+        cursor.execute(ACTIVE_QUESTS_SQL, (player_id,))
         return [dict(row) for row in cursor.fetchall()]
     
     def get_completed_quests(self, player_id):
         """Получить завершенные квесты игрока"""
         cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT * FROM completed_quests WHERE player_id = ?
-        ''', (player_id,))
+        cursor.execute(COMPLETED_QUESTS_SQL, (player_id,))
         return [dict(row) for row in cursor.fetchall()]
     
     def get_inventory(self, player_id):
         """Получить инвентарь игрока"""
         cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT * FROM inventory WHERE player_id = ? AND quantity > 0 ORDER BY item_name
-        ''', (player_id,))
+        cursor.execute(INVENTORY_SQL, (player_id,))
         return [dict(row) for row in cursor.fetchall()]
 
-# Создаем глобальный экземпляр БД
-database = GameDatabase()
\ No newline at end of file
+def open_database():
+    """Открыть базу в режиме из config.DB_STORAGE"""
+    if config.DB_STORAGE == "memory":
+        # Без файла состояние живет в памяти, между запусками его переносят снимки
+        db = GameDatabase()
+        SnapshotManager(db).restore_latest()
+        return db
+    if config.DB_STORAGE == "python":
+        # Словари без SQLite и без сохранения - для проверок и бенчмарков
+        return InMemoryGameStorage()
+    if config.DB_SHARDS > 1:
+        # Импорт здесь: модуль шардирования сам строится на GameDatabase
+        from core.sharding import ShardedGameDatabase, shard_paths
+        return ShardedGameDatabase(shard_paths(config.DB_SHARDS, config.DB_SHARD_PATH))
+    return GameDatabase(config.DB_PATH)
+
+def __getattr__(name):
+    """Глобальные database и snapshots открываются при первом обращении
+
+    Их импортируют модули бота (from core.database import database). Инструменты,
+    которым нужен только класс GameDatabase, не открывают и не мигрируют базу из
+    config и не запускают поток контрольных точек.
+    """
+    if name not in ("database", "snapshots"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    db = open_database()
+    # Снимки базы в памяти (в режиме файла не нужны)
+    globals().update(database=db, snapshots=SnapshotManager(db))
+    return globals()[name]
\ No newline at end of file
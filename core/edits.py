@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from telegram.error import BadRequest, RetryAfter, TelegramError
+import config
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Общий лимит исходящих запросов: rate токенов в секунду, не больше burst про запас"""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+
+    def reserve(self):
+        """Взять токен, возвращает сколько секунд подождать перед запросом
+
+        Токены уходят в минус, поэтому одновременные ожидающие встают в очередь,
+        а не перехватывают один и тот же пополнившийся токен.
+        """
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class EditCoalescer:
+    """Правки сообщений с ограничением частоты и склейкой по чатам
+
+    Обработчик только кладет отрисовку в pending и сразу возвращается. На
+    каждый чат работает одна задача-отправщик: она шлет последнюю отрисовку
+    каждого сообщения не чаще min_interval и берет токен общего TokenBucket.
+    Остальные вызовы бота (query.answer, reply_text, send_message) мимо
+    TokenBucket идут напрямую, см. EDIT_GLOBAL_RATE в config.
+    Отрисовка, пришедшая, пока предыдущая ждет отправки, заменяет ее (merged),
+    а совпадающая с уже показанной не отправляется вовсе (dropped). При
+    RetryAfter чат ждет указанное Telegram время, отрисовка не теряется.
+    """
+
+    def __init__(
+        self,
+        bot,
+        min_interval=config.EDIT_MIN_INTERVAL_SECONDS,
+        rate=config.EDIT_GLOBAL_RATE,
+        burst=config.EDIT_GLOBAL_BURST,
+        clock=time.monotonic
+    ):
+        self.bot = bot
+        self.min_interval = min_interval
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.pending = {}  # {chat_id: {message_id: (text, kwargs)}}
+        self.shown = {}  # {chat_id: (message_id, (text, kwargs))} - последняя правка, пока жив отправщик чата
+        self.senders = {}  # {chat_id: asyncio.Task}
+        self.counters = {
+            "requested": 0,
+            "sent": 0,
+            "merged": 0,
+            "dropped": 0,
+            "retry_after": 0,
+            "failed": 0,
+        }
+
+    def edit(self, chat_id, message_id, text, **kwargs):
+        """Поставить правку в очередь чата (аргументы как у edit_message_text)"""
+        self.counters["requested"] += 1
+        render = (text, kwargs)
+        chat = self.pending.setdefault(chat_id, {})
+
+        if message_id in chat:
+            self.counters["merged"] += 1
+        elif self.shown.get(chat_id) == (message_id, render):
+            # Такой текст и разметка уже на экране
+            self.counters["dropped"] += 1
+            if not chat:
+                del self.pending[chat_id]
+            return
+        chat[message_id] = render
+
+        if chat_id not in self.senders:
+            self.senders[chat_id] = asyncio.get_running_loop().create_task(self._send_loop(chat_id))
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        """То же, что edit, в виде корутины - подходит как send в обработчиках бота"""
+        self.edit(chat_id, message_id, text, **kwargs)
+
+    def stats(self):
+        return {**self.counters, "pending": sum(map(len, self.pending.values())), "chats": len(self.senders)}
+
+    async def _send_loop(self, chat_id):
+        try:
+            while True:
+                chat = self.pending.get(chat_id)
+                if not chat:
+                    break
+
+                delay = self.bucket.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                # Пока ждали токен, отрисовка могла смениться - берем последнюю
+                message_id = next(iter(chat))
+                render = chat.pop(message_id)
+                if not chat:
+                    del self.pending[chat_id]
+                if self.shown.get(chat_id) == (message_id, render):
+                    self.counters["dropped"] += 1
+                    continue
+
+                # На экране считаем новую отрисовку уже на время запроса: иначе повтор
+                # прежней, пришедший во время запроса, был бы ошибочно отброшен
+                self.shown[chat_id] = (message_id, render)
+                delay = self.min_interval
+                try:
+                    await self.bot.edit_message_text(render[0], chat_id=chat_id, message_id=message_id, **render[1])
+                    self.counters["sent"] += 1
+                except RetryAfter as e:
+                    self.shown.pop(chat_id, None)
+                    # Вернем отрисовку, если за время запроса не пришла новее
+                    self.pending.setdefault(chat_id, {}).setdefault(message_id, render)
+                    retry_after = e.retry_after
+                    delay = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+                    self.counters["retry_after"] += 1
+                    logger.warning(f"RetryAfter для чата {chat_id}: ждем {delay} с")
+                except BadRequest as e:
+                    if "not modified" in str(e).lower():
+                        self.counters["dropped"] += 1
+                    else:
+                        self.shown.pop(chat_id, None)
+                        self.counters["failed"] += 1
+                        logger.error(f"Ошибка правки сообщения в чате {chat_id}: {e}")
+                except TelegramError as e:
+                    self.shown.pop(chat_id, None)
+                    self.counters["failed"] += 1
+                    logger.error(f"Ошибка правки сообщения в чате {chat_id}: {e}")
+
+                # Пауза держит частоту правок чата, новые отрисовки за это время склеиваются
+                await asyncio.sleep(delay)
+        finally:
+            # Чат без отправщика не держит память: повтор отрисовки после паузы
+            # просто уйдет в Telegram и вернется как "not modified"
+            del self.senders[chat_id]
+            self.shown.pop(chat_id, None)
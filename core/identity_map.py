@@ -0,0 +1,57 @@
+import contextvars
+import functools
+from contextlib import contextmanager
+
+# Карта игроков текущего Telegram-апдейта (None вне обработчика)
+_current_map = contextvars.ContextVar("player_identity_map", default=None)
+
+class PlayerIdentityMap:
+    """Кэш записей игроков на время обработки одного апдейта
+
+    Каждый игрок загружается из базы не более одного раза, любая запись
+    по игроку выбрасывает его из карты, поэтому следующее чтение свежее.
+    """
+
+    def __init__(self):
+        self.players = {}  # {telegram_id: player}
+        self.telegram_ids = {}  # {player_id: telegram_id}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id):
+        player = self.players.get(telegram_id)
+        if player is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return player
+
+    def put(self, player):
+        self.players[player['telegram_id']] = player
+        self.telegram_ids[player['id']] = player['telegram_id']
+
+    def invalidate(self, player_id):
+        telegram_id = self.telegram_ids.pop(player_id, None)
+        if telegram_id is not None:
+            self.players.pop(telegram_id, None)
+
+def current_identity_map():
+    """Карта текущего апдейта или None"""
+    return _current_map.get()
+
+@contextmanager
+def update_scope():
+    """Открыть карту игроков на время блока"""
+    token = _current_map.set(PlayerIdentityMap())
+    try:
+        yield _current_map.get()
+    finally:
+        _current_map.reset(token)
+
+def per_update(handler):
+    """Декоратор обработчика: одна карта игроков на апдейт"""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        with update_scope():
+            return await handler(*args, **kwargs)
+    return wrapper
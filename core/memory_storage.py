@@ -0,0 +1,593 @@
+import bisect
+import heapq
+import itertools
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from core.identity_map import current_identity_map
+from core.migrations import DEFAULT_ACHIEVEMENTS
+from core.storage import GameStorage, ENERGY_RECOVERY_SECONDS, STARTER_ITEMS, level_after_exp
+from core.story_state import chapter_mask, flag_mask, story_state
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def _timestamp(moment=None):
+    # Тот же формат, что у CURRENT_TIMESTAMP в SQLite (UTC)
+    return (moment or datetime.now(timezone.utc)).strftime(TIMESTAMP_FORMAT)
+
+def _epoch(timestamp):
+    return int(datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+
+class InMemoryGameStorage(GameStorage):
+    """Хранилище на словарях и явных индексах без SQLite
+
+    Строки таблиц - словари, индексы - словари по ключу поиска, отсортированные
+    списки (-счет, player_id) для рейтингов и куча по expires_at для ротации
+    квестов. Транзакции откатываются журналом отмены: каждая запись внутри
+    transaction() запоминает обратное действие. Данные не переживают перезапуск,
+    хранилище нужно для быстрых проверок движка и сравнения стратегий хранения.
+    """
+
+    def __init__(self):
+        self.in_memory = True
+        self.read_only = False
+        self.write_lock = threading.RLock()
+        self._undo = None  # журнал отмены открытой транзакции
+        self._ids = {}  # {таблица: счетчик id}
+
+        self.players = {}  # {id: строка}
+        self.player_ids = {}  # {telegram_id: id} - уникальный индекс
+        self.story = {}  # {player_id: строка}
+        self.stats = {}  # {player_id: строка}
+        self.inventory = {}  # {player_id: {item_id: строка}}
+        self.quests = {}  # {id: строка active_quests}
+        self.player_quests = {}  # {player_id: {quest_id: строка}} - уникальный индекс
+        self.quest_expiry = []  # куча (expires_at, id)
+        self.completed_quests = {}  # {player_id: [строка]}
+        self.achievements = {}  # {player_id: {achievement_id: строка}}
+        self.history = deque()  # battle_history в порядке played_at
+        self.replays = []  # battle_replays [(id, song_id, replay, score, max_combo)] по возрастанию id
+        self.song_stats = {}  # {player_id: {song_id: строка}}
+        self.song_scores = {}  # {song_id: [(-best_score, player_id)]} по возрастанию
+        self.total_scores = []  # [(-best_score_total, player_id)] игроков с результатом
+        self.battles = {}  # {player_id: (player_id, telegram_id, song_id, seed, state)}
+        self.definitions = {
+            achievement_id: {"achievement_id": achievement_id, "achievement_name": name, "target": target}
+            for achievement_id, name, target in DEFAULT_ACHIEVEMENTS
+        }
+
+    # Журнал отмены
+
+    def _next_id(self, table):
+        counter = self._ids.get(table)
+        if counter is None:
+            counter = self._ids[table] = itertools.count(1)
+        return next(counter)
+
+    def _log(self, fn, *args):
+        if self._undo is not None:
+            self._undo.append((fn, args))
+
+    def _set(self, row, key, value):
+        self._log(row.__setitem__, key, row[key])
+        row[key] = value
+
+    def _put(self, mapping, key, value):
+        if key in mapping:
+            self._log(mapping.__setitem__, key, mapping[key])
+        else:
+            self._log(mapping.pop, key)
+        mapping[key] = value
+
+    def _remove(self, mapping, key):
+        self._log(mapping.__setitem__, key, mapping[key])
+        del mapping[key]
+
+    def _index_insert(self, index, key):
+        bisect.insort(index, key)
+        self._log(self._index_discard, index, key)
+
+    def _index_remove(self, index, key):
+        self._index_discard(index, key)
+        self._log(bisect.insort, index, key)
+
+    @staticmethod
+    def _index_discard(index, key):
+        del index[bisect.bisect_left(index, key)]
+
+    @contextmanager
+    def transaction(self, player_id=None):
+        """Единица работы: при исключении все записи блока отменяются"""
+        outer = self._undo is None
+        if outer:
+            self._undo = []
+        mark = len(self._undo)
+        try:
+            yield self
+        except BaseException:
+            while len(self._undo) > mark:
+                fn, args = self._undo.pop()
+                fn(*args)
+            if outer:
+                self._undo = None
+            raise
+        if outer:
+            self._undo = None
+
+    def open_reader(self):
+        return self
+
+    # Игроки
+
+    def _current_energy(self, row, now):
+        gain = (now - _epoch(row["last_energy_update"])) // ENERGY_RECOVERY_SECONDS
+        return min(row["max_energy"], row["energy"] + gain), gain
+
+    def get_player(self, telegram_id):
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            cached = identity_map.get(telegram_id)
+            if cached is not None:
+                return cached
+
+        player_id = self.player_ids.get(telegram_id)
+        if player_id is None:
+            return None
+
+        row = self.players[player_id]
+        story = self.story.get(player_id)
+        stats = self.stats.get(player_id)
+        player = {
+            **row,
+            "story": dict(story) if story else None,
+            "story_state": story_state(story),
+            "stats": dict(stats) if stats else None
+        }
+        player["energy"] = self._current_energy(row, int(datetime.now(timezone.utc).timestamp()))[0]
+        if identity_map is not None:
+            identity_map.put(player)
+        return player
+
+    def create_player(self, telegram_id, username, character_name):
+        if telegram_id in self.player_ids:
+            logger.warning(f"Игрок с telegram_id {telegram_id} уже существует")
+            return None
+
+        now = _timestamp()
+        with self.transaction():
+            player_id = self._next_id("players")
+            self._put(self.players, player_id, {
+                "id": player_id, "telegram_id": telegram_id, "username": username,
+                "character_name": character_name, "level": 1, "exp": 0,
+                "health": 100, "max_health": 100, "rhythm": 50, "charisma": 30, "strength": 40,
+                "money": 100, "energy": 100, "max_energy": 100,
+                "last_energy_update": now, "created_at": now, "last_active": now
+            })
+            self._put(self.player_ids, telegram_id, player_id)
+            self._put(self.story, player_id, {
+                "id": self._next_id("story_progress"), "player_id": player_id, "chapter": 1,
+                "completed_chapters": "[]", "current_quest": None, "story_flags": "{}",
+                "pico_relationship": 0, "boyfriend_relationship": 0, "flag_bits": 0, "chapter_bits": 0
+            })
+            self._put(self.stats, player_id, {
+                "id": self._next_id("player_stats"), "player_id": player_id,
+                "total_battles": 0, "battles_won": 0, "perfect_scores": 0, "max_combo": 0,
+                "quests_completed": 0, "daily_quests_completed": 0, "achievements_completed": 0,
+                "total_play_time": 0, "money_earned": 0, "money_spent": 0,
+                "last_activity": now, "best_score_total": 0
+            })
+            items = {}
+            for item_id, item_name, quantity in STARTER_ITEMS:
+                items[item_id] = {
+                    "id": self._next_id("inventory"), "player_id": player_id,
+                    "item_id": item_id, "item_name": item_name, "quantity": quantity
+                }
+            self._put(self.inventory, player_id, items)
+
+        return self.get_player(telegram_id)
+
+    def update_energy(self, player_id, new_energy):
+        row = self.players[player_id]
+        self._set(row, "energy", new_energy)
+        self._set(row, "last_energy_update", _timestamp())
+        self._invalidate(player_id)
+
+    def spend_energy(self, player_id, amount):
+        if amount <= 0:
+            return True
+
+        row = self.players.get(player_id)
+        if row is None:
+            return False
+        now = int(datetime.now(timezone.utc).timestamp())
+        current, gain = self._current_energy(row, now)
+        if current < amount:
+            return False
+
+        # Восстановленные единицы фиксируются, остаток времени до следующей сохраняется
+        if row["energy"] + gain >= row["max_energy"]:
+            last_update = _timestamp()
+        else:
+            moment = datetime.strptime(row["last_energy_update"], TIMESTAMP_FORMAT)
+            last_update = _timestamp(moment + timedelta(seconds=gain * ENERGY_RECOVERY_SECONDS))
+        self._set(row, "energy", current - amount)
+        self._set(row, "last_energy_update", last_update)
+        self._invalidate(player_id)
+        return True
+
+    def add_experience(self, player_id, exp_amount):
+        row = self.players[player_id]
+        self._set(row, "exp", row["exp"] + exp_amount)
+        self._invalidate(player_id)
+        self.check_level_up(player_id)
+
+    def check_level_up(self, player_id):
+        row = self.players.get(player_id)
+        if row is None:
+            return None
+        new_level = level_after_exp(row["level"], row["exp"])
+        if new_level <= row["level"]:
+            return None
+        self._level_up(row, new_level)
+        self._invalidate(player_id)
+        return new_level
+
+    def _level_up(self, row, new_level):
+        levels = new_level - row["level"]
+        self._set(row, "level", new_level)
+        self._set(row, "max_health", row["max_health"] + 10 * levels)
+        self._set(row, "max_energy", row["max_energy"] + 5 * levels)
+
+    def add_money(self, player_id, amount):
+        row = self.players[player_id]
+        self._set(row, "money", row["money"] + amount)
+        if amount > 0:
+            stats = self.stats[player_id]
+            self._set(stats, "money_earned", stats["money_earned"] + amount)
+        self._invalidate(player_id)
+
+    def grant_rewards(self, player_id, exp, money):
+        with self.transaction():
+            row = self.players[player_id]
+            new_level = level_after_exp(row["level"], row["exp"] + exp)
+            levels = new_level - row["level"]
+            self._set(row, "exp", row["exp"] + exp)
+            self._set(row, "money", row["money"] + money)
+            self._level_up(row, new_level)
+            if money > 0:
+                stats = self.stats[player_id]
+                self._set(stats, "money_earned", stats["money_earned"] + money)
+            self._invalidate(player_id)
+
+        return {
+            "level_up": new_level if levels else None,
+            "levels_gained": levels
+        }
+
+    def update_relationship(self, player_id, character, amount):
+        column = {"pico": "pico_relationship", "boyfriend": "boyfriend_relationship"}.get(character)
+        story = self.story.get(player_id)
+        if column and story:
+            self._set(story, column, story[column] + amount)
+        self._invalidate(player_id)
+
+    def touch_activity(self, player_id):
+        stats = self.stats.get(player_id)
+        if stats:
+            self._set(stats, "last_activity", _timestamp())
+
+    def set_story_flag(self, player_id, flag):
+        return self._set_story_bit(player_id, "flag_bits", flag_mask(flag))
+
+    def complete_chapter(self, player_id, chapter):
+        return self._set_story_bit(player_id, "chapter_bits", chapter_mask(chapter))
+
+    def _set_story_bit(self, player_id, column, mask):
+        story = self.story.get(player_id)
+        if not story or story[column] & mask:
+            return False
+        self._set(story, column, story[column] | mask)
+        self._invalidate(player_id)
+        return True
+
+    # Квесты
+
+    def _insert_quest(self, player_id, quest_id, quest_type, target, expires_at):
+        player_quests = self.player_quests.setdefault(player_id, {})
+        if quest_id in player_quests:
+            return False
+        row = {
+            "id": self._next_id("active_quests"), "player_id": player_id, "quest_id": quest_id,
+            "quest_type": quest_type, "progress": 0, "target": target,
+            "started_at": _timestamp(), "expires_at": expires_at, "completed": 0
+        }
+        self._put(self.quests, row["id"], row)
+        self._put(player_quests, quest_id, row)
+        if expires_at is not None:
+            heapq.heappush(self.quest_expiry, (expires_at, row["id"]))
+        return True
+
+    def add_quest(self, player_id, quest_id, quest_type, target):
+        return self._insert_quest(player_id, quest_id, quest_type, target, None)
+
+    def add_quests_bulk(self, rows):
+        with self.transaction():
+            return sum(1 for row in rows if self._insert_quest(*row))
+
+    def expire_quests(self, now, batch_size):
+        removed = 0
+        while removed < batch_size and self.quest_expiry and self.quest_expiry[0][0] <= now:
+            expires_at, quest_row_id = heapq.heappop(self.quest_expiry)
+            self._log(heapq.heappush, self.quest_expiry, (expires_at, quest_row_id))
+            row = self.quests.get(quest_row_id)
+            # Записи кучи не удаляются вместе с квестом - пропускаем устаревшие
+            if row is None or row["expires_at"] != expires_at:
+                continue
+            self._remove(self.quests, quest_row_id)
+            self._remove(self.player_quests[row["player_id"]], row["quest_id"])
+            removed += 1
+        return removed
+
+    def get_recently_active_player_ids(self, days):
+        since = _timestamp(datetime.now(timezone.utc) - timedelta(days=days))
+        return [player_id for player_id, stats in self.stats.items() if stats["last_activity"] >= since]
+
+    def _advance_quests(self, player_id, quest_type, amount):
+        for row in self.player_quests.get(player_id, {}).values():
+            if row["quest_type"] == quest_type and not row["completed"]:
+                self._set(row, "progress", row["progress"] + amount)
+                if row["progress"] >= row["target"]:
+                    self._set(row, "completed", 1)
+
+    def update_quest_progress(self, player_id, quest_type, amount=1):
+        self._advance_quests(player_id, quest_type, amount)
+        return sum(
+            1 for row in self.player_quests.get(player_id, {}).values()
+            if row["quest_type"] == quest_type and row["completed"]
+        )
+
+    def get_open_quests(self, player_id, quest_type):
+        return [
+            (row["progress"], row["target"]) for row in self.player_quests.get(player_id, {}).values()
+            if row["quest_type"] == quest_type and not row["completed"]
+        ]
+
+    def get_active_quests(self, player_id):
+        return [dict(row) for row in self.player_quests.get(player_id, {}).values() if not row["completed"]]
+
+    def get_completed_quests(self, player_id):
+        return [dict(row) for row in self.completed_quests.get(player_id, [])]
+
+    # Достижения
+
+    def _add_achievement(self, player_id, achievement_id, amount):
+        definition = self.definitions.get(achievement_id)
+        if definition is None:
+            return
+        rows = self.achievements.setdefault(player_id, {})
+        row = rows.get(achievement_id)
+        if row is None:
+            # Строка прогресса создается из каталога при первом касании
+            row = {
+                "id": self._next_id("achievements"), "player_id": player_id,
+                "achievement_id": achievement_id, "achievement_name": definition["achievement_name"],
+                "progress": amount, "target": definition["target"], "completed": 0,
+                "completed_at": None, "reward_claimed": 0
+            }
+            self._put(rows, achievement_id, row)
+        elif not row["completed"]:
+            self._set(row, "progress", row["progress"] + amount)
+
+        if not row["completed"] and row["progress"] >= row["target"]:
+            self._set(row, "completed", 1)
+            self._set(row, "completed_at", _timestamp())
+
+    def update_achievement_progress(self, player_id, achievement_id, amount=1):
+        if amount:
+            self._add_achievement(player_id, achievement_id, amount)
+        row = self.achievements.get(player_id, {}).get(achievement_id)
+        return row["completed"] if row else False
+
+    def apply_progress(self, achievements, quests):
+        with self.transaction():
+            for (player_id, achievement_id), amount in achievements.items():
+                if amount:
+                    self._add_achievement(player_id, achievement_id, amount)
+            for (player_id, quest_type), amount in quests.items():
+                if amount:
+                    self._advance_quests(player_id, quest_type, amount)
+
+    def get_achievement_targets(self):
+        return {achievement_id: row["target"] for achievement_id, row in self.definitions.items()}
+
+    def get_achievement_state(self, player_id, achievement_id):
+        row = self.achievements.get(player_id, {}).get(achievement_id)
+        return (row["progress"], bool(row["completed"])) if row else (0, False)
+
+    def get_player_achievements(self, player_id, limit=None):
+        rows = self.achievements.get(player_id, {})
+        result = []
+        for achievement_id, definition in self.definitions.items():
+            row = rows.get(achievement_id)
+            result.append({
+                **definition,
+                "progress": row["progress"] if row else 0,
+                "completed": row["completed"] if row else 0,
+                "completed_at": row["completed_at"] if row else None,
+                "reward_claimed": row["reward_claimed"] if row else 0
+            })
+        result.sort(key=lambda row: (-row["completed"], -row["progress"]))
+        return result if limit is None else result[:limit]
+
+    # Битвы и рейтинги
+
+    def _insert_battle(self, player_id, song_id, score, max_combo, perfect_hits, good_hits, bad_hits, missed, duration):
+        row = {
+            "id": self._next_id("battle_history"), "player_id": player_id, "song_id": song_id,
+            "score": score, "max_combo": max_combo, "perfect_hits": perfect_hits,
+            "good_hits": good_hits, "bad_hits": bad_hits, "missed": missed, "completed": 1,
+            "battle_duration": duration, "played_at": _timestamp()
+        }
+        self.history.append(row)
+        self._log(self.history.pop)
+
+        stats = self.stats[player_id]
+        self._set(stats, "total_battles", stats["total_battles"] + 1)
+        self._set(stats, "battles_won", stats["battles_won"] + 1)
+        self._set(stats, "perfect_scores", stats["perfect_scores"] + (1 if perfect_hits >= 10 else 0))
+        self._set(stats, "max_combo", max(stats["max_combo"], max_combo))
+        self._set(stats, "last_activity", row["played_at"])
+        return row["id"]
+
+    def record_battle(self, player_id, song_id, score, max_combo, perfect_hits, good_hits, bad_hits, missed, duration):
+        with self.transaction():
+            battle_id = self._insert_battle(
+                player_id, song_id, score, max_combo, perfect_hits, good_hits, bad_hits, missed, duration
+            )
+            self._update_song_stats(player_id, song_id, score, max_combo, perfect_hits + good_hits + bad_hits)
+            self._invalidate(player_id)
+        return battle_id
+
+    def settle_battle(self, player_id, battle, exp, money):
+        with self.transaction():
+            self._insert_battle(
+                player_id, battle['song_id'], battle['score'], battle['max_combo'], battle['perfect_hits'],
+                battle['good_hits'], battle['bad_hits'], battle['missed'], battle['battle_duration']
+            )
+            if battle.get('replay') is not None:
+                self.replays.append((
+                    self._next_id("battle_replays"), battle['song_id'], battle['replay'], battle['score'],
+                    battle['max_combo']
+                ))
+                self._log(self.replays.pop)
+            granted = self.grant_rewards(player_id, exp, money)
+            best_score, best_score_total = self._update_song_stats(
+                player_id, battle['song_id'], battle['score'], battle['max_combo'],
+                battle['perfect_hits'] + battle['good_hits'] + battle['bad_hits']
+            )
+            self._invalidate(player_id)
+
+        return {
+            **granted,
+            "best_score": best_score,
+            "best_score_total": best_score_total
+        }
+
+    def _update_song_stats(self, player_id, song_id, score, max_combo, hits):
+        songs = self.song_stats.setdefault(player_id, {})
+        index = self.song_scores.setdefault(song_id, [])
+        row = songs.get(song_id)
+        if row is None:
+            row = {
+                "player_id": player_id, "song_id": song_id, "best_score": score,
+                "best_combo": max_combo, "play_count": 1, "total_hits": hits
+            }
+            self._put(songs, song_id, row)
+            self._index_insert(index, (-score, player_id))
+        else:
+            if score > row["best_score"]:
+                self._index_remove(index, (-row["best_score"], player_id))
+                self._index_insert(index, (-score, player_id))
+                self._set(row, "best_score", score)
+            self._set(row, "best_combo", max(row["best_combo"], max_combo))
+            self._set(row, "play_count", row["play_count"] + 1)
+            self._set(row, "total_hits", row["total_hits"] + hits)
+
+        stats = self.stats.get(player_id)
+        if stats is None:
+            return row["best_score"], 0
+        total = sum(song["best_score"] for song in songs.values())
+        if total != stats["best_score_total"]:
+            if stats["best_score_total"] > 0:
+                self._index_remove(self.total_scores, (-stats["best_score_total"], player_id))
+            if total > 0:
+                self._index_insert(self.total_scores, (-total, player_id))
+            self._set(stats, "best_score_total", total)
+        return row["best_score"], total
+
+    def get_song_stats(self, player_id):
+        rows = [dict(row) for row in self.song_stats.get(player_id, {}).values()]
+        rows.sort(key=lambda row: -row["best_score"])
+        return rows
+
+    def compact_battle_history(self, older_than_days, batch_size):
+        cutoff = _timestamp(datetime.now(timezone.utc) - timedelta(days=older_than_days))
+        removed = 0
+        while removed < batch_size and self.history and self.history[0]["played_at"] < cutoff:
+            self._log(self.history.appendleft, self.history.popleft())
+            removed += 1
+        return removed
+
+    def get_battle_replays(self, after, limit):
+        start = bisect.bisect_right(self.replays, after or 0, key=lambda row: row[0])
+        return self.replays[start:start + limit]
+
+    def save_battles(self, rows):
+        for row in rows:
+            self._put(self.battles, row[0], tuple(row))
+        return len(rows)
+
+    def delete_battles(self, player_ids):
+        removed = 0
+        for player_id in player_ids:
+            if player_id in self.battles:
+                self._remove(self.battles, player_id)
+                removed += 1
+        return removed
+
+    def load_battles(self):
+        return list(self.battles.values())
+
+    def _score_index(self, song_id):
+        return self.total_scores if song_id is None else self.song_scores.get(song_id, [])
+
+    def get_leaderboard_top(self, song_id, limit):
+        return [(player_id, -neg_score) for neg_score, player_id in self._score_index(song_id)[:limit]]
+
+    def get_leaderboard_rank(self, player_id, song_id=None):
+        if song_id is None:
+            stats = self.stats.get(player_id)
+            score = stats["best_score_total"] if stats and stats["best_score_total"] > 0 else None
+        else:
+            row = self.song_stats.get(player_id, {}).get(song_id)
+            score = row["best_score"] if row else None
+        if score is None:
+            return None
+        return {"score": score, "rank": self.count_better_scores(score, song_id) + 1}
+
+    def count_better_scores(self, score, song_id=None):
+        # (-score,) меньше любого (-score, player_id) - слева только строго лучшие
+        return bisect.bisect_left(self._score_index(song_id), (-score,))
+
+    def get_player_names(self, player_ids):
+        return {
+            player_id: self.players[player_id]["character_name"]
+            for player_id in player_ids if player_id in self.players
+        }
+
+    # Профиль
+
+    def get_player_dashboard(self, player_id):
+        total = len(self.definitions)
+        done = sum(1 for row in self.achievements.get(player_id, {}).values() if row["completed"])
+        return {
+            "achievements_total": total,
+            "achievements_completed": done,
+            "achievements_percentage": round(100.0 * done / total, 1) if total else 0,
+            "quests_active": sum(
+                1 for row in self.player_quests.get(player_id, {}).values() if not row["completed"]
+            ),
+            "quests_completed": len(self.completed_quests.get(player_id, [])),
+            "inventory_items": sum(
+                row["quantity"] for row in self.inventory.get(player_id, {}).values() if row["quantity"] > 0
+            )
+        }
+
+    def get_inventory(self, player_id):
+        rows = [dict(row) for row in self.inventory.get(player_id, {}).values() if row["quantity"] > 0]
+        rows.sort(key=lambda row: row["item_name"])
+        return rows
@@ -0,0 +1,483 @@
+import json
+import logging
+import re
+
+from core import queries
+
+logger = logging.getLogger(__name__)
+
+# Версия схемы хранится в PRAGMA user_version, миграции применяются строго по порядку
+
+
+def create_base_schema(cursor):
+    """v1: исходные таблицы игры"""
+    # Игроки
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS players (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            character_name TEXT NOT NULL,
+            level INTEGER DEFAULT 1,
+            exp INTEGER DEFAULT 0,
+            health INTEGER DEFAULT 100,
+            max_health INTEGER DEFAULT 100,
+            rhythm INTEGER DEFAULT 50,
+            charisma INTEGER DEFAULT 30,
+            strength INTEGER DEFAULT 40,
+            money INTEGER DEFAULT 100,
+            energy INTEGER DEFAULT 100,
+            max_energy INTEGER DEFAULT 100,
+            last_energy_update DATETIME DEFAULT CURRENT_TIMESTAMP,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_active DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Инвентарь
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS inventory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER NOT NULL,
+            item_id TEXT NOT NULL,
+            item_name TEXT NOT NULL,
+            quantity INTEGER DEFAULT 1,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Прогресс сюжета
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS story_progress (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER UNIQUE NOT NULL,
+            chapter INTEGER DEFAULT 1,
+            completed_chapters TEXT DEFAULT '[]',
+            current_quest TEXT,
+            story_flags TEXT DEFAULT '{}',
+            pico_relationship INTEGER DEFAULT 0,
+            boyfriend_relationship INTEGER DEFAULT 0,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Активные квесты
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS active_quests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER NOT NULL,
+            quest_id TEXT NOT NULL,
+            quest_type TEXT NOT NULL,
+            progress INTEGER DEFAULT 0,
+            target INTEGER NOT NULL,
+            started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Завершенные квесты
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS completed_quests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER NOT NULL,
+            quest_id TEXT NOT NULL,
+            completed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            reward_claimed BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Достижения
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS achievements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER NOT NULL,
+            achievement_id TEXT NOT NULL,
+            achievement_name TEXT NOT NULL,
+            progress INTEGER DEFAULT 0,
+            target INTEGER NOT NULL,
+            completed BOOLEAN DEFAULT FALSE,
+            completed_at DATETIME,
+            reward_claimed BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Ежедневные задания
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_quests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER NOT NULL,
+            quest_type TEXT NOT NULL,
+            progress INTEGER DEFAULT 0,
+            target INTEGER NOT NULL,
+            completed BOOLEAN DEFAULT FALSE,
+            date DATE NOT NULL,
+            reward_claimed BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Статистика
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS player_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER UNIQUE NOT NULL,
+            total_battles INTEGER DEFAULT 0,
+            battles_won INTEGER DEFAULT 0,
+            perfect_scores INTEGER DEFAULT 0,
+            max_combo INTEGER DEFAULT 0,
+            quests_completed INTEGER DEFAULT 0,
+            daily_quests_completed INTEGER DEFAULT 0,
+            achievements_completed INTEGER DEFAULT 0,
+            total_play_time INTEGER DEFAULT 0,
+            money_earned INTEGER DEFAULT 0,
+            money_spent INTEGER DEFAULT 0,
+            last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Баттлы
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS battle_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER NOT NULL,
+            song_id TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            max_combo INTEGER DEFAULT 0,
+            perfect_hits INTEGER DEFAULT 0,
+            good_hits INTEGER DEFAULT 0,
+            bad_hits INTEGER DEFAULT 0,
+            missed INTEGER DEFAULT 0,
+            completed BOOLEAN DEFAULT FALSE,
+            battle_duration INTEGER DEFAULT 0,
+            played_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+
+
+def add_active_quests_completed(cursor):
+    """v2: колонка completed, которую читают запросы квестов"""
+    cursor.execute("PRAGMA table_info(active_quests)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if "completed" not in columns:
+        cursor.execute("ALTER TABLE active_quests ADD COLUMN completed BOOLEAN DEFAULT FALSE")
+
+
+def create_hot_path_indexes(cursor):
+    """v3: индексы для поиска по игроку вместо полного сканирования таблиц"""
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_achievements_player
+        ON achievements(player_id, achievement_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_active_quests_player_type
+        ON active_quests(player_id, quest_type)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_active_quests_player_quest
+        ON active_quests(player_id, quest_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_completed_quests_player
+        ON completed_quests(player_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_inventory_player_item
+        ON inventory(player_id, item_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_daily_quests_player_date
+        ON daily_quests(player_id, date)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_battle_history_player_played
+        ON battle_history(player_id, played_at)
+    ''')
+
+
+DEFAULT_ACHIEVEMENTS = [
+    # Story achievements
+    ("first_blood", "Первая кровь", 1),
+    ("pico_friend", "Друг Пико", 50),
+    ("story_master", "Мастер истории", 4),
+    
+    # Battle achievements
+    ("perfectionist", "Перфекционист", 50),
+    ("combo_master", "Мастер комбо", 100),
+    ("boss_slayer", "Убийца боссов", 5),
+    
+    # Collection achievements
+    ("note_collector", "Коллекционер нот", 1000),
+    ("rich_player", "Богатый игрок", 10000),
+    
+    # Social achievements
+    ("popular", "Популярный", 20),
+    ("legendary", "Легендарный", 50),
+]
+
+
+def create_achievement_catalog(cursor):
+    """v4: каталог достижений вместо копии всех достижений у каждого игрока"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS achievement_definitions (
+            achievement_id TEXT PRIMARY KEY,
+            achievement_name TEXT NOT NULL,
+            target INTEGER NOT NULL
+        )
+    ''')
+    cursor.executemany('''
+        INSERT OR IGNORE INTO achievement_definitions (achievement_id, achievement_name, target)
+        VALUES (?, ?, ?)
+    ''', DEFAULT_ACHIEVEMENTS)
+    
+    # Нетронутые строки больше не нужны: прогресс создается лениво
+    cursor.execute("DELETE FROM achievements WHERE progress = 0 AND completed = FALSE")
+
+
+def create_song_stats(cursor):
+    """v5: агрегаты битв по (игрок, песня) вместо сканирования battle_history"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS song_stats (
+            player_id INTEGER NOT NULL,
+            song_id TEXT NOT NULL,
+            best_score INTEGER DEFAULT 0,
+            best_combo INTEGER DEFAULT 0,
+            play_count INTEGER DEFAULT 0,
+            total_hits INTEGER DEFAULT 0,
+            PRIMARY KEY(player_id, song_id),
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO song_stats (player_id, song_id, best_score, best_combo, play_count, total_hits)
+        SELECT player_id, song_id, MAX(score), MAX(max_combo), COUNT(*),
+               SUM(perfect_hits + good_hits + bad_hits)
+        FROM battle_history
+        GROUP BY player_id, song_id
+    ''')
+    # Для пакетного удаления старых записей по сроку хранения
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_battle_history_played
+        ON battle_history(played_at)
+    ''')
+
+
+def create_leaderboard_indexes(cursor):
+    """v6: сумма лучших результатов и индексы для рейтингов"""
+    cursor.execute("PRAGMA table_info(player_stats)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if "best_score_total" not in columns:
+        cursor.execute("ALTER TABLE player_stats ADD COLUMN best_score_total INTEGER DEFAULT 0")
+    
+    cursor.execute('''
+        UPDATE player_stats SET best_score_total = COALESCE(
+            (SELECT SUM(best_score) FROM song_stats WHERE song_stats.player_id = player_stats.player_id), 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_song_stats_song_score
+        ON song_stats(song_id, best_score)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_player_stats_best_total
+        ON player_stats(best_score_total)
+    ''')
+
+
+def create_rollover_indexes(cursor):
+    """v7: индексы для ежедневной ротации квестов"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_active_quests_expires
+        ON active_quests(expires_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_player_stats_activity
+        ON player_stats(last_activity)
+    ''')
+
+
+def encode_story_progress(cursor):
+    """v8: флаги и пройденные главы сюжета битами вместо JSON"""
+    from core.story_state import encode_legacy_json
+
+    cursor.execute("PRAGMA table_info(story_progress)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if "flag_bits" not in columns:
+        cursor.execute("ALTER TABLE story_progress ADD COLUMN flag_bits INTEGER NOT NULL DEFAULT 0")
+    if "chapter_bits" not in columns:
+        cursor.execute("ALTER TABLE story_progress ADD COLUMN chapter_bits INTEGER NOT NULL DEFAULT 0")
+
+    # Переводим только непустые значения; в JSON-колонках остается то, что
+    # не выражается битами реестра, и их больше никто не пишет
+    cursor.execute('''
+        SELECT id, completed_chapters, story_flags FROM story_progress
+        WHERE completed_chapters NOT IN ('', '[]') OR story_flags NOT IN ('', '{}')
+    ''')
+    updates = []
+    for row_id, completed_chapters, story_flags in cursor.fetchall():
+        flag_bits, chapter_bits, other_chapters, other_flags = encode_legacy_json(completed_chapters, story_flags)
+        if other_chapters or other_flags:
+            logger.warning(f"story_progress {row_id}: вне реестра сюжета остались {other_chapters} {other_flags}")
+        updates.append((flag_bits, chapter_bits, json.dumps(other_chapters), json.dumps(other_flags), row_id))
+    cursor.executemany('''
+        UPDATE story_progress
+        SET flag_bits = flag_bits | ?, chapter_bits = chapter_bits | ?,
+            completed_chapters = ?, story_flags = ?
+        WHERE id = ?
+    ''', updates)
+
+
+def create_active_battles(cursor):
+    """v9: незавершенные битвы, чтобы продолжить их после перезапуска"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS active_battles (
+            player_id INTEGER PRIMARY KEY,
+            telegram_id INTEGER NOT NULL,
+            song_id TEXT NOT NULL,
+            seed INTEGER NOT NULL,
+            state BLOB NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+
+
+def create_battle_replays(cursor):
+    """v10: повторы битв (seed и ввод по нотам) для аудита и пересчета счета
+
+    Отдельная таблица, а не колонка battle_history: очистка истории по сроку
+    хранения (compact_battle_history) повторы не удаляет.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS battle_replays (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER NOT NULL,
+            song_id TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            max_combo INTEGER NOT NULL,
+            replay BLOB NOT NULL,
+            played_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+    ''')
+
+
+def expire_legacy_daily_quests(cursor):
+    """v11: срок для ежедневных квестов, выданных до ротации (expires_at был NULL)
+
+    quest_id таких квестов кончается датой выдачи (daily_battle_2024-05-01),
+    срок - начало следующего дня, как у daily_quest_rows. Без срока ротация
+    их не удаляет, и они копят прогресс рядом с новыми. Квесты, дату которых
+    разобрать нельзя, удаляются.
+    """
+    cursor.execute('''
+        UPDATE active_quests SET expires_at = datetime(substr(quest_id, -10), '+1 day')
+        WHERE expires_at IS NULL AND quest_id LIKE 'daily\\_%' ESCAPE '\\'
+          AND date(substr(quest_id, -10)) IS NOT NULL
+    ''')
+    cursor.execute('''
+        DELETE FROM active_quests
+        WHERE expires_at IS NULL AND quest_id LIKE 'daily\\_%' ESCAPE '\\'
+    ''')
+
+
+MIGRATIONS = [
+    (1, create_base_schema),
+    (2, add_active_quests_completed),
+    (3, create_hot_path_indexes),
+    (4, create_achievement_catalog),
+    (5, create_song_stats),
+    (6, create_leaderboard_indexes),
+    (7, create_rollover_indexes),
+    (8, encode_story_progress),
+    (9, create_active_battles),
+    (10, create_battle_replays),
+    (11, expire_legacy_daily_quests),
+]
+
+
+def get_schema_version(conn):
+    """Текущая версия схемы базы"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn):
+    """Применить недостающие миграции, каждую в своей транзакции"""
+    version = get_schema_version(conn)
+    applied = 0
+    
+    for target, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"Миграция схемы до версии {target} не удалась")
+            raise
+        
+        logger.info(f"Схема обновлена до версии {target}: {migration.__doc__}")
+        version = target
+        applied += 1
+    
+    return applied
+
+
+# Таблицы-справочники постоянного размера, их сканирование не растет с числом игроков
+CATALOG_TABLES = {"achievement_definitions"}
+
+# Запросы горячих путей GameDatabase с примерами параметров: ни один не должен
+# сканировать таблицу целиком
+HOT_PATH_QUERIES = {
+    "get_player": (queries.PLAYER_BY_TELEGRAM_ID_SQL, (1,)),
+    "get_story": (queries.STORY_BY_PLAYER_SQL, (1,)),
+    "get_stats": (queries.STATS_BY_PLAYER_SQL, (1,)),
+    "spend_energy": (queries.SPEND_ENERGY_SQL, {"amount": 1, "player_id": 1}),
+    "add_quest": (queries.QUEST_EXISTS_SQL, (1, "q")),
+    "update_quest_progress": (queries.QUEST_PROGRESS_SQL, (1, 1, "battle")),
+    "update_achievement_progress": (queries.ACHIEVEMENT_PROGRESS_SQL, (1, 1, "first_blood")),
+    "complete_achievement": (queries.ACHIEVEMENT_COMPLETE_SQL, (1, "first_blood")),
+    "get_player_achievements": (queries.PLAYER_ACHIEVEMENTS_SQL, (1, 5)),
+    "get_player_dashboard": (queries.PLAYER_DASHBOARD_SQL, {"player_id": 1}),
+    "get_active_quests": (queries.ACTIVE_QUESTS_SQL, (1,)),
+    "get_completed_quests": (queries.COMPLETED_QUESTS_SQL, (1,)),
+    "get_inventory": (queries.INVENTORY_SQL, (1,)),
+    "get_song_stats": (queries.SONG_STATS_SQL, (1,)),
+    "compact_battle_history": (queries.COMPACT_HISTORY_SQL, ("-30 days", 500)),
+    "get_battle_replays": (queries.BATTLE_REPLAYS_SQL, (0, 500)),
+    "leaderboard_song_top": (queries.LEADERBOARD_TOP_SONG_SQL, ("tutorial", 100)),
+    "leaderboard_song_rank": (queries.LEADERBOARD_RANK_SONG_SQL, (1, "tutorial")),
+    "leaderboard_song_better": (queries.BETTER_SCORES_SONG_SQL, ("tutorial", 1000)),
+    "leaderboard_global_top": (queries.LEADERBOARD_TOP_GLOBAL_SQL, (100,)),
+    "leaderboard_global_rank": (queries.LEADERBOARD_RANK_GLOBAL_SQL, (1,)),
+    "leaderboard_global_better": (queries.BETTER_SCORES_GLOBAL_SQL, (1000,)),
+    "expire_quests": (queries.EXPIRE_QUESTS_SQL, ("2000-01-01 00:00:00", 500)),
+    "recently_active_players": (queries.RECENTLY_ACTIVE_SQL, ("-3 days",)),
+}
+
+
+def find_full_scans(conn, queries=None):
+    """Вернуть [(запрос, шаг плана)] для горячих запросов с полным сканированием"""
+    full_scans = []
+    for name, (sql, params) in (queries or HOT_PATH_QUERIES).items():
+        # Обход по индексу останавливается на первых строках только при LIMIT,
+        # без него SCAN ... USING INDEX читает весь индекс (например, COUNT(*))
+        limited = re.search(r"\bLIMIT\b", sql, re.IGNORECASE) is not None
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row[3]
+            if not detail.startswith("SCAN "):
+                continue
+            table = detail.split()[1]
+            ordered_walk = limited and (" USING INDEX " in detail or " USING COVERING INDEX " in detail)
+            if table != "CONSTANT" and table not in CATALOG_TABLES and not ordered_walk:
+                full_scans.append((name, detail))
+    return full_scans
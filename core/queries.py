@@ -0,0 +1,152 @@
+from core.storage import ENERGY_RECOVERY_SECONDS
+
+# SQL горячих путей GameDatabase. Те же строки проверяет find_full_scans
+# (HOT_PATH_QUERIES в core.migrations), поэтому план смотрится у настоящих запросов
+
+# Энергия хранится как (energy, last_energy_update) и досчитывается при чтении без записи
+ENERGY_GAIN_SQL = f'''((
+    CAST(strftime('%s', 'now') AS INTEGER) - CAST(strftime('%s', last_energy_update) AS INTEGER)
+) / {ENERGY_RECOVERY_SECONDS})'''
+CURRENT_ENERGY_SQL = f"MIN(max_energy, energy + {ENERGY_GAIN_SQL})"
+
+PLAYER_BY_TELEGRAM_ID_SQL = f"SELECT *, {CURRENT_ENERGY_SQL} AS current_energy FROM players WHERE telegram_id = ?"
+STORY_BY_PLAYER_SQL = "SELECT * FROM story_progress WHERE player_id = ?"
+STATS_BY_PLAYER_SQL = "SELECT * FROM player_stats WHERE player_id = ?"
+
+# Восстановленные единицы фиксируются, остаток времени до следующей сохраняется
+SPEND_ENERGY_SQL = f'''
+    UPDATE players
+    SET energy = {CURRENT_ENERGY_SQL} - :amount,
+        last_energy_update = CASE
+            WHEN energy + {ENERGY_GAIN_SQL} >= max_energy THEN CURRENT_TIMESTAMP
+            ELSE datetime(last_energy_update, '+' || ({ENERGY_GAIN_SQL} * {ENERGY_RECOVERY_SECONDS}) || ' seconds')
+        END
+    WHERE id = :player_id AND {CURRENT_ENERGY_SQL} >= :amount
+'''
+
+QUEST_EXISTS_SQL = "SELECT id FROM active_quests WHERE player_id = ? AND quest_id = ?"
+
+EXPIRE_QUESTS_SQL = '''
+    DELETE FROM active_quests WHERE id IN (
+        SELECT id FROM active_quests WHERE expires_at <= ? LIMIT ?
+    )
+'''
+
+RECENTLY_ACTIVE_SQL = '''
+    SELECT player_id FROM player_stats WHERE last_activity >= datetime('now', ?)
+'''
+
+QUEST_PROGRESS_SQL = '''
+    UPDATE active_quests
+    SET progress = progress + ?
+    WHERE player_id = ? AND quest_type = ? AND completed = FALSE
+'''
+
+# Строка прогресса создается из каталога при первом касании
+ACHIEVEMENT_PROGRESS_SQL = '''
+    INSERT INTO achievements (player_id, achievement_id, achievement_name, target, progress)
+    SELECT ?, achievement_id, achievement_name, target, ?
+    FROM achievement_definitions WHERE achievement_id = ?
+    ON CONFLICT(player_id, achievement_id) DO UPDATE
+    SET progress = progress + excluded.progress
+    WHERE completed = FALSE
+'''
+
+ACHIEVEMENT_COMPLETE_SQL = '''
+    UPDATE achievements
+    SET completed = TRUE, completed_at = CURRENT_TIMESTAMP
+    WHERE player_id = ? AND achievement_id = ? AND progress >= target AND completed = FALSE
+'''
+
+SONG_STATS_SQL = '''
+    SELECT * FROM song_stats WHERE player_id = ? ORDER BY best_score DESC
+'''
+
+LEADERBOARD_TOP_GLOBAL_SQL = '''
+    SELECT player_id, best_score_total AS score FROM player_stats
+    WHERE best_score_total > 0
+    ORDER BY best_score_total DESC LIMIT ?
+'''
+
+LEADERBOARD_TOP_SONG_SQL = '''
+    SELECT player_id, best_score AS score FROM song_stats
+    WHERE song_id = ?
+    ORDER BY best_score DESC LIMIT ?
+'''
+
+LEADERBOARD_RANK_GLOBAL_SQL = '''
+    SELECT best_score_total AS score,
+           (SELECT COUNT(*) FROM player_stats AS other
+            WHERE other.best_score_total > player_stats.best_score_total) + 1 AS rank
+    FROM player_stats WHERE player_id = ? AND best_score_total > 0
+'''
+
+LEADERBOARD_RANK_SONG_SQL = '''
+    SELECT best_score AS score,
+           (SELECT COUNT(*) FROM song_stats AS other
+            WHERE other.song_id = song_stats.song_id
+            AND other.best_score > song_stats.best_score) + 1 AS rank
+    FROM song_stats WHERE player_id = ? AND song_id = ?
+'''
+
+BETTER_SCORES_GLOBAL_SQL = "SELECT COUNT(*) FROM player_stats WHERE best_score_total > ?"
+BETTER_SCORES_SONG_SQL = "SELECT COUNT(*) FROM song_stats WHERE song_id = ? AND best_score > ?"
+
+COMPACT_HISTORY_SQL = '''
+    DELETE FROM battle_history WHERE id IN (
+        SELECT id FROM battle_history
+        WHERE played_at < datetime('now', ?)
+        ORDER BY played_at
+        LIMIT ?
+    )
+'''
+
+BATTLE_REPLAYS_SQL = '''
+    SELECT id, song_id, replay, score, max_combo FROM battle_replays
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+'''
+
+# Только скалярные подзапросы: производные таблицы в FROM план показывает как SCAN
+PLAYER_DASHBOARD_SQL = '''
+    SELECT
+        (SELECT COUNT(*) FROM achievement_definitions) AS achievements_total,
+        (SELECT COUNT(*) FROM achievements
+         WHERE player_id = :player_id AND completed = TRUE) AS achievements_completed,
+        (SELECT COUNT(*) FROM active_quests
+         WHERE player_id = :player_id AND completed = FALSE) AS quests_active,
+        (SELECT COUNT(*) FROM completed_quests
+         WHERE player_id = :player_id) AS quests_completed,
+        (SELECT COALESCE(SUM(quantity), 0) FROM inventory
+         WHERE player_id = :player_id AND quantity > 0) AS inventory_items
+'''
+
+# Каталог определяет список, а прогресс есть только у затронутых достижений
+PLAYER_ACHIEVEMENTS_SQL = '''
+    SELECT achievement_definitions.achievement_id,
+           achievement_definitions.achievement_name,
+           achievement_definitions.target,
+           COALESCE(achievements.progress, 0) AS progress,
+           COALESCE(achievements.completed, FALSE) AS completed,
+           achievements.completed_at,
+           COALESCE(achievements.reward_claimed, FALSE) AS reward_claimed
+    FROM achievement_definitions
+    LEFT JOIN achievements
+        ON achievements.player_id = ?
+        AND achievements.achievement_id = achievement_definitions.achievement_id
+    ORDER BY completed DESC, progress DESC
+    LIMIT ?
+'''
+
+ACTIVE_QUESTS_SQL = '''
+    SELECT * FROM active_quests WHERE player_id = ? AND completed = FALSE
+'''
+
+COMPLETED_QUESTS_SQL = '''
+    SELECT * FROM completed_quests WHERE player_id = ?
+'''
+
+INVENTORY_SQL = '''
+    SELECT * FROM inventory WHERE player_id = ? AND quantity > 0 ORDER BY item_name
+'''
@@ -0,0 +1,208 @@
+import abc
+import heapq
+import itertools
+import zlib
+from contextlib import ExitStack, contextmanager
+from core.database import GameDatabase
+from core.storage import GameStorage
+
+# Методы с telegram_id первым аргументом - идут в шард по хэшу telegram_id
+TELEGRAM_METHODS = frozenset({
+    "get_player",
+    "create_player",
+})
+
+# Методы с player_id первым аргументом - идут в шард по id игрока
+PLAYER_METHODS = frozenset({
+    "update_energy",
+    "spend_energy",
+    "add_experience",
+    "check_level_up",
+    "add_money",
+    "update_relationship",
+    "touch_activity",
+    "set_story_flag",
+    "complete_chapter",
+    "add_quest",
+    "update_quest_progress",
+    "update_achievement_progress",
+    "record_battle",
+    "grant_rewards",
+    "settle_battle",
+    "get_song_stats",
+    "get_achievement_state",
+    "get_open_quests",
+    "get_player_dashboard",
+    "get_player_achievements",
+    "get_active_quests",
+    "get_completed_quests",
+    "get_inventory",
+})
+
+def shard_for_telegram(telegram_id, count):
+    """Номер шарда игрока по стабильному хэшу telegram_id"""
+    return zlib.crc32(str(telegram_id).encode()) % count
+
+def shard_paths(count, pattern):
+    return [pattern.format(index) for index in range(count)]
+
+class ShardedGameDatabase(GameStorage):
+    """Тот же API, что у GameDatabase, поверх N файлов SQLite
+
+    Игрок живет в шарде shard_for_telegram(telegram_id), его id в этом
+    шарде дает номер шарда по модулю N, поэтому методы по telegram_id и по
+    player_id сразу идут в нужный файл. У каждого файла свой писатель, так что
+    записи разных игроков не ждут друг друга. Рейтинги, ротация квестов и
+    прочие общие операции выполняются на всех шардах с объединением результата.
+    """
+
+    def __init__(self, paths, read_only=False):
+        self.paths = list(paths)
+        self.count = len(self.paths)
+        self.read_only = read_only
+        self.in_memory = False
+        self.shards = [
+            GameDatabase(path, read_only=read_only, shard=(index, self.count))
+            for index, path in enumerate(self.paths)
+        ]
+
+    def open_reader(self):
+        return ShardedGameDatabase(self.paths, read_only=True)
+
+    def shard_of_player(self, player_id):
+        return player_id % self.count
+
+    def shard_index(self, method, args):
+        """Номер шарда для вызова метода или None, если метод затрагивает все шарды"""
+        if method in TELEGRAM_METHODS:
+            return shard_for_telegram(args[0], self.count)
+        if method in PLAYER_METHODS:
+            return self.shard_of_player(args[0])
+        return None
+
+    def _call(self, index, method, *args):
+        shard = self.shards[index]
+        if self.read_only:
+            return getattr(shard, method)(*args)
+        # Замок шарда: его же держит писатель шарда на время своей операции
+        with shard.write_lock:
+            return getattr(shard, method)(*args)
+
+    def _each(self, method, *args):
+        return [self._call(index, method, *args) for index in range(self.count)]
+
+    @contextmanager
+    def transaction(self, player_id=None):
+        """Транзакция в шарде игрока или, без player_id, сразу во всех шардах"""
+        indexes = range(self.count) if player_id is None else [self.shard_of_player(player_id)]
+        with ExitStack() as stack:
+            for index in indexes:
+                shard = self.shards[index]
+                stack.enter_context(shard.write_lock)
+                stack.enter_context(shard.transaction())
+            yield self
+
+    def _split_by_player(self, keyed):
+        # {(player_id, id): прирост} -> по словарю на шард
+        parts = [{} for _ in range(self.count)]
+        for key, value in keyed.items():
+            parts[self.shard_of_player(key[0])][key] = value
+        return parts
+
+    def add_quests_bulk(self, rows):
+        parts = [[] for _ in range(self.count)]
+        for row in rows:
+            parts[self.shard_of_player(row[0])].append(row)
+        return sum(self._call(index, "add_quests_bulk", part) for index, part in enumerate(parts) if part)
+
+    def apply_progress(self, achievements, quests):
+        achievement_parts = self._split_by_player(achievements)
+        quest_parts = self._split_by_player(quests)
+        for index in range(self.count):
+            if achievement_parts[index] or quest_parts[index]:
+                self._call(index, "apply_progress", achievement_parts[index], quest_parts[index])
+
+    def expire_quests(self, now, batch_size):
+        # Сумма меньше batch_size, только если ни в одном шарде порция не была полной
+        return sum(self._each("expire_quests", now, batch_size))
+
+    def compact_battle_history(self, older_than_days, batch_size):
+        return sum(self._each("compact_battle_history", older_than_days, batch_size))
+
+    def get_recently_active_player_ids(self, days):
+        return list(itertools.chain.from_iterable(self._each("get_recently_active_player_ids", days)))
+
+    def get_achievement_targets(self):
+        # Каталог одинаковый во всех шардах
+        return self._call(0, "get_achievement_targets")
+
+    def save_battles(self, rows):
+        parts = [[] for _ in range(self.count)]
+        for row in rows:
+            parts[self.shard_of_player(row[0])].append(row)
+        return sum(self._call(index, "save_battles", part) for index, part in enumerate(parts) if part)
+
+    def delete_battles(self, player_ids):
+        parts = [[] for _ in range(self.count)]
+        for player_id in player_ids:
+            parts[self.shard_of_player(player_id)].append(player_id)
+        return sum(self._call(index, "delete_battles", part) for index, part in enumerate(parts) if part)
+
+    def load_battles(self):
+        return list(itertools.chain.from_iterable(self._each("load_battles")))
+
+    def get_battle_replays(self, after, limit):
+        """Keyset-курсор (номер шарда, id в шарде): шарды по порядку, внутри шарда - по id"""
+        index, after_id = after if after is not None else (0, None)
+        rows = []
+        while index < self.count and len(rows) < limit:
+            part = self._call(index, "get_battle_replays", after_id, limit - len(rows))
+            rows += [((index, row[0]), *row[1:]) for row in part]
+            index += 1
+            after_id = None
+        return rows
+
+    def get_leaderboard_top(self, song_id, limit):
+        tops = self._each("get_leaderboard_top", song_id, limit)
+        merged = heapq.merge(*tops, key=lambda entry: -entry[1])
+        return list(itertools.islice(merged, limit))
+
+    def get_leaderboard_rank(self, player_id, song_id=None):
+        own = self._call(self.shard_of_player(player_id), "get_leaderboard_rank", player_id, song_id)
+        if own is None:
+            return None
+        better = sum(self._each("count_better_scores", own["score"], song_id))
+        return {"score": own["score"], "rank": better + 1}
+
+    def count_better_scores(self, score, song_id=None):
+        return sum(self._each("count_better_scores", score, song_id))
+
+    def get_player_names(self, player_ids):
+        parts = [[] for _ in range(self.count)]
+        for player_id in player_ids:
+            parts[self.shard_of_player(player_id)].append(player_id)
+        names = {}
+        for index, part in enumerate(parts):
+            if part:
+                names.update(self._call(index, "get_player_names", part))
+        return names
+
+    def checkpoint(self, mode="PASSIVE"):
+        return self._each("checkpoint", mode)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+def _routed(name):
+    def method(self, *args):
+        return self._call(self.shard_index(name, args), name, *args)
+    method.__name__ = name
+    method.__doc__ = getattr(GameStorage, name).__doc__
+    return method
+
+# Методы одного игрока просто перенаправляются в его шард
+for _name in TELEGRAM_METHODS | PLAYER_METHODS:
+    setattr(ShardedGameDatabase, _name, _routed(_name))
+# Методы добавлены после создания класса, абстрактные пересчитываются заново
+abc.update_abstractmethods(ShardedGameDatabase)
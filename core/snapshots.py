@@ -0,0 +1,154 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+import config
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PREFIX = "snapshot-"
+SNAPSHOT_SUFFIX = ".db"
+
+class BackupRestarted(Exception):
+    """Пошаговый backup слишком часто перезапускается из-за записей"""
+
+def list_snapshots(directory):
+    """Пути снимков в каталоге от старого к новому"""
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(
+        name for name in os.listdir(directory)
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX)
+    )
+    return [os.path.join(directory, name) for name in names]
+
+class SnapshotManager:
+    """Онлайн-снимки базы в памяти в файл через backup API SQLite
+
+    Копирование идет порциями по step_pages страниц с паузой между ними.
+    Каждый шаг берет write_lock базы, поэтому попадает между транзакциями
+    писателя и задерживает его только на время одного шага, а не всего снимка.
+    Если записи идут так часто, что пошаговая копия не успевает завершиться,
+    база копируется в память одним шагом и уже оттуда пишется в файл.
+    Хранится keep последних снимков, самый свежий восстанавливается при старте.
+    """
+
+    def __init__(self, db, directory=None, keep=None, step_pages=None, step_pause_ms=None, max_restarts=None):
+        self.db = db
+        self.directory = directory or config.DB_SNAPSHOT_DIR
+        self.keep = keep or config.DB_SNAPSHOT_KEEP
+        self.step_pages = step_pages or config.DB_SNAPSHOT_STEP_PAGES
+        self.step_pause = (config.DB_SNAPSHOT_STEP_PAUSE_MS if step_pause_ms is None else step_pause_ms) / 1000
+        self.max_restarts = config.DB_SNAPSHOT_MAX_RESTARTS if max_restarts is None else max_restarts
+        self.lock = threading.Lock()
+        self.snapshots = 0
+        self.failures = 0
+        self.last = None  # метрики последнего снимка
+
+    def snapshot(self):
+        """Снять снимок (блокирующий вызов для фонового потока), возвращает метрики"""
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"{SNAPSHOT_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{SNAPSHOT_SUFFIX}"
+            path = os.path.join(self.directory, name)
+            tmp_path = path + ".tmp"
+
+            started = time.perf_counter()
+            target = sqlite3.connect(tmp_path)
+            try:
+                try:
+                    steps = self._copy_live(target)
+                    staged = False
+                except BackupRestarted:
+                    steps = self._copy_staged(target)
+                    staged = True
+                pages = target.execute("PRAGMA page_count").fetchone()[0]
+            except sqlite3.Error:
+                self.failures += 1
+                target.close()
+                os.remove(tmp_path)
+                raise
+            target.close()
+            # Недописанный снимок никогда не виден под итоговым именем
+            os.replace(tmp_path, path)
+
+            self.snapshots += 1
+            self.last = {
+                "path": path,
+                "pages": pages,
+                "steps": len(steps),
+                "staged": staged,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                "blocked_ms": round(sum(steps) * 1000, 1),
+                "max_blocked_ms": round(max(steps, default=0) * 1000, 1),
+            }
+            self.rotate()
+            return self.last
+
+    def _copy_live(self, target):
+        # Шаги по step_pages страниц прямо с рабочего соединения, каждый под write_lock.
+        # Коммит в базу в памяти перезапускает backup, поэтому при частых записях
+        # после max_restarts перезапусков сдаемся и копируем через промежуточную базу
+        steps = []
+        state = {"started": 0, "remaining": None, "restarts": 0}
+        gate = self.db.write_lock
+
+        def on_step(status, remaining, total):
+            # Шаг шел под замком писателя - отпускаем его до следующего шага
+            steps.append(time.perf_counter() - state["started"])
+            if state["remaining"] is not None and remaining > state["remaining"]:
+                state["restarts"] += 1
+                if state["restarts"] > self.max_restarts:
+                    raise BackupRestarted()
+            state["remaining"] = remaining
+            gate.release()
+            if remaining and self.step_pause:
+                time.sleep(self.step_pause)
+            gate.acquire()
+            state["started"] = time.perf_counter()
+
+        gate.acquire()
+        try:
+            state["started"] = time.perf_counter()
+            self.db.conn.backup(target, pages=self.step_pages, progress=on_step, sleep=self.step_pause)
+        finally:
+            gate.release()
+        return steps
+
+    def _copy_staged(self, target):
+        # Копия в память одним шагом (писатель ждет только memcpy страниц),
+        # затем запись в файл порциями уже без замка
+        staging = sqlite3.connect(':memory:')
+        try:
+            with self.db.write_lock:
+                started = time.perf_counter()
+                self.db.conn.backup(staging)
+                blocked = time.perf_counter() - started
+            staging.backup(target, pages=self.step_pages)
+        finally:
+            staging.close()
+        return [blocked]
+
+    def rotate(self):
+        """Удалить снимки сверх keep последних"""
+        removed = 0
+        for path in list_snapshots(self.directory)[:-self.keep]:
+            os.remove(path)
+            removed += 1
+        return removed
+
+    def latest(self):
+        snapshots = list_snapshots(self.directory)
+        return snapshots[-1] if snapshots else None
+
+    def restore_latest(self):
+        """Восстановить базу из самого свежего снимка, путь снимка или None"""
+        path = self.latest()
+        if path is None:
+            return None
+        started = time.perf_counter()
+        self.db.restore(path)
+        logger.info(f"База восстановлена из снимка {path} за {(time.perf_counter() - started) * 1000:.1f} мс")
+        return path
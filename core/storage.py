@@ -0,0 +1,256 @@
+from abc import ABC, abstractmethod
+import config
+from core.identity_map import current_identity_map
+
+# Энергия восстанавливается на единицу за этот интервал (досчитывается при чтении)
+ENERGY_RECOVERY_SECONDS = config.ENERGY_RECOVERY_MINUTES * 60
+
+STARTER_ITEMS = [
+    ("health_potion", "Зелье здоровья", 3),
+    ("energy_drink", "Энергетик", 2),
+    ("guitar_pick", "Медиатор", 1)
+]
+
+def level_after_exp(level, exp):
+    """Уровень после начисления опыта (может вырасти сразу на несколько)"""
+    # Формула для следующего уровня: level^2 * 100
+    while level < config.MAX_LEVEL and exp >= (level ** 2) * 100:
+        level += 1
+    return level
+
+class GameStorage(ABC):
+    """Протокол хранилища игры: операции, на которые опираются GameEngine, DAO и бот
+
+    Реализации: GameDatabase (SQLite), ShardedGameDatabase (несколько файлов
+    SQLite) и InMemoryGameStorage (словари и явные индексы на чистом Python).
+    Все они проходят одну проверку tools/check_storage.py. Записи игроков
+    возвращаются как dict, булевы поля - как 0/1, время - строками
+    'YYYY-MM-DD HH:MM:SS' в UTC, как их отдает SQLite.
+
+    Атрибуты реализации: in_memory (второе соединение к ней открыть нельзя),
+    read_only и write_lock (RLock, который поток-писатель держит на время операции).
+    Операции абстрактные: реализация без любой из них не создается.
+    """
+
+    # Игроки
+
+    @abstractmethod
+    def get_player(self, telegram_id):
+        """Игрок по telegram_id со story, story_state, stats и энергией с учетом восстановления или None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_player(self, telegram_id, username, character_name):
+        """Создать игрока со стартовыми предметами, None если telegram_id уже занят"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_energy(self, player_id, new_energy):
+        raise NotImplementedError
+
+    @abstractmethod
+    def spend_energy(self, player_id, amount):
+        """Списать энергию, если ее хватает с учетом восстановления, True при успехе"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_experience(self, player_id, exp_amount):
+        raise NotImplementedError
+
+    @abstractmethod
+    def check_level_up(self, player_id):
+        """Повысить уровень по накопленному опыту, новый уровень или None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_money(self, player_id, amount):
+        raise NotImplementedError
+
+    @abstractmethod
+    def grant_rewards(self, player_id, exp, money):
+        """Опыт и деньги одной записью, {"level_up": уровень или None, "levels_gained": n}"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_relationship(self, player_id, character, amount):
+        raise NotImplementedError
+
+    @abstractmethod
+    def touch_activity(self, player_id):
+        """Отметить игрока активным сейчас (для ежедневной ротации)"""
+        raise NotImplementedError
+
+    # Сюжет (биты по реестру content.story, см. core/story_state.py)
+
+    @abstractmethod
+    def set_story_flag(self, player_id, flag):
+        """Поставить флаг сюжета, True если его еще не было"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def complete_chapter(self, player_id, chapter):
+        """Отметить главу пройденной, True если она пройдена впервые"""
+        raise NotImplementedError
+
+    # Квесты
+
+    @abstractmethod
+    def add_quest(self, player_id, quest_id, quest_type, target):
+        """Выдать квест, False если он уже выдан"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_quests_bulk(self, rows):
+        """Выдать [(player_id, quest_id, quest_type, target, expires_at)], число новых"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire_quests(self, now, batch_size):
+        """Удалить до batch_size квестов с expires_at <= now, число удаленных"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_recently_active_player_ids(self, days):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_quest_progress(self, player_id, quest_type, amount=1):
+        """Прогресс квестам типа, число завершенных квестов этого типа"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_open_quests(self, player_id, quest_type):
+        """[(прогресс, цель)] незавершенных квестов типа"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_active_quests(self, player_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_completed_quests(self, player_id):
+        raise NotImplementedError
+
+    # Достижения
+
+    @abstractmethod
+    def update_achievement_progress(self, player_id, achievement_id, amount=1):
+        """Прогресс достижения, True если оно завершено"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def apply_progress(self, achievements, quests):
+        """Приросты {(player_id, achievement_id | quest_type): n} одной транзакцией"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_achievement_targets(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_achievement_state(self, player_id, achievement_id):
+        """(прогресс, завершено), (0, False) если не начато"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_player_achievements(self, player_id, limit=None):
+        """Весь каталог с прогрессом игрока: сначала завершенные, затем по прогрессу"""
+        raise NotImplementedError
+
+    # Битвы и рейтинги
+
+    @abstractmethod
+    def record_battle(self, player_id, song_id, score, max_combo, perfect_hits, good_hits, bad_hits, missed, duration):
+        raise NotImplementedError
+
+    @abstractmethod
+    def settle_battle(self, player_id, battle, exp, money):
+        """Итог битвы одной транзакцией: grant_rewards + best_score и best_score_total
+
+        Прогресс квестов и достижений сюда не входит - его пишет apply_progress.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_song_stats(self, player_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def compact_battle_history(self, older_than_days, batch_size):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_battle_replays(self, after, limit):
+        """Порция повторов битв [(курсор, song_id, replay, score, max_combo)] после курсора after
+
+        Первый вызов - с after=None, следующий - с курсором последней строки.
+        Курсор непрозрачный: у ShardedGameDatabase это (номер шарда, id).
+        Повторы не удаляются вместе с историей по сроку хранения.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_battles(self, rows):
+        """Сохранить незавершенные битвы [(player_id, telegram_id, song_id, seed, state)], state - bytes"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_battles(self, player_ids):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_battles(self):
+        """Все сохраненные незавершенные битвы в формате save_battles"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_leaderboard_top(self, song_id, limit):
+        """[(player_id, счет)] по убыванию счета, song_id=None - глобальный рейтинг"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_leaderboard_rank(self, player_id, song_id=None):
+        """{"score", "rank"} или None, если игрок не играл"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_better_scores(self, score, song_id=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_player_names(self, player_ids):
+        raise NotImplementedError
+
+    # Профиль
+
+    @abstractmethod
+    def get_player_dashboard(self, player_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_inventory(self, player_id):
+        raise NotImplementedError
+
+    # Служебное
+
+    @abstractmethod
+    def transaction(self, player_id=None):
+        """Контекстный менеджер: записи блока применяются вместе или откатываются"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def open_reader(self):
+        """Хранилище для пула читателей (только если in_memory ложно)"""
+        raise NotImplementedError
+
+    def checkpoint(self, mode="PASSIVE"):
+        return None
+
+    def close(self):
+        pass
+
+    def _invalidate(self, player_id):
+        # Запись по игроку делает его запись в карте текущего апдейта устаревшей
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            identity_map.invalidate(player_id)
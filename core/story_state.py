@@ -0,0 +1,97 @@
+import json
+from content.story import CHAPTERS, STORY_FLAGS
+
+# Флаги и пройденные главы хранятся битами в INTEGER-колонках story_progress.
+# SQLite пишет целые в записи переменной длины (1-8 байт), так что пустой и
+# почти пустой прогресс занимает байт-два, а проверка и установка флага - одна
+# битовая операция без разбора JSON. В знаковое 64-битное целое влезает 63 бита.
+MAX_BITS = 63
+
+FLAG_BITS = {name: bit for bit, name in enumerate(STORY_FLAGS)}
+CHAPTER_BITS = {chapter: bit for bit, chapter in enumerate(CHAPTERS)}
+
+assert len(FLAG_BITS) == len(STORY_FLAGS) <= MAX_BITS, "STORY_FLAGS: дубли или больше 63 флагов"
+assert len(CHAPTER_BITS) == len(CHAPTERS) <= MAX_BITS, "CHAPTERS: дубли или больше 63 глав"
+
+def flag_mask(name):
+    """Маска флага из реестра STORY_FLAGS"""
+    if name not in FLAG_BITS:
+        raise ValueError(f"Флаг сюжета {name!r} не зарегистрирован в content.story.STORY_FLAGS")
+    return 1 << FLAG_BITS[name]
+
+def chapter_mask(chapter):
+    """Маска главы из реестра CHAPTERS"""
+    if chapter not in CHAPTER_BITS:
+        raise ValueError(f"Глава {chapter!r} не зарегистрирована в content.story.CHAPTERS")
+    return 1 << CHAPTER_BITS[chapter]
+
+def _names(bits, registry):
+    return [name for bit, name in enumerate(registry) if bits >> bit & 1]
+
+class StoryState:
+    """Типизированный доступ к битам прогресса сюжета из записи игрока
+
+    Лежит в player["story_state"]. Только читает: записи идут через
+    set_story_flag и complete_chapter хранилища, которые ставят бит одним UPDATE.
+    """
+
+    __slots__ = ("flag_bits", "chapter_bits")
+
+    def __init__(self, flag_bits=0, chapter_bits=0):
+        self.flag_bits = flag_bits
+        self.chapter_bits = chapter_bits
+
+    def has_flag(self, name):
+        return bool(self.flag_bits & flag_mask(name))
+
+    def is_chapter_completed(self, chapter):
+        return bool(self.chapter_bits & chapter_mask(chapter))
+
+    def flags(self):
+        return _names(self.flag_bits, STORY_FLAGS)
+
+    def completed_chapters(self):
+        return _names(self.chapter_bits, CHAPTERS)
+
+    def chapters_completed(self):
+        return bin(self.chapter_bits).count("1")
+
+    def __repr__(self):
+        return f"StoryState(flags={self.flags()}, chapters={self.completed_chapters()})"
+
+def story_state(story):
+    """StoryState по строке story_progress (None, если строки нет)"""
+    if story is None:
+        return None
+    return StoryState(story["flag_bits"], story["chapter_bits"])
+
+def encode_legacy_json(completed_chapters, story_flags):
+    """Перевести JSON-колонки v1 в биты
+
+    Возвращает (flag_bits, chapter_bits, остаток completed_chapters, остаток story_flags):
+    в остатке то, что не выражается битами реестра (незарегистрированные имена
+    и небулевы значения флагов), чтобы миграция ничего не теряла.
+    """
+    chapters = json.loads(completed_chapters) if completed_chapters else []
+    flags = json.loads(story_flags) if story_flags else {}
+
+    chapter_bits = 0
+    other_chapters = []
+    for chapter in chapters:
+        # Номера глав из колонки chapter приводим к идентификаторам реестра
+        chapter_id = f"chapter{chapter}" if isinstance(chapter, int) else chapter
+        if chapter_id in CHAPTER_BITS:
+            chapter_bits |= chapter_mask(chapter_id)
+        else:
+            other_chapters.append(chapter)
+
+    flag_bits = 0
+    other_flags = {}
+    for name, value in flags.items():
+        if name in FLAG_BITS and isinstance(value, bool):
+            if value:
+                flag_bits |= flag_mask(name)
+        else:
+            other_flags[name] = value
+
+    return flag_bits, chapter_bits, other_chapters, other_flags
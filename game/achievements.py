@@ -0,0 +1,102 @@
+from core.counters import progress
+from core.migrations import DEFAULT_ACHIEVEMENTS
+
+# Названия достижений для сообщений о получении
+ACHIEVEMENT_NAMES = {achievement_id: name for achievement_id, name, _ in DEFAULT_ACHIEVEMENTS}
+
+# События игры и их данные:
+#   battle_settled - song_id, score, max_combo, perfect_hits, good_hits, bad_hits
+#   money_changed  - amount
+#   choice_made    - choice, relationship
+#   chapter_completed - chapter
+#   level_up       - level, levels
+BATTLE_SETTLED = "battle_settled"
+MONEY_CHANGED = "money_changed"
+CHOICE_MADE = "choice_made"
+CHAPTER_COMPLETED = "chapter_completed"
+LEVEL_UP = "level_up"
+
+# Правила достижений: на какое событие подписано и сколько прогресса оно дает
+RULES = [
+    {
+        "achievement": "first_blood",
+        "event": BATTLE_SETTLED,
+        "amount": lambda event: 1
+    },
+    {
+        "achievement": "perfectionist",
+        "event": BATTLE_SETTLED,
+        "amount": lambda event: event["perfect_hits"]
+    },
+    {
+        "achievement": "combo_master",
+        "event": BATTLE_SETTLED,
+        "amount": lambda event: event["max_combo"]
+    },
+    {
+        "achievement": "boss_slayer",
+        "event": BATTLE_SETTLED,
+        "amount": lambda event: 1 if event["song_id"] == "final_boss" else 0
+    },
+    {
+        "achievement": "note_collector",
+        "event": BATTLE_SETTLED,
+        "amount": lambda event: event["perfect_hits"] + event["good_hits"] + event["bad_hits"]
+    },
+    {
+        "achievement": "rich_player",
+        "event": MONEY_CHANGED,
+        "amount": lambda event: max(event["amount"], 0)
+    },
+    {
+        "achievement": "pico_friend",
+        "event": CHOICE_MADE,
+        "amount": lambda event: event["relationship"]
+    },
+    {
+        "achievement": "popular",
+        "event": CHOICE_MADE,
+        "amount": lambda event: 1 if event["relationship"] > 0 else 0
+    },
+    {
+        "achievement": "story_master",
+        "event": CHAPTER_COMPLETED,
+        "amount": lambda event: 1
+    },
+    {
+        # Прогресс равен достигнутому уровню: первое повышение засчитывает и стартовый
+        "achievement": "legendary",
+        "event": LEVEL_UP,
+        "amount": lambda event: event["levels"] + (1 if event["level"] - event["levels"] == 1 else 0)
+    },
+]
+
+class AchievementRules:
+    """Движок правил достижений
+
+    Правила один раз раскладываются в индекс {событие: [правила]}, поэтому
+    событие проверяет только подписанные на него правила, а новые достижения
+    не удорожают чужие события. Прогресс пишется через write-back счетчики.
+    """
+
+    def __init__(self, counters, rules=RULES):
+        self.counters = counters
+        self.index = {}
+        for rule in rules:
+            self.index.setdefault(rule["event"], []).append(rule)
+
+    def publish(self, event_type, player_id, **event):
+        """Опубликовать событие, возвращает id только что завершенных достижений"""
+        completed = []
+        for rule in self.index.get(event_type, ()):
+            amount = rule["amount"](event)
+            if not amount:
+                continue
+            achievement_id = rule["achievement"]
+            already_done = self.counters.add_achievement(player_id, achievement_id, 0)
+            if not already_done and self.counters.add_achievement(player_id, achievement_id, amount):
+                completed.append(achievement_id)
+        return completed
+
+# Глобальный движок правил
+achievement_rules = AchievementRules(progress)
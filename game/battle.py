@@ -1,6 +1,151 @@
+import bisect
 import random
+import struct
 import time
-from datetime import datetime
+from array import array
+import config
+from game.charts import ARROWS, arrows_mask, get_chart, mask_arrows
+
+# Итог ноты в BattleState.results
+RESULT_PENDING = 0
+RESULT_PERFECT = 1
+RESULT_GOOD = 2
+RESULT_BAD = 3
+RESULT_MISSED = 4
+
+# Границы окон точности по возрастанию и оценка для каждого окна (последняя - за границами)
+TIMING_BOUNDS = [config.PERFECT_TIMING_WINDOW, config.GOOD_TIMING_WINDOW]
+TIMING_JUDGEMENTS = ['perfect', 'good', 'bad']
+
+# Итог, очки и продление комбо для попадания с оценкой тайминга (иначе - как bad)
+HIT_SCORING = {
+    'perfect': (RESULT_PERFECT, 100, True),
+    'good': (RESULT_GOOD, 50, True),
+    'bad': (RESULT_BAD, 10, False),
+}
+
+# Код оценки тайминга - номер в TIMING_JUDGEMENTS (неизвестная оценка считается как bad)
+JUDGEMENT_CODES = {judgement: code for code, judgement in enumerate(TIMING_JUDGEMENTS)}
+
+# Ввод ноты в BattleState.inputs: маска нажатых стрелок в младших 4 битах
+# (0 - нераспознанный ввод, он не совпадает ни с одной нотой), код оценки выше
+INPUT_MASK = 0x0F
+JUDGEMENT_SHIFT = 4
+
+# Сохраненное состояние: версия, 8 счетчиков, счет, секунды с начала битвы,
+# затем по байту итога и по байту ввода на каждую уже сыгранную ноту
+STATE_VERSION = 2
+STATE_HEADER = struct.Struct("<B8HIf")
+
+# Повтор битвы для battle_history: версия, seed карты, число нот, затем байты ввода
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<BHH")
+
+def pack_input(mask, timing_accuracy):
+    """Байт ввода ноты из маски стрелок и оценки тайминга"""
+    code = JUDGEMENT_CODES.get(timing_accuracy, JUDGEMENT_CODES['bad'])
+    return (mask if mask > 0 else 0) | code << JUDGEMENT_SHIFT
+
+def unpack_replay(replay):
+    """(seed, байты ввода) из повтора или None, если формат не подходит"""
+    if len(replay) < REPLAY_HEADER.size or replay[0] != REPLAY_VERSION:
+        return None
+    _, seed, notes = REPLAY_HEADER.unpack_from(replay)
+    inputs = replay[REPLAY_HEADER.size:]
+    return (seed, inputs) if len(inputs) == notes else None
+
+class BattleState:
+    """Состояние одной битвы игрока
+
+    Счетчики - атрибуты в __slots__ (без __dict__ на каждую битву), ноты
+    берутся из общей карты chart, а итог и ввод каждой ноты - байты в массивах
+    results и inputs. По seed и inputs битву можно переиграть (replay).
+    """
+
+    __slots__ = (
+        "player_id", "song_id", "song_name", "total_notes", "energy_cost", "chart", "seed", "results", "inputs",
+        "current_note", "notes_hit", "perfect_hits", "good_hits", "bad_hits", "missed",
+        "combo", "max_combo", "score", "start_time", "last_input", "latency", "battle_duration", "completed"
+    )
+
+    def __init__(self, player_id, song_id, song, chart, seed):
+        self.player_id = player_id
+        self.song_id = song_id
+        self.song_name = song['name']
+        self.total_notes = song['notes']
+        self.energy_cost = song['energy_cost']
+        self.chart = chart
+        self.seed = seed
+        self.results = array('B', bytes(song['notes']))
+        self.inputs = array('B', bytes(song['notes']))
+        self.current_note = 0
+        self.notes_hit = 0
+        self.perfect_hits = 0
+        self.good_hits = 0
+        self.bad_hits = 0
+        self.missed = 0
+        self.combo = 0
+        self.max_combo = 0
+        self.score = 0
+        self.start_time = time.monotonic()
+        # Момент предыдущего нажатия для оценки тайминга; до первого нажатия - None,
+        # иначе в первый промежуток попадет время, пока игрок читал экран старта
+        self.last_input = None
+        self.latency = None  # сглаженная задержка игрока (см. game/timing.py), None - замеров нет
+        self.battle_duration = 0.0
+        self.completed = False
+
+    def as_record(self):
+        """Поля для settle_battle / battle_history"""
+        return {
+            'song_id': self.song_id,
+            'score': self.score,
+            'max_combo': self.max_combo,
+            'perfect_hits': self.perfect_hits,
+            'good_hits': self.good_hits,
+            'bad_hits': self.bad_hits,
+            'missed': self.missed,
+            'battle_duration': self.battle_duration,
+            'replay': self.replay()
+        }
+
+    def replay(self):
+        """Компактный повтор: seed карты и упакованные ввод и оценка каждой сыгранной ноты"""
+        return REPLAY_HEADER.pack(REPLAY_VERSION, self.seed, self.current_note) + self.inputs[:self.current_note].tobytes()
+
+    def to_bytes(self):
+        """Компактное состояние для active_battles (карта восстанавливается по song_id и seed)"""
+        # Вызывается в потоке писателя, пока обработчики меняют битву: число нот
+        # читается один раз, чтобы заголовок и срезы всегда совпадали по длине
+        played = self.current_note
+        elapsed = self.battle_duration if self.completed else time.monotonic() - self.start_time
+        header = STATE_HEADER.pack(
+            STATE_VERSION, played, self.notes_hit, self.perfect_hits, self.good_hits,
+            self.bad_hits, self.missed, self.combo, self.max_combo, self.score, elapsed
+        )
+        return header + self.results[:played].tobytes() + self.inputs[:played].tobytes()
+
+    def load_bytes(self, data):
+        """Продолжить битву с сохраненного состояния, False если формат не подходит"""
+        if len(data) < STATE_HEADER.size or data[0] != STATE_VERSION:
+            return False
+        fields = STATE_HEADER.unpack_from(data)
+        played = fields[1]
+        if played > self.total_notes or len(data) != STATE_HEADER.size + 2 * played:
+            return False
+        (_, self.current_note, self.notes_hit, self.perfect_hits, self.good_hits, self.bad_hits,
+         self.missed, self.combo, self.max_combo, self.score, elapsed) = fields
+        self.results[:played] = array('B', data[STATE_HEADER.size:STATE_HEADER.size + played])
+        self.inputs[:played] = array('B', data[STATE_HEADER.size + played:])
+        # Время простоя между сохранением и перезапуском в длительность не входит
+        self.start_time = time.monotonic() - elapsed
+        if played == self.total_notes:
+            # Сохранено между последней нотой и finish(), пока шел settle_battle
+            self.completed = True
+            self.battle_duration = elapsed
+        # Отсчет ритма начнется заново со следующего нажатия
+        self.last_input = None
+        return True
 
 class RhythmBattleSystem:
     def __init__(self):
@@ -35,7 +180,7 @@ class RhythmBattleSystem:
             }
         }
         
-        self.arrows = ['←', '→', '↑', '↓']
+        self.arrows = ARROWS
         
     def start_battle(self, player_id, song_id):
         """Начать битву"""
@@ -43,124 +188,145 @@ class RhythmBattleSystem:
             return None
             
         song = self.songs[song_id]
-        patterns = self.generate_note_patterns(song['notes'], song['difficulty'])
-        
-        battle_data = {
-            'song_id': song_id,
-            'song_name': song['name'],
-            'total_notes': song['notes'],
-            'notes_hit': 0,
-            'perfect_hits': 0,
-            'good_hits': 0,
-            'bad_hits': 0,
-            'missed': 0,
-            'combo': 0,
-            'max_combo': 0,
-            'score': 0,
-            'patterns': patterns,
-            'current_note': 0,
-            'start_time': datetime.now(),
-            'completed': False,
-            'energy_cost': song['energy_cost']
-        }
+        # Битва ссылается на общую карту из кэша, а не держит свою копию нот
+        seed = random.randrange(config.BATTLE_CHART_VARIANTS)
         
-        return battle_data
+        return BattleState(player_id, song_id, song, self.get_chart(song_id, seed), seed)
     
-    def generate_note_patterns(self, note_count, difficulty):
-        """Генерация паттернов нот"""
-        patterns = []
-        
-        for i in range(note_count):
-            if difficulty == 1:
-                # Легко: только одиночные ноты
-                pattern = [random.choice(self.arrows)]
-            elif difficulty == 2:
-                # Средне: 80% одиночные, 20% двойные
-                if random.random() < 0.2:
-                    pattern = random.sample(self.arrows, 2)
-                else:
-                    pattern = [random.choice(self.arrows)]
-            elif difficulty == 3:
-                # Сложно: 60% одиночные, 30% двойные, 10% тройные
-                rand = random.random()
-                if rand < 0.1:
-                    pattern = random.sample(self.arrows, 3)
-                elif rand < 0.4:
-                    pattern = random.sample(self.arrows, 2)
-                else:
-                    pattern = [random.choice(self.arrows)]
-            elif difficulty >= 4:
-                # Очень сложно: сложные паттерны
-                pattern_length = random.randint(1, min(4, difficulty))
-                pattern = [random.choice(self.arrows) for _ in range(pattern_length)]
-            
-            patterns.append({
-                'id': i,
-                'arrows': pattern,
-                'timing': i * 0.8,  # Нота каждые 0.8 секунд
-                'hit': None,
-                'score': 0
-            })
-        
-        return patterns
+    def restore_battle(self, player_id, song_id, seed, state):
+        """Битва из сохраненного состояния или None, если песни больше нет или формат устарел"""
+        song = self.songs.get(song_id)
+        if song is None:
+            return None
+        battle = BattleState(player_id, song_id, song, self.get_chart(song_id, seed), seed)
+        return battle if battle.load_bytes(state) else None
     
-    def process_note_input(self, battle_data, player_input, timing_accuracy):
+    def replay_battle(self, player_id, song_id, replay):
+        """Переиграть повтор через process_note_input, None если песни нет или формат не подходит"""
+        song = self.songs.get(song_id)
+        unpacked = unpack_replay(replay)
+        if song is None or unpacked is None or len(unpacked[1]) > song['notes']:
+            return None
+        seed, inputs = unpacked
+        battle = BattleState(player_id, song_id, song, self.get_chart(song_id, seed), seed)
+        for packed in inputs:
+            judgement = TIMING_JUDGEMENTS[min(packed >> JUDGEMENT_SHIFT, len(TIMING_JUDGEMENTS) - 1)]
+            self.process_note_input(battle, mask_arrows(packed & INPUT_MASK), judgement)
+        return battle
+    
+    def get_chart(self, song_id, seed):
+        """Общая нотная карта песни для варианта seed"""
+        song = self.songs[song_id]
+        return get_chart(song_id, song['notes'], song['difficulty'], seed)
+    
+    def process_note_input(self, battle, player_input, timing_accuracy):
         """Обработать ввод ноты игроком"""
-        if battle_data['current_note'] >= battle_data['total_notes']:
-            return battle_data
-            
-        current_note = battle_data['patterns'][battle_data['current_note']]
+        index = battle.current_note
+        if index >= battle.total_notes:
+            return battle
         
         # Проверяем правильность ввода
-        if set(player_input) == set(current_note['arrows']):
-            if timing_accuracy == 'perfect':
-                score = 100
-                battle_data['perfect_hits'] += 1
-                battle_data['combo'] += 1
-            elif timing_accuracy == 'good':
-                score = 50  
-                battle_data['good_hits'] += 1
-                battle_data['combo'] += 1
-            else:  # bad
-                score = 10
-                battle_data['bad_hits'] += 1
-                battle_data['combo'] = 0
+        mask = arrows_mask(player_input)
+        if mask == battle.chart.masks[index]:
+            result, score, keeps_combo = HIT_SCORING.get(timing_accuracy, HIT_SCORING['bad'])
+            if result == RESULT_PERFECT:
+                battle.perfect_hits += 1
+            elif result == RESULT_GOOD:
+                battle.good_hits += 1
+            else:
+                battle.bad_hits += 1
+            battle.combo = battle.combo + 1 if keeps_combo else 0
         else:
             score = 0
-            battle_data['missed'] += 1
-            battle_data['combo'] = 0
+            result = RESULT_MISSED
+            battle.missed += 1
+            battle.combo = 0
         
         # Обновляем статистику
-        battle_data['score'] += score * battle_data['combo']
-        battle_data['notes_hit'] += 1
-        battle_data['max_combo'] = max(battle_data['max_combo'], battle_data['combo'])
-        battle_data['current_note'] += 1
+        battle.results[index] = result
+        battle.inputs[index] = pack_input(mask, timing_accuracy)
+        battle.score += score * battle.combo
+        battle.notes_hit += 1
+        if battle.combo > battle.max_combo:
+            battle.max_combo = battle.combo
+        battle.current_note = index + 1
         
         # Проверяем завершение битвы
-        if battle_data['current_note'] >= battle_data['total_notes']:
-            battle_data['completed'] = True
-            battle_data['end_time'] = datetime.now()
-            duration = (battle_data['end_time'] - battle_data['start_time']).total_seconds()
-            battle_data['battle_duration'] = duration
+        if battle.current_note >= battle.total_notes:
+            battle.completed = True
+            battle.battle_duration = time.monotonic() - battle.start_time
             
-        return battle_data
+        return battle
     
-    def calculate_timing_accuracy(self, timing_difference):
-        """Рассчитать точность тайминга"""
-        if timing_difference <= 0.1:
-            return 'perfect'
-        elif timing_difference <= 0.3:
-            return 'good'
+    def process_phrase(self, battle, masks, timing_accuracy):
+        """Обработать фразу из нескольких нот за один проход
+
+        masks - маски стрелок по порядку начиная с текущей ноты (лишние
+        отбрасываются), timing_accuracy - одна оценка на всю фразу. Счет и
+        комбо считаются так же, как при вводе тех же нот по одной через
+        process_note_input, но счетчики битвы обновляются один раз.
+        """
+        index = battle.current_note
+        end = min(index + len(masks), battle.total_notes)
+        if index >= end:
+            return battle
+        
+        result, points, keeps_combo = HIT_SCORING.get(timing_accuracy, HIT_SCORING['bad'])
+        code = JUDGEMENT_CODES.get(timing_accuracy, JUDGEMENT_CODES['bad']) << JUDGEMENT_SHIFT
+        chart_masks = battle.chart.masks
+        results = battle.results
+        inputs = battle.inputs
+        combo = battle.combo
+        max_combo = battle.max_combo
+        score = battle.score
+        hits = 0
+        
+        for note, mask in zip(range(index, end), masks):
+            inputs[note] = mask | code
+            if mask == chart_masks[note]:
+                results[note] = result
+                hits += 1
+                if keeps_combo:
+                    combo += 1
+                    score += points * combo
+                    if combo > max_combo:
+                        max_combo = combo
+                else:
+                    combo = 0
+            else:
+                results[note] = RESULT_MISSED
+                combo = 0
+        
+        if result == RESULT_PERFECT:
+            battle.perfect_hits += hits
+        elif result == RESULT_GOOD:
+            battle.good_hits += hits
         else:
-            return 'bad'
+            battle.bad_hits += hits
+        battle.missed += end - index - hits
+        battle.notes_hit += end - index
+        battle.combo = combo
+        battle.max_combo = max_combo
+        battle.score = score
+        battle.current_note = end
+        
+        if end >= battle.total_notes:
+            battle.completed = True
+            battle.battle_duration = time.monotonic() - battle.start_time
+        
+        return battle
+    
+    def calculate_timing_accuracy(self, timing_difference):
+        """Рассчитать точность тайминга (бинарный поиск по границам окон)"""
+        return TIMING_JUDGEMENTS[bisect.bisect_left(TIMING_BOUNDS, abs(timing_difference))]
     
-    def get_battle_summary(self, battle_data):
+    def get_battle_summary(self, battle):
         """Получить статистику битвы"""
-        if not battle_data['completed']:
+        if not battle.completed:
             return None
             
-        accuracy = (battle_data['notes_hit'] / battle_data['total_notes']) * 100
-        perfect_percentage = (battle_data['perfect_hits'] / battle_data['total_notes']) * 100
+        accuracy = (battle.notes_hit / battle.total_notes) * 100
+        perfect_percentage = (battle.perfect_hits / battle.total_notes) * 100
         
         grade = "F"
         if accuracy >= 90:
@@ -173,19 +339,19 @@ class RhythmBattleSystem:
             grade = "D"
             
         return {
-            'song_name': battle_data['song_name'],
-            'total_notes': battle_data['total_notes'],
-            'notes_hit': battle_data['notes_hit'],
-            'perfect_hits': battle_data['perfect_hits'],
-            'good_hits': battle_data['good_hits'],
-            'bad_hits': battle_data['bad_hits'],
-            'missed': battle_data['missed'],
-            'max_combo': battle_data['max_combo'],
-            'score': battle_data['score'],
+            'song_name': battle.song_name,
+            'total_notes': battle.total_notes,
+            'notes_hit': battle.notes_hit,
+            'perfect_hits': battle.perfect_hits,
+            'good_hits': battle.good_hits,
+            'bad_hits': battle.bad_hits,
+            'missed': battle.missed,
+            'max_combo': battle.max_combo,
+            'score': battle.score,
             'accuracy': round(accuracy, 1),
             'perfect_percentage': round(perfect_percentage, 1),
             'grade': grade,
-            'duration': round(battle_data['battle_duration'], 1)
+            'duration': round(battle.battle_duration, 1)
         }
 
 # Глобальный экземпляр системы боев
@@ -0,0 +1,196 @@
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+from core.database import database
+from game.battle import battle_system
+import config
+
+logger = logging.getLogger(__name__)
+
+class BattleSessions:
+    """Незавершенные битвы игроков с вытеснением брошенных и сохранением в базу
+
+    Срок простоя отслеживает куча (срок, поколение, telegram_id) с ленивым
+    продлением: ввод только обновляет время последнего действия, а при
+    извлечении из кучи запись с продленным сроком возвращается обратно.
+    Поколение записи меняется с каждой новой битвой игрока, поэтому записи
+    законченных битв отбрасываются, а не продлеваются вместе с новой. Так
+    вытеснение смотрит только на истекшие записи, без обхода всех битв, а в
+    куче нет ничего, кроме текущих битв и битв, законченных за последние ttl
+    секунд.
+
+    Состояние изменившихся битв пишется в active_battles пачкой по таймеру
+    (config.BATTLE_PERSIST_SECONDS) и сразу при старте битвы, когда энергия
+    уже списана. После перезапуска restore() поднимает битвы из базы, и игрок
+    продолжает с той же ноты.
+    """
+
+    def __init__(self, db, ttl_seconds=config.BATTLE_IDLE_TTL_SECONDS, clock=time.monotonic):
+        self.db = db
+        self.ttl = ttl_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.battles = {}  # {telegram_id: BattleState}
+        self.last_seen = {}  # {telegram_id: время последнего действия}
+        self.deadlines = []  # куча (срок, поколение, telegram_id)
+        self.generations = {}  # {telegram_id: поколение записи текущей битвы в куче}
+        self.next_generation = itertools.count()
+        self.dirty = set()  # telegram_id битв, которые надо сохранить
+        self.ended = set()  # player_id битв, которые надо удалить из базы
+        self.counters = {
+            "started": 0,
+            "completed": 0,
+            "fled": 0,
+            "evicted": 0,
+            "resumed": 0,
+            "saved": 0,
+        }
+
+    def start(self, telegram_id, battle):
+        """Новая битва игрока (прежняя незавершенная заменяется)"""
+        with self.lock:
+            previous = self.battles.get(telegram_id)
+            if previous is not None and previous.player_id != battle.player_id:
+                self.ended.add(previous.player_id)
+            self._add(telegram_id, battle)
+            self.ended.discard(battle.player_id)
+            self.counters["started"] += 1
+        return battle
+
+    def get(self, telegram_id):
+        """Битва игрока или None; обращение продлевает срок и помечает ее к сохранению"""
+        with self.lock:
+            battle = self.battles.get(telegram_id)
+            if battle is not None:
+                self.last_seen[telegram_id] = self.clock()
+                self.dirty.add(telegram_id)
+            return battle
+
+    def finish(self, telegram_id, reason="completed"):
+        """Убрать битву (reason: completed или fled), возвращает ее или None"""
+        with self.lock:
+            battle = self._drop(telegram_id)
+            if battle is not None:
+                self.counters[reason] += 1
+            return battle
+
+    def evict_expired(self):
+        """Вытеснить битвы без ввода дольше ttl, возвращает их число"""
+        now = self.clock()
+        evicted = 0
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, generation, telegram_id = heapq.heappop(self.deadlines)
+                if self.generations.get(telegram_id) != generation:
+                    # Запись законченной битвы
+                    continue
+                deadline = self.last_seen[telegram_id] + self.ttl
+                if deadline > now:
+                    # Был ввод после постановки в кучу - продлеваем
+                    heapq.heappush(self.deadlines, (deadline, generation, telegram_id))
+                    continue
+                self._drop(telegram_id)
+                evicted += 1
+            self.counters["evicted"] += evicted
+        return evicted
+
+    def flush(self):
+        """Записать изменившиеся битвы и удалить законченные, возвращает число записей"""
+        with self.lock:
+            ended, self.ended = self.ended, set()
+            dirty, self.dirty = self.dirty, set()
+            rows = [
+                (battle.player_id, telegram_id, battle.song_id, battle.seed, battle.to_bytes())
+                for telegram_id, battle in ((telegram_id, self.battles.get(telegram_id)) for telegram_id in dirty)
+                if battle is not None
+            ]
+
+        try:
+            # Сначала удаления: битва могла закончиться и начаться заново между сбросами
+            if ended:
+                self.db.delete_battles(list(ended))
+            if rows:
+                self.db.save_battles(rows)
+        except Exception:
+            # Вернем изменения, чтобы записать их в следующий раз
+            with self.lock:
+                self.ended |= ended - {battle.player_id for battle in self.battles.values()}
+                self.dirty |= dirty & self.battles.keys()
+            raise
+
+        with self.lock:
+            self.counters["saved"] += len(rows)
+        return len(rows) + len(ended)
+
+    def restore(self):
+        """Поднять сохраненные битвы после перезапуска, возвращает их число"""
+        restored = 0
+        stale = []
+        finished = 0
+        for player_id, telegram_id, song_id, seed, state in self.db.load_battles():
+            battle = battle_system.restore_battle(player_id, song_id, seed, state)
+            if battle is None:
+                stale.append(player_id)
+                continue
+            if battle.completed:
+                # Все ноты сыграны, процесс упал до finish(). settle_battle мог уже
+                # записать итог, поэтому повторно не рассчитываем (награды не
+                # удваиваются); если он не успел, результат этой битвы теряется
+                stale.append(player_id)
+                finished += 1
+                continue
+            with self.lock:
+                self._add(telegram_id, battle)
+            restored += 1
+
+        if stale:
+            self.db.delete_battles(stale)
+        with self.lock:
+            self.counters["resumed"] += restored
+        if restored or stale:
+            logger.info(
+                f"Восстановлено незавершенных битв: {restored}, отброшено устаревших: {len(stale) - finished}, "
+                f"сыгранных до конца: {finished}"
+            )
+        return restored
+
+    def stats(self):
+        """Счетчики и оценка памяти под битвы в байтах"""
+        with self.lock:
+            memory = sum(
+                sys.getsizeof(battle) + sys.getsizeof(battle.results) + sys.getsizeof(battle.inputs) for battle in self.battles.values()
+            )
+            return {
+                **self.counters,
+                "active": len(self.battles),
+                "heap": len(self.deadlines),
+                "pending_saves": len(self.dirty),
+                "memory_bytes": memory,
+            }
+
+    def _add(self, telegram_id, battle):
+        now = self.clock()
+        if telegram_id not in self.battles:
+            generation = next(self.next_generation)
+            self.generations[telegram_id] = generation
+            heapq.heappush(self.deadlines, (now + self.ttl, generation, telegram_id))
+        self.battles[telegram_id] = battle
+        self.last_seen[telegram_id] = now
+        self.dirty.add(telegram_id)
+
+    def _drop(self, telegram_id):
+        battle = self.battles.pop(telegram_id, None)
+        if battle is None:
+            return None
+        del self.last_seen[telegram_id]
+        del self.generations[telegram_id]
+        self.dirty.discard(telegram_id)
+        self.ended.add(battle.player_id)
+        # Запись в куче остается и отбрасывается при извлечении (поколения больше нет)
+        return battle
+
+# Глобальное хранилище битв
+battle_sessions = BattleSessions(database)
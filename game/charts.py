@@ -0,0 +1,118 @@
+import random
+from array import array
+from functools import lru_cache
+import config
+
+ARROWS = ['←', '→', '↑', '↓']
+
+# Бит стрелки в маске ноты. Кнопки битвы присылают названия (arrow_left),
+# поэтому они отображаются на те же биты, что и символы
+ARROW_BITS = {arrow: 1 << bit for bit, arrow in enumerate(ARROWS)}
+ARROW_BITS.update({name: ARROW_BITS[arrow] for name, arrow in zip(["left", "right", "up", "down"], ARROWS)})
+
+NOTE_INTERVAL_MS = 800  # нота каждые 0.8 секунды
+
+def arrows_mask(arrows):
+    """Маска набора стрелок; неизвестная стрелка дает -1, которая не совпадет ни с одной нотой"""
+    mask = 0
+    for arrow in arrows:
+        bit = ARROW_BITS.get(arrow)
+        if bit is None:
+            return -1
+        mask |= bit
+    return mask
+
+def mask_arrows(mask):
+    return [arrow for arrow in ARROWS if mask & ARROW_BITS[arrow]]
+
+# Символы фразы, набранной текстом: стрелки или первые буквы направлений
+PHRASE_BITS = {arrow: ARROW_BITS[arrow] for arrow in ARROWS}
+PHRASE_BITS.update({letter: ARROW_BITS[arrow] for letter, arrow in zip("lrud", ARROWS)})
+PHRASE_BITS.update({letter: ARROW_BITS[arrow] for letter, arrow in zip("лпвн", ARROWS)})
+
+def parse_phrase(text):
+    """Маски нот фразы "← →↑ ↓" (ноты через пробел, аккорд - слитно) или None, если есть чужие символы"""
+    masks = []
+    for token in text.lower().split():
+        mask = 0
+        for char in token:
+            bit = PHRASE_BITS.get(char)
+            if bit is None:
+                return None
+            mask |= bit
+        masks.append(mask)
+    return masks or None
+
+def phrase_text(masks):
+    """Фраза для показа игроку в том же формате, что принимает parse_phrase"""
+    return " ".join("".join(mask_arrows(mask)) for mask in masks)
+
+class Chart:
+    """Нотная карта песни: маска стрелок и время каждой ноты в плоских массивах
+
+    Карты общие для всех битв с тем же (song_id, difficulty, seed) и живут
+    в LRU-кэше get_chart, поэтому их массивы нельзя менять.
+    """
+
+    __slots__ = ("song_id", "difficulty", "seed", "masks", "timings_ms")
+
+    def __init__(self, song_id, difficulty, seed, masks, timings_ms):
+        self.song_id = song_id
+        self.difficulty = difficulty
+        self.seed = seed
+        self.masks = masks  # array('B'): биты стрелок ноты
+        self.timings_ms = timings_ms  # array('I'): миллисекунды от начала песни
+
+    def __len__(self):
+        return len(self.masks)
+
+    def arrows(self, index):
+        """Стрелки ноты для показа игроку"""
+        return mask_arrows(self.masks[index])
+
+    def timing(self, index):
+        """Время ноты в секундах"""
+        return self.timings_ms[index] / 1000
+
+    def nbytes(self):
+        return self.masks.itemsize * len(self.masks) + self.timings_ms.itemsize * len(self.timings_ms)
+
+def generate_chart(song_id, note_count, difficulty, seed):
+    """Сгенерировать карту; одни и те же аргументы всегда дают одну и ту же карту"""
+    # Строковое зерно хэшируется детерминированно, без PYTHONHASHSEED
+    rng = random.Random(f"{song_id}:{difficulty}:{seed}")
+    masks = array('B', bytes(note_count))
+
+    for i in range(note_count):
+        if difficulty == 1:
+            # Легко: только одиночные ноты
+            pattern = [rng.choice(ARROWS)]
+        elif difficulty == 2:
+            # Средне: 80% одиночные, 20% двойные
+            if rng.random() < 0.2:
+                pattern = rng.sample(ARROWS, 2)
+            else:
+                pattern = [rng.choice(ARROWS)]
+        elif difficulty == 3:
+            # Сложно: 60% одиночные, 30% двойные, 10% тройные
+            rand = rng.random()
+            if rand < 0.1:
+                pattern = rng.sample(ARROWS, 3)
+            elif rand < 0.4:
+                pattern = rng.sample(ARROWS, 2)
+            else:
+                pattern = [rng.choice(ARROWS)]
+        else:
+            # Очень сложно: сложные паттерны (повторы стрелок сливаются в маске)
+            pattern_length = rng.randint(1, min(4, difficulty))
+            pattern = [rng.choice(ARROWS) for _ in range(pattern_length)]
+
+        masks[i] = arrows_mask(pattern)
+
+    timings_ms = array('I', range(0, note_count * NOTE_INTERVAL_MS, NOTE_INTERVAL_MS))
+    return Chart(song_id, difficulty, seed, masks, timings_ms)
+
+@lru_cache(maxsize=config.BATTLE_CHART_CACHE_SIZE)
+def get_chart(song_id, note_count, difficulty, seed):
+    """Карта из LRU-кэша (статистика - get_chart.cache_info())"""
+    return generate_chart(song_id, note_count, difficulty, seed)
@@ -1,17 +1,37 @@
 import sqlite3
 import json
 import random
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from core.counters import progress, ProgressCounters
 from core.database import database
+from core.story_state import FLAG_BITS
+from game.achievements import (
+    achievement_rules, AchievementRules, BATTLE_SETTLED, MONEY_CHANGED, CHOICE_MADE, CHAPTER_COMPLETED, LEVEL_UP
+)
+from game.battle import battle_system
+from game.leaderboard import leaderboards, Leaderboards
 
 class GameEngine:
-    def __init__(self):
-        self.db = database
-        self.energy_cooldown = 5  # минут на 1 энергию
+    def __init__(self, db=None):
+        # По умолчанию - общая база бота; другое хранилище (GameStorage) получает свои
+        # счетчики прогресса и рейтинги, чтобы ничего не писать в общую базу
+        if db is None:
+            self.db = database
+            self.progress = progress
+            self.achievements = achievement_rules
+            self.leaderboards = leaderboards
+        else:
+            self.db = db
+            self.progress = ProgressCounters(db)
+            self.achievements = AchievementRules(self.progress)
+            self.leaderboards = Leaderboards(db, battle_system.songs)
         
-    def calculate_play_time(self, player_id):
+    def calculate_play_time(self, telegram_id):
         """Рассчитать игровое время"""
-        player = self.db.get_player(player_id)
+        return self.play_time(self.db.get_player(telegram_id))
+    
+    def play_time(self, player):
+        """Игровое время по уже загруженной записи игрока"""
         if player and player.get('stats'):
             base_time = 180 + 60  # 3+1 часа основного контента
             endgame_minutes = player['stats'].get('total_play_time', 0)
@@ -23,9 +43,10 @@ class GameEngine:
             }
         return {"main_story": 0, "side_quests": 0, "endgame": 0, "total": 0}
     
-    def generate_daily_quests(self, player_id):
-        """Генерация ежедневных заданий"""
-        today = datetime.now().date()
+    def daily_quest_rows(self, player_id, today):
+        """Строки active_quests с ежедневными заданиями игрока на дату (UTC)"""
+        # Задания живут до конца дня, потом их удаляет ежедневная ротация
+        expires_at = f"{today + timedelta(days=1)} 00:00:00"
         
         daily_quests = [
             {
@@ -60,49 +81,45 @@ class GameEngine:
             }
         ]
         
-        created_count = 0
-        for quest in daily_quests:
-            if self.db.add_quest(player_id, quest["quest_id"], quest["quest_type"], quest["target"]):
-                created_count += 1
-                
-        return created_count
+        return [
+            (player_id, quest["quest_id"], quest["quest_type"], quest["target"], expires_at)
+            for quest in daily_quests
+        ]
     
-    def check_energy(self, player_id):
-        """Проверка и восстановление энергии"""
-        player_data = self.db.get_player(player_id)
-        if not player_data:
+    def generate_daily_quests(self, player_id):
+        """Генерация ежедневных заданий"""
+        today = datetime.now(timezone.utc).date()
+        # Накопленный прогресс относится к старым квестам - пишем его до выдачи новых
+        self.progress.forget_quests(player_id)
+        with self.db.transaction(player_id):
+            # Ротация выдает задания тем, кто был активен, - /daily тоже считается
+            self.db.touch_activity(player_id)
+            return self.db.add_quests_bulk(self.daily_quest_rows(player_id, today))
+    
+    def generate_daily_quests_for(self, player_ids):
+        """Ежедневные задания сразу для пачки игроков одной транзакцией"""
+        today = datetime.now(timezone.utc).date()
+        self.progress.forget_quests()
+        rows = []
+        for player_id in player_ids:
+            rows.extend(self.daily_quest_rows(player_id, today))
+        return self.db.add_quests_bulk(rows)
+    
+    def check_energy(self, telegram_id):
+        """Текущая энергия с учетом восстановления (без записи в БД)"""
+        player = self.db.get_player(telegram_id)
+        if not player:
             return 0
-            
-        player = player_data
-        current_energy = player['energy']
-        max_energy = player['max_energy']
-        
-        if current_energy >= max_energy:
-            return current_energy
-            
-        # Восстанавливаем энергию со временем
-        last_update = datetime.fromisoformat(player['last_energy_update'])
-        time_diff = datetime.now() - last_update
-        energy_gain = int(time_diff.total_seconds() // (self.energy_cooldown * 60))
-        
-        if energy_gain > 0:
-            new_energy = min(max_energy, current_energy + energy_gain)
-            self.db.update_energy(player_id, new_energy)
-            return new_energy
-            
-        return current_energy
+        return player['energy']
     
-    def use_energy(self, player_id, amount):
+    def use_energy(self, telegram_id, amount):
         """Использовать энергию"""
-        current_energy = self.check_energy(player_id)
-        
-        if current_energy >= amount:
-            new_energy = current_energy - amount
-            self.db.update_energy(player_id, new_energy)
-            return True
-        return False
+        player = self.db.get_player(telegram_id)
+        if not player:
+            return False
+        return self.db.spend_energy(player['id'], amount)
     
-    def calculate_battle_rewards(self, player_id, score, max_combo, perfect_hits):
+    def calculate_battle_rewards(self, score, max_combo, perfect_hits):
         """Рассчитать награды за битву"""
         base_exp = 50
         base_money = 25
@@ -111,27 +128,58 @@ class GameEngine:
         exp_bonus = (score // 1000) + (max_combo // 10) + (perfect_hits * 2)
         money_bonus = (score // 2000) + (max_combo // 20) + (perfect_hits * 1)
         
-        total_exp = base_exp + exp_bonus
-        total_money = base_money + money_bonus
+        return {
+            "exp": base_exp + exp_bonus,
+            "money": base_money + money_bonus
+        }
+    
+    def settle_battle(self, player_id, battle):
+        """Записать битву и выдать награды одной транзакцией"""
+        rewards = self.calculate_battle_rewards(
+            battle.score, battle.max_combo, battle.perfect_hits
+        )
         
-        # Добавляем награды
-        self.db.add_experience(player_id, total_exp)
-        self.db.add_money(player_id, total_money)
+        quests = {
+            "battle": 1,
+            "collection": battle.perfect_hits,
+        }
         
-        # Обновляем достижения
-        self.db.update_achievement_progress(player_id, "first_blood")
-        self.db.update_achievement_progress(player_id, "perfectionist", perfect_hits)
-        self.db.update_achievement_progress(player_id, "combo_master", max_combo)
+        # В транзакцию входят история, повтор, статистика, награды и лучшие результаты.
+        # Прогресс квестов и достижений намеренно вне ее - в write-back счетчиках:
+        # завершения пишутся сразу, а при падении процесса теряется не больше
+        # PROGRESS_FLUSH_SECONDS незавершающего прогресса (см. ProgressCounters)
+        result = self.db.settle_battle(player_id, battle.as_record(), rewards["exp"], rewards["money"])
+        for quest_type, amount in quests.items():
+            self.progress.add_quest(player_id, quest_type, amount)
+        self.leaderboards.record(
+            player_id, battle.song_id, result["best_score"], result["best_score_total"]
+        )
         
-        # Обновляем прогресс квестов
-        self.db.update_quest_progress(player_id, "battle")
-        self.db.update_quest_progress(player_id, "collection", perfect_hits)
+        unlocked = self.achievements.publish(
+            BATTLE_SETTLED, player_id,
+            song_id=battle.song_id,
+            score=battle.score,
+            max_combo=battle.max_combo,
+            perfect_hits=battle.perfect_hits,
+            good_hits=battle.good_hits,
+            bad_hits=battle.bad_hits
+        )
+        unlocked += self.publish_rewards(player_id, rewards["money"], result)
         
-        return {
-            "exp": total_exp,
-            "money": total_money,
-            "level_up": self.db.check_level_up(player_id)
-        }
+        rewards["level_up"] = result["level_up"]
+        rewards["achievements"] = unlocked
+        return rewards
+    
+    def publish_rewards(self, player_id, money, granted):
+        """События изменения денег и повышения уровня после выдачи наград"""
+        unlocked = []
+        if money:
+            unlocked += self.achievements.publish(MONEY_CHANGED, player_id, amount=money)
+        if granted["level_up"]:
+            unlocked += self.achievements.publish(
+                LEVEL_UP, player_id, level=granted["level_up"], levels=granted["levels_gained"]
+            )
+        return unlocked
     
     def process_story_choice(self, player_id, choice, chapter_data):
         """Обработать выбор в сюжете"""
@@ -139,72 +187,77 @@ class GameEngine:
             "exp": 0,
             "money": 0,
             "relationship": 0,
-            "unlocks": []
+            "unlocks": [],
+            "achievements": []
         }
         
-        # Награды за выбор
-        if choice == "ask_pico_past":
-            rewards["exp"] = 25
-            rewards["relationship"] = 10
-            self.db.update_relationship(player_id, "pico", 10)
+        with self.db.transaction(player_id):
+            # Награды за выбор
+            if choice == "ask_pico_past":
+                rewards["exp"] = 25
+                rewards["relationship"] = 10
+                self.db.update_relationship(player_id, "pico", 10)
             
-        elif choice == "help_pico":
-            rewards["exp"] = 50
-            rewards["money"] = 100
-            rewards["relationship"] = 15
-            self.db.update_relationship(player_id, "pico", 15)
-            self.db.update_relationship(player_id, "boyfriend", 5)
+            elif choice == "help_pico":
+                rewards["exp"] = 50
+                rewards["money"] = 100
+                rewards["relationship"] = 15
+                self.db.update_relationship(player_id, "pico", 15)
+                self.db.update_relationship(player_id, "boyfriend", 5)
             
-        elif choice == "challenge_battle":
-            rewards["exp"] = 75
-            rewards["relationship"] = 20
-            self.db.update_relationship(player_id, "pico", 20)
+            elif choice == "challenge_battle":
+                rewards["exp"] = 75
+                rewards["relationship"] = 20
+                self.db.update_relationship(player_id, "pico", 20)
             
-        # Добавляем награды
-        if rewards["exp"] > 0:
-            self.db.add_experience(player_id, rewards["exp"])
+            # Выбор запоминается флагом сюжета, последняя сцена закрывает главу
+            if choice in FLAG_BITS:
+                self.db.set_story_flag(player_id, choice)
+            chapter = (chapter_data or {}).get("completes_chapter")
+            chapter_completed = bool(chapter) and self.db.complete_chapter(player_id, chapter)
+            self.db.touch_activity(player_id)
             
-        if rewards["money"] > 0:
-            self.db.add_money(player_id, rewards["money"])
+            # Добавляем награды
+            granted = self.db.grant_rewards(player_id, rewards["exp"], rewards["money"])
             
         # Обновляем достижения
-        self.db.update_achievement_progress(player_id, "pico_friend", rewards["relationship"])
-        self.db.update_quest_progress(player_id, "social")
+        rewards["achievements"] = self.achievements.publish(
+            CHOICE_MADE, player_id, choice=choice, relationship=rewards["relationship"]
+        )
+        if chapter_completed:
+            rewards["achievements"] += self.achievements.publish(CHAPTER_COMPLETED, player_id, chapter=chapter)
+        rewards["achievements"] += self.publish_rewards(player_id, rewards["money"], granted)
+        self.progress.add_quest(player_id, "social")
         
         return rewards
     
-    def get_player_progress(self, player_id):
-        """Получить полный прогресс игрока"""
-        player_data = self.db.get_player(player_id)
+    def get_player_progress(self, telegram_id):
+        """Получить сводку прогресса игрока (без полных списков)"""
+        player_data = self.db.get_player(telegram_id)
         if not player_data:
             return None
-            
-        achievements = self.db.get_player_achievements(player_id)
-        active_quests = self.db.get_active_quests(player_id)
-        completed_quests = self.db.get_completed_quests(player_id)
-        inventory = self.db.get_inventory(player_id)
-        
-        completed_achievements = [a for a in achievements if a['completed']]
-        completion_percentage = (len(completed_achievements) / len(achievements)) * 100 if achievements else 0
         
+        # Списки достижений и инвентаря грузит только тот экран, который их показывает
+        self.progress.flush_player(player_data['id'])
+        return self.summarize_progress(player_data, self.db.get_player_dashboard(player_data['id']))
+    
+    def summarize_progress(self, player_data, dashboard):
+        """Сводка прогресса из записи игрока и get_player_dashboard (бот читает их из пула читателей)"""
         return {
             "player": player_data,
             "achievements": {
-                "total": len(achievements),
-                "completed": len(completed_achievements),
-                "completion_percentage": round(completion_percentage, 1),
-                "list": achievements
+                "total": dashboard['achievements_total'],
+                "completed": dashboard['achievements_completed'],
+                "completion_percentage": dashboard['achievements_percentage']
             },
             "quests": {
-                "active": active_quests,
-                "completed": len(completed_quests),
-                "active_count": len(active_quests)
+                "completed": dashboard['quests_completed'],
+                "active_count": dashboard['quests_active']
             },
             "inventory": {
-                "items": inventory,
-                "total_items": sum(item['quantity'] for item in inventory)
+                "total_items": dashboard['inventory_items']
             },
-            "play_time": self.calculate_play_time(player_id)
+            "play_time": self.play_time(player_data)
         }
 
 # Глобальный экземпляр движка
@@ -0,0 +1,92 @@
+import bisect
+import threading
+from core.database import database
+from game.battle import battle_system
+
+LEADERBOARD_SIZE = 100  # сколько лучших результатов держим в памяти на рейтинг
+
+class TopK:
+    """Отсортированный топ-K лучших результатов одного рейтинга
+
+    Результаты игрока только растут (лучший счет), поэтому игрок,
+    выпавший из топа, может вернуться в него лишь с новым рекордом.
+    """
+
+    def __init__(self, size=LEADERBOARD_SIZE):
+        self.size = size
+        self.entries = []  # [(-score, player_id)] по возрастанию = по убыванию счета
+        self.scores = {}  # {player_id: score} для игроков в топе
+        self.lock = threading.Lock()
+
+    def update(self, player_id, score):
+        """Учесть новый лучший результат, True если топ изменился"""
+        key = (-score, player_id)
+        with self.lock:
+            old_score = self.scores.get(player_id)
+            if old_score is not None:
+                if score <= old_score:
+                    return False
+                del self.entries[bisect.bisect_left(self.entries, (-old_score, player_id))]
+            elif len(self.entries) >= self.size and key >= self.entries[-1]:
+                return False
+
+            bisect.insort(self.entries, key)
+            self.scores[player_id] = score
+
+            if len(self.entries) > self.size:
+                _, evicted = self.entries.pop()
+                del self.scores[evicted]
+            return True
+
+    def top(self, limit):
+        """[(player_id, score)] лучших результатов"""
+        with self.lock:
+            return [(player_id, -neg_score) for neg_score, player_id in self.entries[:limit]]
+
+    def rank(self, player_id):
+        """(место, счет) игрока в топе или None, если он за пределами топа
+
+        Равные результаты делят место, как в get_leaderboard_rank: место - число
+        строго лучших результатов плюс один.
+        """
+        with self.lock:
+            score = self.scores.get(player_id)
+            if score is None:
+                return None
+            return bisect.bisect_left(self.entries, (-score,)) + 1, score
+
+    def load(self, entries):
+        with self.lock:
+            self.entries = sorted((-score, player_id) for player_id, score in entries)[:self.size]
+            self.scores = {player_id: -neg_score for neg_score, player_id in self.entries}
+
+class Leaderboards:
+    """Глобальный рейтинг и рейтинги песен в памяти, восстанавливаются из song_stats"""
+
+    def __init__(self, db, songs, size=LEADERBOARD_SIZE):
+        self.db = db
+        self.size = size
+        self.global_board = TopK(size)
+        self.song_boards = {song_id: TopK(size) for song_id in songs}
+        self.rebuild()
+
+    def rebuild(self):
+        """Загрузить топы из базы (индексные запросы, без истории битв)"""
+        self.global_board.load(self.db.get_leaderboard_top(None, self.size))
+        for song_id, board in self.song_boards.items():
+            board.load(self.db.get_leaderboard_top(song_id, self.size))
+
+    def board(self, song_id=None):
+        if song_id is None:
+            return self.global_board
+        return self.song_boards.get(song_id)
+
+    def record(self, player_id, song_id, best_score, best_score_total):
+        """Обновить рейтинги после записанной битвы"""
+        board = self.song_boards.get(song_id)
+        if board is not None:
+            board.update(player_id, best_score)
+        self.global_board.update(player_id, best_score_total)
+
+# Глобальные рейтинги
+leaderboards = Leaderboards(database, battle_system.songs)
@@ -0,0 +1,65 @@
+import time
+import config
+from game.battle import battle_system
+
+class TimingJudge:
+    """Оценка тайминга нажатий на сервере с поправкой на задержку Telegram
+
+    Нажатие штампуется монотонными часами при получении callback. Промежуток
+    от предыдущего нажатия сравнивается с промежутком между нотами карты:
+    разница - это опоздание игрока плюс круговая задержка Telegram (правка
+    сообщения до игрока и callback обратно). Задержку оценивает
+    экспоненциальное сглаживание по ходу битвы, и в окна точности попадает
+    только остаток. Оценка хранится в самой битве (BattleState.latency) и
+    уходит вместе с ней, поэтому у судьи нет состояния на каждого игрока.
+    На нажатие - несколько арифметических операций и бинарный поиск по
+    границам окон, то есть O(1).
+    """
+
+    def __init__(
+        self,
+        alpha=config.LATENCY_EWMA_ALPHA,
+        initial=config.LATENCY_INITIAL_SECONDS,
+        max_sample=config.LATENCY_MAX_SECONDS,
+        clock=time.monotonic
+    ):
+        self.alpha = alpha
+        self.initial = initial
+        self.max_sample = max_sample
+        self.clock = clock
+
+    def stamp(self):
+        """Момент получения нажатия; берется до любых await в обработчике"""
+        return self.clock()
+
+    def judge(self, battle, stamp, notes=1):
+        """Оценка нажатия для текущей ноты битвы: perfect, good или bad
+
+        Для фразы (notes > 1) ожидаемый промежуток - до последней ноты фразы.
+        """
+        index = battle.current_note
+        last = min(index + notes, battle.total_notes) - 1
+        previous, battle.last_input = battle.last_input, stamp
+        if previous is None:
+            # Первое нажатие битвы или после восстановления - отсчитывать не от чего
+            return 'good'
+
+        timings = battle.chart.timings_ms
+        expected = (timings[last] - timings[index - 1] if index else timings[last]) / 1000
+        offset = stamp - previous - expected
+        latency = self.estimate(battle)
+        # В оценку задержки идет только правдоподобный замер: раннее нажатие - не
+        # отрицательная задержка, а долгая пауза - игрок отошел, а не сеть, и такой
+        # замер не учитывается вовсе
+        if offset <= self.max_sample:
+            sample = max(offset, 0.0)
+            battle.latency = latency + self.alpha * (sample - latency)
+        # Оценивается знаковое отклонение, поэтому слишком ранние нажатия - bad
+        return battle_system.calculate_timing_accuracy(offset - latency)
+
+    def estimate(self, battle):
+        """Текущая оценка задержки игрока в битве в секундах"""
+        return self.initial if battle.latency is None else battle.latency
+
+# Глобальный экземпляр оценки тайминга
+timing_judge = TimingJudge()
@@ -28,6 +28,19 @@ def main():
         logger.info("Бот запускается в режиме polling...")
         bot.application.run_polling()
         
+        import config
+        from core.counters import progress
+        from core.dao import dao
+        from core.database import database, snapshots
+        from game.battle_sessions import battle_sessions
+        dao.close()
+        progress.flush()
+        battle_sessions.flush()
+        if config.DB_STORAGE == "memory":
+            # Последний снимок, чтобы следующий запуск продолжил с того же места
+            snapshots.snapshot()
+        database.close()
+        
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
         logger.info("Бот остановлен")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Сравнение реализаций GameStorage по операциям
+
+Запуск: python -m tools.bench_backends [количество_игроков]
+Для каждой операции печатает среднее время вызова в микросекундах
+на SQLite в файле (WAL), SQLite в памяти и InMemoryGameStorage.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from core.database import GameDatabase
+from core.memory_storage import InMemoryGameStorage
+from game.battle import battle_system
+
+SONGS = list(battle_system.songs)
+
+
+def battle(rng):
+    return {
+        'song_id': rng.choice(SONGS), 'score': rng.randint(1000, 100000), 'max_combo': rng.randint(0, 200),
+        'perfect_hits': rng.randint(0, 50), 'good_hits': rng.randint(0, 30), 'bad_hits': rng.randint(0, 10),
+        'missed': rng.randint(0, 10), 'battle_duration': 60
+    }
+
+
+def operations(db, players, rng):
+    """[(имя, функция без аргументов)] в порядке замера"""
+    telegram_ids = list(range(1, players + 1))
+    created = []
+
+    def create_player():
+        telegram_id = len(created) + 1
+        created.append(db.create_player(telegram_id, f"user{telegram_id}", f"Player{telegram_id}")['id'])
+
+    def player_id():
+        return rng.choice(created)
+
+    return [
+        ("create_player", create_player, players),
+        ("get_player", lambda: db.get_player(rng.choice(telegram_ids)), players),
+        ("spend_energy", lambda: db.spend_energy(player_id(), 1), players),
+        ("grant_rewards", lambda: db.grant_rewards(player_id(), 10, 5), players),
+        ("settle_battle", lambda: db.settle_battle(player_id(), battle(rng), 50, 25), players * 2),
+        ("apply_progress", lambda: db.apply_progress(
+            {(player_id(), "combo_master"): 5}, {(player_id(), "battle"): 1}
+        ), players),
+        ("get_leaderboard_top", lambda: db.get_leaderboard_top(rng.choice(SONGS + [None]), 10), players),
+        ("get_leaderboard_rank", lambda: db.get_leaderboard_rank(player_id()), players),
+        ("get_player_dashboard", lambda: db.get_player_dashboard(player_id()), players),
+        ("get_player_achievements", lambda: db.get_player_achievements(player_id(), 10), players),
+    ]
+
+
+def measure(db, players):
+    # Одинаковое зерно - одинаковая последовательность операций во всех хранилищах
+    rng = random.Random(42)
+    results = {}
+    for name, fn, calls in operations(db, players, rng):
+        started = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        results[name] = (time.perf_counter() - started) / calls * 1_000_000
+    return results
+
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = {
+            "sqlite-wal": GameDatabase(os.path.join(tmp, "bench.db")),
+            "sqlite-mem": GameDatabase(),
+            "python": InMemoryGameStorage(),
+        }
+        results = {}
+        for name, db in backends.items():
+            results[name] = measure(db, players)
+            db.close()
+
+    print(f"{'операция (мкс)':<26}" + "".join(f"{name:>12}" for name in results))
+    for operation in next(iter(results.values())):
+        print(f"{operation:<26}" + "".join(f"{results[name][operation]:>12.1f}" for name in results))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Память на одновременные битвы
+
+Запуск: python -m tools.bench_battles [число_битв]
+Создает N битв (по умолчанию 10000) в прежнем виде - dict с собственным
+списком нот-словарей - и в виде BattleState с общими картами, и печатает
+байт на битву по tracemalloc. Каждая битва проходит половину нот, чтобы
+в обоих вариантах были заполнены итоги нот.
+"""
+import gc
+import random
+import sys
+import tracemalloc
+from datetime import datetime
+
+from game.battle import battle_system
+from game.charts import get_chart
+
+
+def legacy_battle(song_id, seed):
+    """Битва в формате до BattleState: dict с копией нот на каждую битву"""
+    song = battle_system.songs[song_id]
+    chart = battle_system.get_chart(song_id, seed)
+    patterns = [
+        {'id': i, 'arrows': chart.arrows(i), 'timing': chart.timing(i), 'hit': None, 'score': 0}
+        for i in range(len(chart))
+    ]
+    battle = {
+        'song_id': song_id, 'song_name': song['name'], 'total_notes': song['notes'],
+        'notes_hit': 0, 'perfect_hits': 0, 'good_hits': 0, 'bad_hits': 0, 'missed': 0,
+        'combo': 0, 'max_combo': 0, 'score': 0, 'patterns': patterns, 'current_note': 0,
+        'start_time': datetime.now(), 'completed': False, 'energy_cost': song['energy_cost']
+    }
+    for note in patterns[:len(patterns) // 2]:
+        note['hit'] = True
+        note['score'] = 50 * (note['id'] + 1)
+        battle['current_note'] += 1
+    return battle
+
+
+def slotted_battle(song_id, seed):
+    battle = battle_system.start_battle(0, song_id)
+    chart = battle.chart
+    for index in range(len(chart) // 2):
+        battle_system.process_note_input(battle, chart.arrows(index), 'good')
+    return battle
+
+
+def measure(factory, count):
+    """Байт на битву с учетом общих карт (кэш очищается перед замером)"""
+    rng = random.Random(42)
+    songs = list(battle_system.songs)
+    get_chart.cache_clear()
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    battles = [factory(rng.choice(songs), rng.randrange(8)) for _ in range(count)]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    del battles
+    return used / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    legacy = measure(legacy_battle, count)
+    slotted = measure(slotted_battle, count)
+
+    print(f"Одновременных битв: {count}")
+    print(f"  dict + список нот:     {legacy:>10.0f} байт на битву")
+    print(f"  BattleState + карта:   {slotted:>10.0f} байт на битву")
+    print(f"  в {legacy / slotted:.1f} раза меньше, всего {legacy * count / 2**20:.1f} -> {slotted * count / 2**20:.1f} МБ")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
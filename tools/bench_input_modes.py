@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Ввод по одной ноте против ввода фразами: вызовы Telegram API и время на песню
+
+Запуск: python -m tools.bench_input_modes [задержка_вызова_мс] [нот_во_фразе]
+Проходит каждую песню без ошибок в двух режимах по тому же пути, что и
+обработчики бота: кнопка на ноту (query.answer + edit_message_text) и фраза
+текстом (один reply_text). Вызовы API заменены заглушкой, которая ждет
+заданную задержку (по умолчанию 20 мс) и считает вызовы.
+"""
+import asyncio
+import sys
+import time
+
+import config
+from game.battle import battle_system
+from game.charts import phrase_text, parse_phrase
+from game.timing import TimingJudge
+
+
+class FakeTelegram:
+    """Заглушка вызовов API с фиксированной задержкой"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def call(self, *args, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+
+async def play_notes(song_id, api, judge):
+    battle = battle_system.start_battle(0, song_id)
+    while not battle.completed:
+        # Как в button_handler: штамп до query.answer()
+        stamp = judge.stamp()
+        await api.call()  # query.answer()
+        arrows = battle.chart.arrows(battle.current_note)
+        battle_system.process_note_input(battle, arrows, judge.judge(battle, stamp))
+        await api.call()  # query.edit_message_text(...)
+    return battle
+
+
+async def play_phrases(song_id, api, judge, phrase_notes):
+    battle = battle_system.start_battle(0, song_id)
+    while not battle.completed:
+        stamp = judge.stamp()
+        # Игрок набирает показанную фразу, бот разбирает текст сообщения
+        index = battle.current_note
+        masks = parse_phrase(phrase_text(battle.chart.masks[index:index + phrase_notes]))
+        battle_system.process_phrase(battle, masks, judge.judge(battle, stamp, len(masks)))
+        await api.call()  # update.message.reply_text(...)
+    return battle
+
+
+async def measure(play, song_id, latency, *args):
+    api = FakeTelegram(latency)
+    started = time.perf_counter()
+    await play(song_id, api, TimingJudge(), *args)
+    return api.calls, time.perf_counter() - started
+
+
+def main():
+    latency = (float(sys.argv[1]) if len(sys.argv) > 1 else 20) / 1000
+    phrase_notes = int(sys.argv[2]) if len(sys.argv) > 2 else config.BATTLE_PHRASE_NOTES
+
+    print(f"Задержка вызова API: {latency * 1000:.0f} мс, нот во фразе: {phrase_notes}")
+    print(f"{'песня':<16}{'нот':>5}  {'вызовы по нотам':>16}{'фразами':>9}  {'время по нотам':>15}{'фразами':>9}")
+    for song_id, song in battle_system.songs.items():
+        note_calls, note_time = asyncio.run(measure(play_notes, song_id, latency))
+        phrase_calls, phrase_time = asyncio.run(measure(play_phrases, song_id, latency, phrase_notes))
+        print(
+            f"{song_id:<16}{song['notes']:>5}  {note_calls:>16}{phrase_calls:>9}  "
+            f"{note_time:>13.2f} с{phrase_time:>7.2f} с"
+        )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Сравнение задержки записи: база в памяти против файла в режиме WAL
+
+Запуск: python -m tools.bench_storage [количество_записей]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from core.database import GameDatabase
+
+
+def measure_writes(db, writes):
+    player = db.create_player(1, "bench", "Bench")
+    latencies = []
+    
+    for i in range(writes):
+        started = time.perf_counter()
+        db.add_money(player['id'], 1)
+        latencies.append(time.perf_counter() - started)
+    
+    latencies.sort()
+    return {
+        "avg_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def main():
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        modes = {
+            "memory": GameDatabase(),
+            "wal": GameDatabase(os.path.join(tmp, "bench.db")),
+        }
+        
+        for name, db in modes.items():
+            result = measure_writes(db, writes)
+            print(
+                f"{name:>6}: avg {result['avg_ms']:.3f} мс | "
+                f"p50 {result['p50_ms']:.3f} мс | p99 {result['p99_ms']:.3f} мс"
+            )
+            db.close()
+    
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
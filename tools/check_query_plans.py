@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""Проверка EXPLAIN QUERY PLAN горячих запросов на свежей схеме
+
+Запуск: python -m tools.check_query_plans
+Возвращает код 1, если какой-то запрос сканирует таблицу целиком.
+"""
+import sys
+
+from core.database import GameDatabase
+from core.migrations import HOT_PATH_QUERIES, find_full_scans
+
+
+def main():
+    db = GameDatabase()
+    full_scans = find_full_scans(db.conn)
+    
+    for name in HOT_PATH_QUERIES:
+        status = "SCAN" if any(scan[0] == name for scan in full_scans) else "ok"
+        print(f"{status:>4}  {name}")
+    
+    for name, detail in full_scans:
+        print(f"Полное сканирование в {name}: {detail}")
+    
+    db.close()
+    return 1 if full_scans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Проверка соответствия хранилищ протоколу GameStorage
+
+Запуск: python -m tools.check_storage
+Прогоняет одни и те же сценарии на SQLite в памяти, шардированной SQLite
+и InMemoryGameStorage. Возвращает код 1, если какая-то проверка не прошла.
+"""
+import itertools
+import os
+import sys
+import tempfile
+import traceback
+
+from core.database import GameDatabase
+from core.memory_storage import InMemoryGameStorage
+from core.sharding import ShardedGameDatabase, shard_paths
+
+
+def battle(song_id, score, perfect_hits=5, max_combo=20):
+    return {
+        'song_id': song_id, 'score': score, 'max_combo': max_combo, 'perfect_hits': perfect_hits,
+        'good_hits': 3, 'bad_hits': 1, 'missed': 0, 'battle_duration': 60
+    }
+
+
+def expect(actual, expected, what):
+    if actual != expected:
+        raise AssertionError(f"{what}: ожидалось {expected!r}, получено {actual!r}")
+
+
+def check_players(db):
+    player = db.create_player(101, "alice", "Alice")
+    expect(player['telegram_id'], 101, "telegram_id")
+    expect((player['level'], player['money'], player['energy']), (1, 100, 100), "стартовые значения")
+    expect(player['story']['pico_relationship'], 0, "прогресс сюжета")
+    expect(player['stats']['total_battles'], 0, "статистика")
+    expect(db.create_player(101, "alice", "Alice"), None, "повторное создание")
+    expect(db.get_player(999), None, "неизвестный игрок")
+    expect([item['item_id'] for item in db.get_inventory(player['id'])],
+           ["health_potion", "guitar_pick", "energy_drink"], "инвентарь по имени")
+    expect(db.get_player_names([player['id'], -1]), {player['id']: "Alice"}, "имена")
+
+
+def check_energy(db):
+    player = db.create_player(102, "bob", "Bob")
+    expect(db.spend_energy(player['id'], 30), True, "списание")
+    expect(db.get_player(102)['energy'], 70, "энергия после списания")
+    expect(db.spend_energy(player['id'], 100), False, "списание сверх остатка")
+    expect(db.spend_energy(player['id'], 0), True, "нулевое списание")
+    db.update_energy(player['id'], 5)
+    expect(db.get_player(102)['energy'], 5, "энергия после update_energy")
+
+
+def check_rewards(db):
+    player = db.create_player(103, "carol", "Carol")
+    expect(db.grant_rewards(player['id'], 450, 50), {"level_up": 3, "levels_gained": 2}, "повышение на 2 уровня")
+    player = db.get_player(103)
+    expect((player['level'], player['exp'], player['money']), (3, 450, 150), "уровень, опыт, деньги")
+    expect((player['max_health'], player['max_energy']), (120, 110), "бонусы уровня")
+    expect(player['stats']['money_earned'], 50, "заработано")
+    expect(db.grant_rewards(player['id'], 10, 0), {"level_up": None, "levels_gained": 0}, "без повышения")
+
+    db.add_experience(player['id'], 500)
+    expect(db.get_player(103)['level'], 4, "add_experience повышает уровень")
+    db.add_money(player['id'], -20)
+    expect(db.get_player(103)['money'], 130, "трата денег")
+    db.update_relationship(player['id'], "pico", 7)
+    expect(db.get_player(103)['story']['pico_relationship'], 7, "отношения")
+
+
+def check_story(db):
+    player_id = db.create_player(107, "gus", "Gus")['id']
+    state = db.get_player(107)['story_state']
+    expect((state.flags(), state.completed_chapters()), ([], []), "пустой сюжет")
+    expect(db.set_story_flag(player_id, "help_pico"), True, "новый флаг")
+    expect(db.set_story_flag(player_id, "help_pico"), False, "флаг уже стоит")
+    expect(db.complete_chapter(player_id, "chapter2"), True, "глава пройдена")
+    expect(db.complete_chapter(player_id, "chapter2"), False, "повторное прохождение")
+    state = db.get_player(107)['story_state']
+    expect((state.has_flag("help_pico"), state.has_flag("ask_pico_past")), (True, False), "has_flag")
+    expect((state.is_chapter_completed("chapter2"), state.chapters_completed()), (True, 1), "главы")
+    try:
+        db.set_story_flag(player_id, "unknown_flag")
+        raise AssertionError("незарегистрированный флаг принят")
+    except ValueError:
+        pass
+
+
+def check_quests(db):
+    player_id = db.create_player(104, "dave", "Dave")['id']
+    expect(db.add_quest(player_id, "q1", "battle", 2), True, "выдача квеста")
+    expect(db.add_quest(player_id, "q1", "battle", 2), False, "повторная выдача")
+    rows = [
+        (player_id, "d1", "social", 3, "2000-01-01 00:00:00"),
+        (player_id, "d2", "social", 5, "2000-01-01 00:00:00"),
+        (player_id, "d1", "social", 3, "2000-01-01 00:00:00"),
+        (player_id, "d3", "skill", 1, "2999-01-01 00:00:00"),
+    ]
+    expect(db.add_quests_bulk(rows), 3, "пакетная выдача без дублей")
+    expect(sorted(db.get_open_quests(player_id, "social")), [(0, 3), (0, 5)], "открытые квесты")
+
+    expect(db.update_quest_progress(player_id, "social", 3), 1, "завершение квеста")
+    expect(db.get_open_quests(player_id, "social"), [(3, 5)], "остаток после завершения")
+    db.apply_progress({}, {(player_id, "battle"): 2})
+    expect(db.get_open_quests(player_id, "battle"), [], "apply_progress завершает квесты")
+    expect(db.get_player_dashboard(player_id)['quests_active'], 2, "активные в профиле")
+
+    expect(db.expire_quests("2100-01-01 00:00:00", 1), 1, "порция ротации")
+    expect(db.expire_quests("2100-01-01 00:00:00", 10), 1, "остаток ротации")
+    expect(db.expire_quests("2100-01-01 00:00:00", 10), 0, "нечего удалять")
+    expect(sorted(quest['quest_id'] for quest in db.get_active_quests(player_id)), ["d3"], "неистекшие квесты")
+    expect(db.get_completed_quests(player_id), [], "журнал завершенных")
+
+
+def check_achievements(db):
+    player_id = db.create_player(105, "erin", "Erin")['id']
+    expect(db.get_achievement_targets()["combo_master"], 100, "цель из каталога")
+    expect(bool(db.update_achievement_progress(player_id, "first_blood")), True, "завершение с первого раза")
+    expect(bool(db.update_achievement_progress(player_id, "unknown")), False, "неизвестное достижение")
+    db.apply_progress({(player_id, "combo_master"): 60, (player_id, "popular"): 20}, {})
+    db.apply_progress({(player_id, "combo_master"): 30}, {})
+    expect(db.get_achievement_state(player_id, "combo_master"), (90, False), "накопленный прогресс")
+    expect(db.get_achievement_state(player_id, "popular"), (20, True), "завершено через apply_progress")
+    expect(db.get_achievement_state(player_id, "legendary"), (0, False), "не начатое")
+
+    achievements = db.get_player_achievements(player_id)
+    expect(len(achievements), len(db.get_achievement_targets()), "весь каталог")
+    expect([row['achievement_id'] for row in achievements[:3]],
+           ["popular", "first_blood", "combo_master"], "порядок: завершенные, затем по прогрессу")
+    expect(len(db.get_player_achievements(player_id, 2)), 2, "limit")
+    dashboard = db.get_player_dashboard(player_id)
+    expect((dashboard['achievements_completed'], dashboard['achievements_percentage']), (2, 20.0), "профиль")
+
+
+def check_battles(db):
+    ids = [db.create_player(200 + i, f"p{i}", f"P{i}")['id'] for i in range(3)]
+    result = db.settle_battle(ids[0], battle("bopeebo", 5000, perfect_hits=12), 100, 30)
+    expect((result['best_score'], result['best_score_total'], result['level_up']), (5000, 5000, 2), "итог битвы")
+    db.settle_battle(ids[0], battle("bopeebo", 4000), 0, 0)
+    db.settle_battle(ids[0], battle("fresh", 1500), 0, 0)
+    db.settle_battle(ids[1], battle("bopeebo", 7000), 0, 0)
+    db.record_battle(ids[2], "fresh", 3000, 50, 1, 1, 1, 0, 40)
+
+    expect(db.get_leaderboard_top(None, 10), [(ids[1], 7000), (ids[0], 6500), (ids[2], 3000)], "глобальный топ")
+    expect(db.get_leaderboard_top("bopeebo", 1), [(ids[1], 7000)], "топ песни")
+    expect(db.get_leaderboard_rank(ids[0]), {"score": 6500, "rank": 2}, "место в глобальном")
+    expect(db.get_leaderboard_rank(ids[0], "fresh"), {"score": 1500, "rank": 2}, "место в песне")
+    expect(db.get_leaderboard_rank(ids[1], "fresh"), None, "не играл песню")
+    expect(db.count_better_scores(3000), 2, "лучше результата")
+
+    songs = {row['song_id']: row for row in db.get_song_stats(ids[0])}
+    expect((songs['bopeebo']['best_score'], songs['bopeebo']['play_count']), (5000, 2), "итоги песни")
+    stats = db.get_player(200)['stats']
+    expect((stats['total_battles'], stats['perfect_scores'], stats['max_combo']), (3, 1, 20), "статистика битв")
+    expect(sorted(db.get_recently_active_player_ids(1)), sorted(ids), "недавно активные")
+    expect(db.compact_battle_history(30, 100), 0, "свежая история не удаляется")
+
+
+def check_replays(db):
+    ids = [db.create_player(400 + i, f"r{i}", f"R{i}")['id'] for i in range(5)]
+    for i, player_id in enumerate(ids):
+        db.settle_battle(player_id, {**battle("tutorial", 100 * i), 'replay': bytes([1, i])}, 0, 0)
+    db.settle_battle(ids[0], battle("fresh", 900), 0, 0)
+
+    # Порциями по 2 через курсор последней строки
+    rows = []
+    after = None
+    while True:
+        part = db.get_battle_replays(after, 2)
+        if not part:
+            break
+        expect(len(part) <= 2, True, "размер порции повторов")
+        rows += part
+        after = part[-1][0]
+    expect(sorted(row[1:] for row in rows), [("tutorial", bytes([1, i]), 100 * i, 20) for i in range(5)],
+           "повторы битв без записей без повтора")
+    expect(len({row[0] for row in rows}), 5, "курсоры повторов уникальны")
+
+
+def check_saved_battles(db):
+    ids = [db.create_player(300 + i, f"s{i}", f"S{i}")['id'] for i in range(3)]
+    expect(db.save_battles([(player_id, 300 + i, "tutorial", i, bytes([1, i])) for i, player_id in enumerate(ids)]),
+           3, "сохранение битв")
+    db.save_battles([(ids[0], 300, "final_boss", 7, b"\x02")])
+    expect(sorted(db.load_battles()), sorted([
+        (ids[0], 300, "final_boss", 7, b"\x02"),
+        (ids[1], 301, "tutorial", 1, bytes([1, 1])),
+        (ids[2], 302, "tutorial", 2, bytes([1, 2])),
+    ]), "перезапись и загрузка")
+    expect(db.delete_battles([ids[1], ids[2], -1]), 2, "удаление")
+    expect([row[0] for row in db.load_battles()], [ids[0]], "остаток")
+
+
+def check_transactions(db):
+    player_id = db.create_player(106, "fay", "Fay")['id']
+    try:
+        with db.transaction(player_id):
+            db.grant_rewards(player_id, 1000, 500)
+            raise RuntimeError("откат")
+    except RuntimeError:
+        pass
+    expect((db.get_player(106)['level'], db.get_player(106)['money']), (1, 100), "откат транзакции")
+
+    with db.transaction(player_id):
+        db.add_money(player_id, 10)
+        try:
+            with db.transaction(player_id):
+                db.add_money(player_id, 1000)
+                raise RuntimeError("откат вложенной")
+        except RuntimeError:
+            pass
+    expect(db.get_player(106)['money'], 110, "вложенная транзакция откатывается отдельно")
+
+
+CHECKS = [
+    check_players,
+    check_energy,
+    check_rewards,
+    check_story,
+    check_quests,
+    check_achievements,
+    check_battles,
+    check_replays,
+    check_saved_battles,
+    check_transactions,
+]
+
+
+def main():
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        sharded_runs = itertools.count()
+        backends = {
+            "sqlite": lambda: GameDatabase(),
+            "sharded": lambda: ShardedGameDatabase(
+                shard_paths(3, os.path.join(tmp, f"check{next(sharded_runs)}.shard{{}}.db"))
+            ),
+            "python": InMemoryGameStorage,
+        }
+        for name, factory in backends.items():
+            for check in CHECKS:
+                db = factory()
+                try:
+                    check(db)
+                    print(f"  ok  {name:<8} {check.__name__}")
+                except Exception:
+                    failures += 1
+                    print(f"FAIL  {name:<8} {check.__name__}")
+                    traceback.print_exc()
+                finally:
+                    db.close()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
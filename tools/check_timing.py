@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Проверка оценки тайминга нажатий (TimingJudge) на заданных сценариях
+
+Запуск: python -m tools.check_timing
+Моменты нажатий задаются явно, без реального времени. Возвращает код 1,
+если какая-то проверка не прошла.
+"""
+import sys
+import traceback
+
+from game.battle import battle_system
+from game.charts import mask_arrows
+from game.timing import TimingJudge
+
+ROUND_TRIP = 0.5  # постоянная круговая задержка игрока, равна начальной оценке
+
+
+def expect(actual, expected, what):
+    if actual != expected:
+        raise AssertionError(f"{what}: ожидалось {expected!r}, получено {actual!r}")
+
+
+def play(judge, battle, stamp, pauses=None):
+    """Сыграть все ноты точно в такт; pauses - {номер ноты: лишние секунды перед ней}"""
+    pauses = pauses or {}
+    timings = battle.chart.timings_ms
+    judgements = []
+    for index in range(battle.total_notes):
+        if index:
+            stamp += (timings[index] - timings[index - 1]) / 1000 + ROUND_TRIP
+        stamp += pauses.get(index, 0.0)
+        judgement = judge.judge(battle, stamp)
+        judgements.append(judgement)
+        battle_system.process_note_input(battle, mask_arrows(battle.chart.masks[index]), judgement)
+    return judgements
+
+
+def check_first_press(judge):
+    # Игрок 4 секунды читает экран старта, затем жмет точно в такт
+    battle = battle_system.start_battle(1, "tutorial")
+    judgements = play(judge, battle, battle.start_time + 4.0)
+    expect(judgements[0], 'good', "первое нажатие не оценивается по промежутку")
+    expect(judgements[1:5], ['perfect'] * 4, "ноты 1-4 после ожидания на старте")
+    expect(battle.max_combo, battle.total_notes, "комбо без сбросов")
+    expect(round(judge.estimate(battle), 6), ROUND_TRIP, "оценка задержки")
+
+
+def check_pause(judge):
+    # Пауза дольше LATENCY_MAX_SECONDS: сама нота - bad, но задержка не растет
+    battle = battle_system.start_battle(2, "tutorial")
+    judgements = play(judge, battle, battle.start_time, pauses={10: 4.0})
+    expect(judgements[10], 'bad', "нота после паузы")
+    expect(judgements[11:15], ['perfect'] * 4, "ноты после паузы")
+    expect(round(judge.estimate(battle), 6), ROUND_TRIP, "оценка задержки после паузы")
+
+
+CHECKS = [check_first_press, check_pause]
+
+
+def main():
+    failures = 0
+    for check in CHECKS:
+        try:
+            check(TimingJudge(initial=ROUND_TRIP))
+            print(f"  ok  {check.__name__}")
+        except Exception:
+            failures += 1
+            print(f"FAIL  {check.__name__}")
+            traceback.print_exc()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
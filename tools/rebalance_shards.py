@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Перераспределение игроков по шардам
+
+Запуск: python -m tools.rebalance_shards --to 4 [--from 1] [--out data/rebalanced]
+
+Читает текущие файлы (config.DB_PATH при --from 1, иначе шарды по DB_SHARD_PATH),
+раскладывает игроков в --to новых файлов по хэшу telegram_id и выдает им новые id
+(id в шарде дает номер шарда по модулю числа шардов). Бот должен быть остановлен.
+Новые файлы пишутся в --out; после проверки их переносят на место DB_SHARD_PATH
+и запускают бота с FNF_DB_SHARDS=<--to>. Рейтинги и кэши прогресса в памяти
+строятся заново при старте, поэтому смена id игроков для них незаметна.
+"""
+import argparse
+import os
+import sys
+from contextlib import ExitStack
+
+import config
+from core.database import GameDatabase
+from core.sharding import shard_for_telegram, shard_paths
+
+
+def player_tables(conn):
+    """[(таблица, колонки без собственного id)] для таблиц со строками игроков"""
+    tables = []
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"):
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({name})")]
+        if name == "players" or "player_id" not in columns:
+            continue
+        tables.append((name, [column for column in columns if column != "id"]))
+    return tables
+
+
+def rebalance(sources, targets):
+    """Скопировать игроков из sources в targets, возвращает число игроков по шардам"""
+    count = len(targets)
+    next_ids = [index + count for index in range(count)]
+    moved = [0] * count
+    tables = player_tables(targets[0].conn)
+
+    with ExitStack() as stack:
+        for target in targets:
+            stack.enter_context(target.transaction())
+
+        for source in sources:
+            for player in source.conn.execute("SELECT * FROM players ORDER BY id").fetchall():
+                index = shard_for_telegram(player["telegram_id"], count)
+                new_id = next_ids[index]
+                next_ids[index] += count
+                moved[index] += 1
+
+                target = targets[index].conn
+                row = {**dict(player), "id": new_id}
+                target.execute(
+                    f"INSERT INTO players ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                    list(row.values())
+                )
+
+                for table, columns in tables:
+                    rows = source.conn.execute(
+                        f"SELECT {', '.join(columns)} FROM {table} WHERE player_id = ?", (player["id"],)
+                    ).fetchall()
+                    if not rows:
+                        continue
+                    player_column = columns.index("player_id")
+                    target.executemany(
+                        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                        [
+                            [new_id if i == player_column else value for i, value in enumerate(row)]
+                            for row in rows
+                        ]
+                    )
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перераспределить игроков по шардам")
+    parser.add_argument("--from", dest="source_count", type=int, default=config.DB_SHARDS,
+                        help="текущее число шардов (1 - один файл DB_PATH)")
+    parser.add_argument("--to", dest="target_count", type=int, required=True,
+                        help="новое число шардов")
+    parser.add_argument("--out", default="data/rebalanced", help="каталог для новых файлов")
+    args = parser.parse_args()
+
+    if args.source_count > 1:
+        source_paths = shard_paths(args.source_count, config.DB_SHARD_PATH)
+    else:
+        source_paths = [config.DB_PATH]
+    target_paths = shard_paths(
+        args.target_count, os.path.join(args.out, os.path.basename(config.DB_SHARD_PATH))
+    )
+
+    missing = [path for path in source_paths if not os.path.exists(path)]
+    if missing:
+        print(f"Нет исходных файлов: {', '.join(missing)}")
+        return 1
+    existing = [path for path in target_paths if os.path.exists(path)]
+    if existing:
+        print(f"Файлы уже существуют, удалите их или выберите другой --out: {', '.join(existing)}")
+        return 1
+
+    # Открытие через GameDatabase догоняет схему исходных файлов миграциями
+    sources = [GameDatabase(path) for path in source_paths]
+    targets = [
+        GameDatabase(path, shard=(index, args.target_count))
+        for index, path in enumerate(target_paths)
+    ]
+
+    moved = rebalance(sources, targets)
+    total = sum(source.conn.execute("SELECT COUNT(*) FROM players").fetchone()[0] for source in sources)
+
+    for path, players in zip(target_paths, moved):
+        print(f"{path}: {players} игроков")
+    print(f"Всего перенесено {sum(moved)} из {total}")
+
+    for db in sources + targets:
+        db.close()
+    return 0 if sum(moved) == total else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
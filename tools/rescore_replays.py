@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Пакетный пересчет счета, комбо и оценки битв по повторам (нужен numpy)
+
+Запуск: python -m tools.rescore_replays [--shards N] [--batch 50000] [--verify 1000]
+        python -m tools.rescore_replays --synthetic 1000000
+Зависимости: pip install -r tools/requirements.txt
+
+Читает повторы из battle_replays (config.DB_PATH или шарды DB_SHARD_PATH) и
+пересчитывает их векторно по текущим HIT_SCORING и порогам оценки - например,
+чтобы увидеть, как изменятся результаты после смены множителей. Печатает,
+у скольких битв изменился счет. --verify прогоняет первые N повторов через
+обычный process_note_input и проверяет, что результаты совпадают точно.
+--synthetic вместо базы пересчитывает N случайных повторов (замер скорости).
+Сама база не меняется.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import config
+from core.database import GameDatabase
+from core.sharding import ShardedGameDatabase, shard_paths
+from game.battle import (
+    HIT_SCORING, INPUT_MASK, JUDGEMENT_SHIFT, REPLAY_HEADER, REPLAY_VERSION, TIMING_JUDGEMENTS,
+    battle_system, unpack_replay
+)
+
+GRADES = np.array(["S", "A", "B", "C", "D", "F"])
+
+# Очки и продление комбо по коду оценки (номеру в TIMING_JUDGEMENTS)
+POINTS = np.array([HIT_SCORING[judgement][1] for judgement in TIMING_JUDGEMENTS], dtype=np.int64)
+KEEPS_COMBO = np.array([HIT_SCORING[judgement][2] for judgement in TIMING_JUDGEMENTS])
+
+
+def rescore_song(song_id, seeds, inputs):
+    """Итоги битв одной песни: seeds - (n,), inputs - (n, нот) байты ввода
+
+    Повторяет process_note_input для всех битв сразу. Комбо на ноте - число
+    подряд идущих продлевающих попаданий: накопленная сумма минус ее значение
+    на последнем сбросе (максимум с накоплением по сбросам).
+    """
+    total = battle_system.songs[song_id]['notes']
+    unique_seeds, seed_index = np.unique(seeds, return_inverse=True)
+    charts = np.stack([
+        np.frombuffer(battle_system.get_chart(song_id, int(seed)).masks, dtype=np.uint8) for seed in unique_seeds
+    ])
+
+    hit = (inputs & INPUT_MASK) == charts[seed_index]
+    codes = np.minimum(inputs >> JUDGEMENT_SHIFT, len(TIMING_JUDGEMENTS) - 1)
+    extends = hit & KEEPS_COMBO[codes]
+
+    streak = np.cumsum(extends, axis=1, dtype=np.int32)
+    combo = streak - np.maximum.accumulate(np.where(extends, 0, streak), axis=1)
+    score = (np.where(hit, POINTS[codes], 0) * combo).sum(axis=1)
+
+    played = inputs.shape[1]
+    hits = [(hit & (codes == code)).sum(axis=1) for code in range(len(TIMING_JUDGEMENTS))]
+    # Как в get_battle_summary: notes_hit считает каждую сыгранную ноту
+    accuracy = played / total * 100
+    perfect_percentage = hits[0] / total * 100
+    grade = GRADES[np.select(
+        [(accuracy >= 90) & (perfect_percentage >= 80), accuracy >= 90, accuracy >= 80, accuracy >= 70, accuracy >= 60],
+        [0, 1, 2, 3, 4],
+        5
+    )]
+
+    return {
+        'score': score,
+        'max_combo': combo.max(axis=1),
+        'perfect_hits': hits[0],
+        'good_hits': hits[1],
+        'bad_hits': hits[2],
+        'missed': played - hit.sum(axis=1),
+        'grade': grade,
+    }
+
+
+def rescore(replays):
+    """Пересчитать [(song_id, replay)] по песням, возвращает список итогов в том же порядке
+
+    Итог - dict полей rescore_song или None, если песни нет или повтор не
+    подходит (другой формат, число нот песни изменилось).
+    """
+    groups = {}
+    for position, (song_id, replay) in enumerate(replays):
+        song = battle_system.songs.get(song_id)
+        unpacked = unpack_replay(replay)
+        if song is None or unpacked is None or len(unpacked[1]) != song['notes']:
+            continue
+        groups.setdefault(song_id, []).append((position, *unpacked))
+
+    results = [None] * len(replays)
+    for song_id, rows in groups.items():
+        positions, seeds, payloads = zip(*rows)
+        inputs = np.frombuffer(b"".join(payloads), dtype=np.uint8).reshape(len(rows), -1)
+        fields = rescore_song(song_id, np.array(seeds), inputs)
+        for row, position in enumerate(positions):
+            results[position] = {name: values[row].item() for name, values in fields.items()}
+    return results
+
+
+def scalar_result(song_id, replay):
+    """Тот же итог через process_note_input и get_battle_summary"""
+    battle = battle_system.replay_battle(0, song_id, replay)
+    if battle is None or not battle.completed:
+        return None
+    summary = battle_system.get_battle_summary(battle)
+    return {
+        name: summary[name]
+        for name in ('score', 'max_combo', 'perfect_hits', 'good_hits', 'bad_hits', 'missed', 'grade')
+    }
+
+
+def read_replays(db, batch):
+    """Пачки [(song_id, replay, сохраненный счет)] по курсору get_battle_replays"""
+    after = None
+    while True:
+        rows = db.get_battle_replays(after, batch)
+        if not rows:
+            break
+        after = rows[-1][0]
+        yield [(song_id, replay, score) for _, song_id, replay, score, _ in rows]
+
+
+def synthetic_replays(count, batch, seed=42):
+    """Пачки случайных повторов завершенных битв: 85% попаданий, случайные оценки"""
+    rng = np.random.default_rng(seed)
+    songs = list(battle_system.songs)
+    for start in range(0, count, batch):
+        size = min(batch, count - start)
+        rows = []
+        for song_id, size_of_song in zip(songs, rng.multinomial(size, [1 / len(songs)] * len(songs))):
+            notes = battle_system.songs[song_id]['notes']
+            seeds = rng.integers(config.BATTLE_CHART_VARIANTS, size=size_of_song)
+            charts = np.stack([
+                np.frombuffer(battle_system.get_chart(song_id, seed).masks, dtype=np.uint8)
+                for seed in range(config.BATTLE_CHART_VARIANTS)
+            ])
+            masks = np.where(
+                rng.random((size_of_song, notes)) < 0.85, charts[seeds], rng.integers(16, size=(size_of_song, notes))
+            )
+            codes = rng.integers(len(TIMING_JUDGEMENTS), size=(size_of_song, notes))
+            inputs = (masks | codes << JUDGEMENT_SHIFT).astype(np.uint8)
+            rows += [
+                (song_id, REPLAY_HEADER.pack(REPLAY_VERSION, int(seed), notes) + row.tobytes(), None)
+                for seed, row in zip(seeds, inputs)
+            ]
+        yield rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчитать битвы по повторам")
+    parser.add_argument("--shards", type=int, default=config.DB_SHARDS,
+                        help="число шардов (1 - один файл DB_PATH)")
+    parser.add_argument("--batch", type=int, default=50000, help="повторов за один векторный пересчет")
+    parser.add_argument("--verify", type=int, default=1000,
+                        help="сколько первых повторов сверить с process_note_input")
+    parser.add_argument("--synthetic", type=int, default=0, help="пересчитать N случайных повторов вместо базы")
+    args = parser.parse_args()
+
+    db = None
+    if args.synthetic:
+        batches = synthetic_replays(args.synthetic, args.batch)
+    else:
+        if args.shards > 1:
+            db = ShardedGameDatabase(shard_paths(args.shards, config.DB_SHARD_PATH), read_only=True)
+        else:
+            db = GameDatabase(config.DB_PATH, read_only=True)
+        batches = read_replays(db, args.batch)
+
+    total = skipped = changed = verified = mismatched = 0
+    vector_time = scalar_time = 0.0
+    for rows in batches:
+        started = time.perf_counter()
+        results = rescore([(song_id, replay) for song_id, replay, _ in rows])
+        vector_time += time.perf_counter() - started
+
+        for (song_id, replay, stored_score), result in zip(rows, results):
+            total += 1
+            if result is None:
+                skipped += 1
+                continue
+            if stored_score is not None and result['score'] != stored_score:
+                changed += 1
+            if verified < args.verify:
+                started = time.perf_counter()
+                expected = scalar_result(song_id, replay)
+                scalar_time += time.perf_counter() - started
+                verified += 1
+                if expected != result:
+                    mismatched += 1
+                    print(f"Расхождение с process_note_input ({song_id}): {result} != {expected}")
+
+    if db is not None:
+        db.close()
+
+    print(f"Повторов: {total}, пропущено (устаревший формат или песня): {skipped}")
+    if not args.synthetic:
+        print(f"Счет изменился бы у {changed} битв")
+    if total:
+        print(f"Векторный пересчет: {vector_time:.2f} с ({total / vector_time if vector_time else 0:.0f} повторов/с)")
+    if verified:
+        print(
+            f"Сверено с process_note_input: {verified}, расхождений {mismatched} "
+            f"({verified / scalar_time if scalar_time else 0:.0f} повторов/с по одному)"
+        )
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())